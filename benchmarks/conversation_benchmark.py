@@ -0,0 +1,305 @@
+"""Headless benchmark replaying a scripted conversation through the agent.
+
+Drives an ``Agent`` turn by turn the way the app does, with a fake LLM that
+echoes after a fixed latency, against the real summary buffer, transcript and
+vector store in a temporary directory. Reports per-stage p50/p95 latency, disk
+usage, bytes written and memory for every window of turns, and fails if a
+stage of the last window is much slower than in the first one, which would
+mean a storage path grows with the history. Run from the repository root:
+
+    uv run python -m benchmarks.conversation_benchmark --turns 400
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from collections.abc import Iterator
+from typing import Any
+
+from src.llm_agent_gui import agent, embeddings, llm_backend, tracing
+from src.llm_agent_gui.utils import character_sessions
+
+_WORDS = (
+    "saiyan training tournament dragon balls capsule gravity chamber senzu bean "
+    "kamehameha namek tail master roshi island turtle shell milk rice fight "
+    "planet frieza transformation golden hair power level scouter tomorrow "
+    "breakfast mountain river fishing spaceship king kai halo cell games"
+).split()
+_EMBEDDING_DIMENSIONS = 64
+
+
+class FakeLlmBackend(llm_backend.LlmBackend):
+    """OpenAI backend that answers after a fixed latency without any request.
+
+    Answers echo the start of the last prompt message, so they are
+    deterministic and summaries stay short however long the prompt gets.
+    """
+
+    def __init__(self, latency: float, echo_words: int = 32) -> None:
+        super().__init__("openai")
+        self._latency = latency
+        self._echo_words = echo_words
+
+    def load_openai(self) -> Any:
+        return None
+
+    def load_classifier(self) -> Any:
+        return lambda texts, **kwargs: [
+            [{"label": "neutral", "score": 1.0}] for _ in texts
+        ]
+
+    def inference_openai(self, prompt: list[Any]) -> str:
+        time.sleep(self._latency)
+        return self._echo(prompt)
+
+    def stream_openai(self, prompt: list[Any]) -> Iterator[str]:
+        time.sleep(self._latency)
+        for word in self._echo(prompt).split(" "):
+            yield word + " "
+
+    def _echo(self, prompt: list[Any]) -> str:
+        words = prompt[-1]["content"].split() if prompt else []
+        return "Echo: " + " ".join(words[: self._echo_words])
+
+
+def embed_by_word_hashes(texts: list[str]) -> list[list[float]]:
+    # Deterministic stand-in for the embedding model, which needs a download
+    vectors = []
+    for text in texts:
+        vector = [0.0] * _EMBEDDING_DIMENSIONS
+        for word in text.lower().split():
+            digest = hashlib.sha256(word.encode()).digest()
+            vector[digest[0] % _EMBEDDING_DIMENSIONS] += 1.0
+        norm = sum(value * value for value in vector) ** 0.5 or 1.0
+        vectors.append([value / norm for value in vector])
+    return vectors
+
+
+def create_user_messages(turns: int, seed: int) -> list[str]:
+    random_generator = random.Random(seed)
+    return [
+        " ".join(random_generator.choices(_WORDS, k=random_generator.randint(5, 30)))
+        for _ in range(turns)
+    ]
+
+
+def run_benchmark(
+    turns: int,
+    window: int,
+    latency: float,
+    seed: int,
+    character_name: str,
+    history_directory: str,
+    use_embedding_model: bool,
+) -> list[dict[str, Any]]:
+    character_agent = agent.Agent(
+        character_name=character_name,
+        llm=FakeLlmBackend(latency=latency),
+        embedding_function=(
+            None
+            if use_embedding_model
+            else embeddings.CachedEmbeddingFunction(embed_texts=embed_by_word_hashes)
+        ),
+        history_directory=history_directory,
+    )
+    character_agent.warm_up()
+    greeting = "".join(character_agent.stream_system_message())
+    character_agent.save_answer_on_disk_handler(
+        user_message="", character_answer=greeting
+    )
+
+    windows = []
+    stage_seconds: dict[str, list[float]] = defaultdict(list)
+    written_bytes_before = _read_written_bytes()
+    for turn_number, user_message in enumerate(
+        create_user_messages(turns, seed), start=1
+    ):
+        with tracing.turn() as turn_id:
+            start = time.perf_counter()
+            answer = "".join(
+                character_agent.character_agent_response_stream(
+                    user_message=user_message
+                )
+            )
+            character_agent.finish_user_turn(
+                user_message=user_message, character_answer=answer
+            )
+            # The fake latency is not overhead of the agent
+            stage_seconds["turn.total_overhead"].append(
+                time.perf_counter() - start - latency
+            )
+        for span in tracing.tracer.get_spans(turn=turn_id):
+            stage_seconds[span["name"]].append(span["duration"])
+        tracing.tracer.clear()
+
+        if turn_number % window == 0 or turn_number == turns:
+            character_agent.vector_store_memory.flush()
+            character_agent.wait_for_summary_job()
+            written_bytes = _read_written_bytes()
+            windows.append(
+                {
+                    "turns": turn_number,
+                    "messages": character_agent.transcript_memory.message_count(),
+                    "stages_ms": {
+                        name: {
+                            "p50": _percentile(seconds, 50) * 1000,
+                            "p95": _percentile(seconds, 95) * 1000,
+                        }
+                        for name, seconds in sorted(stage_seconds.items())
+                    },
+                    "disk_bytes": _directory_size(history_directory),
+                    "written_bytes": (
+                        None
+                        if written_bytes is None or written_bytes_before is None
+                        else written_bytes - written_bytes_before
+                    ),
+                    "rss_bytes": _read_rss_bytes(),
+                }
+            )
+            stage_seconds.clear()
+            written_bytes_before = written_bytes
+
+    return windows
+
+
+def find_regressions(
+    windows: list[dict[str, Any]], max_growth: float, min_regression_ms: float
+) -> list[str]:
+    first_stages, last_stages = windows[0]["stages_ms"], windows[-1]["stages_ms"]
+    regressions = []
+    for name, last_timings in last_stages.items():
+        if name not in first_stages:
+            continue
+        first_p50, last_p50 = first_stages[name]["p50"], last_timings["p50"]
+        if last_p50 > first_p50 * max_growth and (
+            last_p50 - first_p50 > min_regression_ms
+        ):
+            regressions.append(f"{name}: p50 {first_p50:.2f} ms -> {last_p50:.2f} ms")
+    return regressions
+
+
+def print_report(windows: list[dict[str, Any]]) -> None:
+    for window in windows:
+        written = (
+            "n/a"
+            if window["written_bytes"] is None
+            else f"{window['written_bytes'] / 2**20:7.2f} MiB"
+        )
+        print(
+            f"turns {window['turns']:>5}  messages {window['messages']:>6}  "
+            f"disk {window['disk_bytes'] / 2**20:7.2f} MiB  written {written}  "
+            f"rss {window['rss_bytes'] / 2**20:7.1f} MiB"
+        )
+        for name, timings in window["stages_ms"].items():
+            print(
+                f"    {name:<32} p50 {timings['p50']:8.2f} ms  "
+                f"p95 {timings['p95']:8.2f} ms"
+            )
+
+
+def _percentile(values: list[float], percentile: float) -> float:
+    sorted_values = sorted(values)
+    index = round(percentile / 100 * (len(sorted_values) - 1))
+    return sorted_values[index]
+
+
+def _directory_size(directory: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(root, file_name))
+        for root, _, file_names in os.walk(directory)
+        for file_name in file_names
+    )
+
+
+def _read_written_bytes() -> int | None:
+    # Bytes passed to write calls, only Linux exposes them
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _read_rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # Peak instead of current size, in bytes on macOS
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--turns", type=int, default=400, help="user turns to replay")
+    parser.add_argument(
+        "--window", type=int, default=100, help="turns per reported window"
+    )
+    parser.add_argument(
+        "--latency-ms", type=float, default=0.0, help="latency of the fake LLM"
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the script")
+    parser.add_argument(
+        "--character",
+        default=next(iter(character_sessions.get_character_list())),
+        help="character whose session is replayed",
+    )
+    parser.add_argument(
+        "--embedding-model",
+        action="store_true",
+        help="embed with the configured EMBEDDING_* model instead of word hashes",
+    )
+    parser.add_argument(
+        "--max-growth",
+        type=float,
+        default=3.0,
+        help="fail if a stage's p50 in the last window exceeds the first by this factor",
+    )
+    parser.add_argument(
+        "--min-regression-ms",
+        type=float,
+        default=1.0,
+        help="ignore slowdowns smaller than this, they are noise",
+    )
+    parser.add_argument("--json", help="also write the windows to this JSON file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as history_directory:
+        windows = run_benchmark(
+            turns=args.turns,
+            window=args.window,
+            latency=args.latency_ms / 1000,
+            seed=args.seed,
+            character_name=args.character,
+            history_directory=history_directory,
+            use_embedding_model=args.embedding_model,
+        )
+    print_report(windows)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(windows, f, indent=4)
+
+    regressions = find_regressions(
+        windows, max_growth=args.max_growth, min_regression_ms=args.min_regression_ms
+    )
+    if regressions:
+        print("stages slowing down with the history length:")
+        for regression in regressions:
+            print(f"    {regression}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""Cold start benchmark for the GUI modules and the agent.
+
+Runs in a fresh interpreter, times importing the app and constructing an
+``Agent`` and fails if that exceeds the budget or pulls in a heavy model
+library. Run from the repository root:
+
+    uv run python -m benchmarks.startup_benchmark --budget 1.0
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+
+_HEAVY_MODULES = ["chromadb", "llama_cpp", "openai", "torch", "transformers"]
+
+_MEASURE_STARTUP = """
+import json
+import sys
+import tempfile
+import time
+
+start = time.perf_counter()
+from src.llm_agent_gui import agent, app
+import_seconds = time.perf_counter() - start
+
+from src.llm_agent_gui.utils import character_sessions
+
+character_name = next(iter(character_sessions.get_character_list()))
+# Keeps the session files the agent creates out of the working tree
+with tempfile.TemporaryDirectory() as history_directory:
+    start = time.perf_counter()
+    agent.Agent(character_name=character_name, history_directory=history_directory)
+    agent_seconds = time.perf_counter() - start
+
+print(json.dumps({
+    "import_seconds": import_seconds,
+    "agent_seconds": agent_seconds,
+    "loaded_heavy_modules": [m for m in %r if m in sys.modules],
+}))
+"""
+
+
+def measure_startup() -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", _MEASURE_STARTUP % _HEAVY_MODULES],
+        capture_output=True,
+        check=True,
+        text=True,
+    ).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=1.0,
+        help="maximum seconds for importing the app and constructing the agent",
+    )
+    args = parser.parse_args()
+
+    result = measure_startup()
+    total_seconds = result["import_seconds"] + result["agent_seconds"]
+    print(f"import app modules: {result['import_seconds'] * 1000:8.1f} ms")
+    print(f"construct agent:    {result['agent_seconds'] * 1000:8.1f} ms")
+    print(
+        f"total:              {total_seconds * 1000:8.1f} ms (budget {args.budget:.2f} s)"
+    )
+
+    if result["loaded_heavy_modules"]:
+        print(f"heavy modules imported at startup: {result['loaded_heavy_modules']}")
+        return 1
+    if total_seconds > args.budget:
+        print("startup budget exceeded")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,36 +1,202 @@
+import contextvars
 import os
 import re
+import threading
+from collections.abc import Callable, Iterator
+from concurrent import futures
 from typing import Any
 
-from src.llm_agent_gui import llm_backend, memory
+from src.llm_agent_gui import (
+    embeddings,
+    llm_backend,
+    memory,
+    prompt_builder,
+    response_cache,
+    retrieval,
+    tracing,
+)
 from src.llm_agent_gui.utils import character_sessions, format_messages, prompts
 
+# Summary, buffer lines and related information of a turn's prompt
+PromptContext = tuple[str, list[dict[str, str]], list[str] | None]
+
+# Summaries per level before the oldest ones are rolled up into the next level
+_SUMMARY_ROLLUP_FANOUT = 4
+
 
 class Agent:
-    def __init__(self, character_name: str) -> None:
+    def __init__(
+        self,
+        character_name: str,
+        llm: llm_backend.LlmBackend | None = None,
+        embedding_function: embeddings.EmbedTexts | None = None,
+        history_directory: str | None = None,
+        reranker: retrieval.CrossEncoderReranker | None = None,
+    ) -> None:
         self.character = Character(character_name=character_name)
         self.name_of_user = "Halil"  # Add any name you want to be called as
         self.set_initial_system_message()
 
+        self._history_directory = history_directory
+        # Sessions are stored under src/llm_agent_gui/history_logs by default
+        history_paths: dict[str, str | None] = dict.fromkeys(
+            ["transcript", "vector_store", "summary_buffer"]
+        )
+        if history_directory is not None:
+            history_paths = {
+                "transcript": os.path.join(history_directory, "transcript.sqlite3"),
+                "vector_store": os.path.join(history_directory, "vector_store"),
+                "summary_buffer": os.path.join(history_directory, "summary_buffer"),
+            }
+
+        self.transcript_memory = memory.TranscriptMemory(
+            character_name=self.character.name,
+            transcript_path=history_paths["transcript"],
+        )
+        self.vector_store_memory = memory.VectorStoreMemory(
+            num_query_results=2,
+            character_name=self.character.name,
+            vector_store_path=history_paths["vector_store"],
+            embedding_function=(
+                embedding_function or embeddings.create_embedding_function()
+            ),
+            reranker=reranker or self.create_reranker(),
+            retrieval_latency_budget=float(
+                os.getenv("RETRIEVAL_LATENCY_BUDGET_MS", "50")
+            )
+            / 1000,
+            recency_half_life=float(
+                os.getenv("RETRIEVAL_RECENCY_HALF_LIFE_MESSAGES", "0")
+            ),
+        )
+        # Backend can be configured via LLM_BACKEND env var: "openai" or "llama-cpp"
+        backend = os.getenv("LLM_BACKEND", "openai")
+        # Models load on first use or in start_warm_up unless disabled here
+        lazy_loading = os.getenv("LLM_LAZY_LOADING", "true").lower() != "false"
+        self.llm = llm or llm_backend.LlmBackend(
+            backend,
+            lazy_loading=lazy_loading,
+            # "pytorch", "quantized" (int8 on CPU) or "onnx" (needs optimum)
+            classifier_runtime=os.getenv("EMOTION_CLASSIFIER_RUNTIME", "pytorch"),
+            response_cache=self.create_response_cache(
+                cache_path=os.path.join(
+                    history_directory or "src/llm_agent_gui/history_logs",
+                    "response_cache.sqlite3",
+                )
+            ),
+            llama_cpp_prompt_cache_bytes=int(
+                os.getenv("LLAMA_CPP_PROMPT_CACHE_BYTES", str(2 << 30))
+            ),
+            openai_model=os.getenv("OPENAI_MODEL", "gpt-3.5-turbo"),
+            openai_context_window=int(os.getenv("OPENAI_CONTEXT_WINDOW", "16385")),
+            request_timeout=float(os.getenv("LLM_REQUEST_TIMEOUT_SECONDS", "60")),
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", "3")),
+            max_concurrent_requests=int(os.getenv("LLM_MAX_CONCURRENT_REQUESTS", "4")),
+        )
+
+        # The buffer is summarized once its lines exceed the token budget, a
+        # budget of 0 falls back to summarizing every 10 messages
+        buffer_token_budget = int(os.getenv("SUMMARY_BUFFER_TOKEN_BUDGET", "1024"))
         self.summary_buffer_memory = memory.SummaryBufferMemory(
             buffer_size=10,
             character_name=self.character.name,
+            max_buffer_overrun=10,
+            count_tokens=self.llm.count_tokens,
+            buffer_token_budget=buffer_token_budget or None,
+            max_buffer_token_overrun=buffer_token_budget,
+            summary_buffer_directory=history_paths["summary_buffer"],
         )
+        self._summary_executor = futures.ThreadPoolExecutor(max_workers=1)
+        self._summary_job: futures.Future[None] | None = None
+        # Prompt context loaded for the draft the user is still typing, see
+        # prepare_prompt_speculatively
+        self._speculation_executor = futures.ThreadPoolExecutor(max_workers=1)
+        self._speculation: tuple[str, str, futures.Future[PromptContext]] | None = None
+        self._speculation_lock = threading.Lock()
+        # Independent stages of a turn run concurrently, see run_stages
+        self._stage_executor = futures.ThreadPoolExecutor(max_workers=3)
+        self.last_turn_stage_timings: dict[str, float] = {}
         self.update_is_new_chat_variable()
 
-        self.vector_store_memory = memory.VectorStoreMemory(
-            num_query_results=2, character_name=self.character.name
+        # Prompts are fit into the context window of the backend minus the tokens
+        # reserved for the answer, see create_prompt
+        self.prompt_builder = prompt_builder.PromptBuilder(
+            count_tokens=self.llm.count_tokens,
+            context_window=self.llm.context_window,
+            response_token_reserve=int(os.getenv("LLM_RESPONSE_TOKEN_RESERVE", "512")),
         )
-        # Backend can be configured via LLM_BACKEND env var: "openai" or "llama-cpp"
-        backend = os.getenv("LLM_BACKEND", "openai")
-        self.llm = llm_backend.LlmBackend(backend)
+        self.last_prompt_token_breakdown: dict[str, int] = {}
 
         self.game_mode = False
 
+    def create_character_session(self, character_name: str) -> "Agent":
+        """Agent of another character sharing this agent's models."""
+        return Agent(
+            character_name=character_name,
+            llm=self.llm,
+            embedding_function=self.vector_store_memory.embedding_function,
+            history_directory=self._history_directory,
+            reranker=self.vector_store_memory.reranker,
+        )
+
+    def cached_document_count(self) -> int:
+        return (
+            self.vector_store_memory.cached_document_count()
+            + self.summary_buffer_memory.cached_line_count()
+        )
+
+    def close(self) -> None:
+        self.wait_for_summary_job()
+        with self._speculation_lock:
+            self._speculation = None
+        for executor in [
+            self._speculation_executor,
+            self._stage_executor,
+            self._summary_executor,
+        ]:
+            executor.shutdown(cancel_futures=True)
+        self.vector_store_memory.close()
+        self.transcript_memory.close()
+
+    def create_response_cache(
+        self, cache_path: str
+    ) -> response_cache.ResponseCache | None:
+        if os.getenv("LLM_RESPONSE_CACHE", "false").lower() != "true":
+            return None
+
+        ttl_seconds = os.getenv("LLM_RESPONSE_CACHE_TTL_SECONDS")
+        return response_cache.ResponseCache(
+            cache_path=cache_path,
+            ttl_seconds=float(ttl_seconds) if ttl_seconds else None,
+            max_entries=int(os.getenv("LLM_RESPONSE_CACHE_MAX_ENTRIES", "1000")),
+        )
+
+    def create_reranker(self) -> retrieval.CrossEncoderReranker | None:
+        reranker_model = os.getenv("RETRIEVAL_RERANKER_MODEL")
+        if not reranker_model:
+            return None
+        return retrieval.CrossEncoderReranker(model_name=reranker_model)
+
+    def warm_up(self) -> None:
+        self.vector_store_memory.open_collection()
+        self.vector_store_memory.load_lexical_index()
+        self.vector_store_memory.embedding_function.warm_up()
+        if self.vector_store_memory.reranker is not None:
+            self.vector_store_memory.reranker.warm_up()
+        self.llm.warm_up()
+
+    def start_warm_up(self) -> threading.Thread:
+        warm_up_thread = threading.Thread(target=self.warm_up, daemon=True)
+        warm_up_thread.start()
+        return warm_up_thread
+
     def set_initial_system_message(self) -> None:
         self.initial_system_message = prompts.prepare_initial_system_prompt(
             character=self.character, user_name=self.name_of_user
         )
+        self.system_chat_prompt = prompts.prepare_system_chat_prompt(
+            character=self.character, system_message=self.initial_system_message
+        )
 
     def update_is_new_chat_variable(self) -> None:
         self.is_new_chat = self.summary_buffer_memory.has_empty_buffer_history()
@@ -44,6 +210,21 @@ class Agent:
 
         return character_response
 
+    def stream_system_message(self) -> Iterator[str]:
+        initial_prompt = format_messages.assign_role_to_message(
+            role="system",
+            message=self.initial_system_message,
+        )
+        yield from self.llm.stream_llm([initial_prompt])
+
+    def last_character_answer(self) -> str | None:
+        character_answers = [
+            message["content"]
+            for message in self.summary_buffer_memory.load_buffer_from_disk()
+            if message["role"] == "assistant"
+        ]
+        return character_answers[-1] if character_answers else None
+
     def clean_agent_response(self, response: str) -> str:
         clean_input_pattern = r"^[\s\S]*?(Thought:)"
         clean_input = re.sub(clean_input_pattern, r"\1", response)
@@ -68,34 +249,163 @@ class Agent:
 
             return character_response
 
+    def character_agent_response_stream(self, user_message: str) -> Iterator[str]:
+        if self.game_mode:
+            return
+        chat_prompt = self.create_prompt(user_message=user_message)
+        yield from self.llm.stream_llm(prompt=chat_prompt)
+
     def create_prompt(self, user_message: str) -> list[dict[str, str]]:
-        current_summary = self.summary_buffer_memory.load_summary_from_disk()
-        last_messages = self.summary_buffer_memory.load_buffer_from_disk()
-        user_message_formatted = format_messages.assign_role_to_message(
-            role="user", message=user_message
+        (current_summary, last_messages, related_information), stage_timings = (
+            self.take_prompt_context(user_message=user_message)
         )
+        self.last_turn_stage_timings = stage_timings
 
         if not current_summary:
-            chat_prompt = last_messages + [user_message_formatted]
-            return chat_prompt
+            (chat_prompt, self.last_prompt_token_breakdown), prompt_build_seconds = (
+                _run_timed(
+                    "prompt_build",
+                    lambda: self.prompt_builder.build(
+                        user_message=user_message, recent_messages=last_messages
+                    ),
+                )
+            )
 
         else:
-            related_information = self.vector_store_memory.retreive_related_information(
-                user_message=user_message
+            (chat_prompt, self.last_prompt_token_breakdown), prompt_build_seconds = (
+                _run_timed(
+                    "prompt_build",
+                    lambda: self.prompt_builder.build(
+                        user_message=user_message,
+                        recent_messages=last_messages,
+                        instructions=self.system_chat_prompt,
+                        summary=current_summary,
+                        related_information=related_information,
+                    ),
+                )
+            )
+        self.last_turn_stage_timings["prompt_build"] = prompt_build_seconds
+        return chat_prompt
+
+    def load_prompt_context(
+        self, user_message: str
+    ) -> tuple[PromptContext, dict[str, float]]:
+        # The query is embedded while the state loads, retrieval then finds
+        # its vector in the embedding cache
+        stage_results, stage_timings = self.run_stages(
+            {
+                "state_load": (
+                    self.summary_buffer_memory.load_summary_and_buffer_from_disk
+                ),
+                "query_embedding": lambda: self.vector_store_memory.embedding_function(
+                    [user_message]
+                ),
+            }
+        )
+        current_summary, last_messages = stage_results["state_load"]
+
+        related_information = None
+        if current_summary:
+            # Lines in the buffer are part of the prompt anyway
+            related_information, stage_timings["retrieval"] = _run_timed(
+                "retrieval",
+                lambda: self.vector_store_memory.retreive_related_information(
+                    user_message=user_message, exclude_recent=len(last_messages)
+                ),
             )
-            system_prompt = prompts.prepare_system_chat_prompt(
-                character=self.character,
-                system_message=self.initial_system_message,
-                current_summary=current_summary,
-                context_sentences=related_information,
+        return (current_summary, last_messages, related_information), stage_timings
+
+    def prepare_prompt_speculatively(self, draft_message: str) -> None:
+        """Start loading the prompt context for a message still being typed."""
+        with self._speculation_lock:
+            if self._speculation is not None:
+                self._speculation[2].cancel()  # unless it already started
+            self._speculation = (
+                self.character.name,
+                draft_message,
+                self._speculation_executor.submit(
+                    self.load_prompt_context, draft_message
+                ),
             )
-            system_prompt_formatted = format_messages.assign_role_to_message(
-                role="system", message=system_prompt
+
+    def take_prompt_context(
+        self, user_message: str
+    ) -> tuple[PromptContext, dict[str, float]]:
+        with self._speculation_lock:
+            speculation, self._speculation = self._speculation, None
+
+        if speculation is not None:
+            character_name, draft_message, prompt_context_job = speculation
+            if (
+                character_name == self.character.name
+                and draft_message == user_message
+                and not prompt_context_job.cancelled()
+            ):
+                _, speculation_wait_seconds = _run_timed(
+                    "speculation_wait", prompt_context_job.exception
+                )
+                if prompt_context_job.exception() is None:
+                    prompt_context, _ = prompt_context_job.result()
+                    speculative_summary, speculative_messages, related_information = (
+                        prompt_context
+                    )
+                    # Cached in memory by now, only the retrieval is worth reusing
+                    current_summary, last_messages = (
+                        self.summary_buffer_memory.load_summary_and_buffer_from_disk()
+                    )
+                    # Unless lines were saved or summarized since it ran
+                    if current_summary == speculative_summary and len(
+                        last_messages
+                    ) == len(speculative_messages):
+                        return (current_summary, last_messages, related_information), {
+                            "speculation_wait": speculation_wait_seconds
+                        }
+            else:
+                prompt_context_job.cancel()
+
+        return self.load_prompt_context(user_message=user_message)
+
+    def run_stages(
+        self, stages: dict[str, Callable[[], Any]]
+    ) -> tuple[dict[str, Any], dict[str, float]]:
+        """Run independent stages of a turn concurrently and time each of them."""
+        # Each stage gets a copy of the context, so its spans join the turn
+        stage_jobs = {
+            name: self._stage_executor.submit(
+                contextvars.copy_context().run, _run_timed, name, stage
             )
-            chat_prompt = (
-                [system_prompt_formatted] + last_messages + [user_message_formatted]
+            for name, stage in stages.items()
+        }
+        # All stages finish before any error surfaces, none is left half done
+        futures.wait(stage_jobs.values())
+
+        stage_results = {}
+        stage_timings = {}
+        for name, stage_job in stage_jobs.items():
+            stage_results[name], stage_timings[name] = stage_job.result()
+        return stage_results, stage_timings
+
+    def finish_user_turn(self, user_message: str, character_answer: str) -> str:
+        """Save the turn while the answer's sentiment is classified."""
+        if self.is_new_chat:
+            self.save_answer_on_disk_handler(
+                user_message=user_message, character_answer=character_answer
             )
-            return chat_prompt
+            return self.llm.classify_sentiment(character_response=character_answer)
+
+        new_lines = format_messages.assign_multiple_roles_to_messages(
+            roles=["user", "assistant"], messages=[user_message, character_answer]
+        )
+        stage_results, stage_timings = self.run_stages(
+            {
+                "sentiment": lambda: self.llm.classify_sentiment(
+                    character_response=character_answer
+                ),
+                **self.create_save_stages(new_lines=new_lines),
+            }
+        )
+        self.last_turn_stage_timings.update(stage_timings)
+        return stage_results["sentiment"]
 
     def save_answer_on_disk_handler(
         self, user_message: str, character_answer: str
@@ -104,8 +414,14 @@ class Agent:
             character_greeting_formatted = format_messages.assign_role_to_message(
                 role="assistant", message=character_answer
             )
+            sequence_numbers = self.transcript_memory.save_new_lines(
+                new_lines=[character_greeting_formatted],
+                character_name=self.character.name,
+                user_name=self.name_of_user,
+            )
             self.save_initial_character_answer_on_disk(
                 character_greeting=character_greeting_formatted,
+                sequence_numbers=sequence_numbers,
             )
 
         else:
@@ -113,52 +429,164 @@ class Agent:
                 roles=["user", "assistant"],
                 messages=[user_message, character_answer],
             )
-            self.save_subsequent_character_answer_on_disk(new_lines=new_lines_to_save)
+            _, stage_timings = self.run_stages(
+                self.create_save_stages(new_lines=new_lines_to_save)
+            )
+            self.last_turn_stage_timings.update(stage_timings)
+
+    def create_save_stages(
+        self, new_lines: list[dict[str, str]]
+    ) -> dict[str, Callable[[], Any]]:
+        # The vector store needs the transcript's sequence numbers, the summary
+        # buffer is independent of both
+        def save_to_transcript_and_vector_store() -> None:
+            sequence_numbers = self.transcript_memory.save_new_lines(
+                new_lines=new_lines,
+                character_name=self.character.name,
+                user_name=self.name_of_user,
+            )
+            self.vector_store_memory.save_new_lines_as_vectors(
+                new_lines=new_lines,
+                character_name=self.character.name,
+                user_name=self.name_of_user,
+                sequence_numbers=sequence_numbers,
+            )
+
+        return {
+            "transcript_and_vector_write": save_to_transcript_and_vector_store,
+            "buffer_write": lambda: self.save_subsequent_character_answer_on_disk(
+                new_lines=new_lines
+            ),
+        }
 
     def save_initial_character_answer_on_disk(
         self,
         character_greeting: dict[str, str],
+        sequence_numbers: list[int] | None = None,
     ) -> None:
         self.summary_buffer_memory.save_initial_buffer_on_disk(
-            character_greeting=character_greeting
+            character_greeting=[character_greeting]
         )
         self.summary_buffer_memory.update_buffer_counter()
         self.vector_store_memory.save_initial_lines_as_vectors(
-            character_greeting=character_greeting, character_name=self.character.name
+            character_greeting=character_greeting,
+            character_name=self.character.name,
+            sequence_numbers=sequence_numbers,
         )
         self.is_new_chat = False
 
     def save_subsequent_character_answer_on_disk(
         self, new_lines: list[dict[str, str]]
     ) -> None:
-        self.vector_store_memory.save_new_lines_as_vectors(
-            new_lines=new_lines,
+        if self.summary_buffer_memory.summary_pending and not self.summary_in_progress:
+            self.start_summary_job()
+
+        self.summary_buffer_memory.expand_buffer_on_disk(new_lines=new_lines)
+        self.summary_buffer_memory.update_buffer_counter()
+
+        if self.summary_buffer_memory.exceeds_buffer_overrun():
+            self.wait_for_summary_job()
+
+    def get_chat_history_page(
+        self, before: int | None = None, limit: int = 50
+    ) -> tuple[str, int | None]:
+        if self.transcript_memory.is_empty() and not self.is_new_chat:
+            self.backfill_transcript_from_vector_store()
+        return self.transcript_memory.get_chat_history_page(before=before, limit=limit)
+
+    def backfill_transcript_from_vector_store(self) -> None:
+        # Sessions recorded before the transcript store only exist as vectors
+        sequence_numbers, documents = self.vector_store_memory.get_stored_documents()
+        self.transcript_memory.import_documents(
+            sequence_numbers=sequence_numbers,
+            documents=documents,
             character_name=self.character.name,
-            user_name=self.name_of_user,
         )
 
-        if not self.summary_buffer_memory.summary_pending:
-            self.summary_buffer_memory.expand_buffer_on_disk(new_lines=new_lines)
-            self.summary_buffer_memory.update_buffer_counter()
+    def rebuild_vector_store(self) -> None:
+        self.vector_store_memory.rebuild_from_transcript(
+            self.transcript_memory, character_name=self.character.name
+        )
 
-        else:
-            new_summary = self.generate_new_summary()
-            self.summary_buffer_memory.save_new_summary_on_disk(new_summary=new_summary)
-            self.summary_buffer_memory.reset_buffer_on_disk()
-            self.summary_buffer_memory.expand_buffer_on_disk(new_lines=new_lines)
-            self.summary_buffer_memory.update_buffer_counter()
-
-    def generate_new_summary(self) -> str:
-        current_summary = self.summary_buffer_memory.load_summary_from_disk()
+    @property
+    def summary_in_progress(self) -> bool:
+        return self._summary_job is not None and not self._summary_job.done()
+
+    def start_summary_job(self) -> None:
+        self.wait_for_summary_job()  # surfaces errors of a finished job
         last_messages = self.summary_buffer_memory.load_buffer_from_disk()
-        summarizer_prompt = prompts.prepare_summarizer_prompt(
-            current_summary=current_summary,
+        # The newest lines stay verbatim in the buffer
+        last_messages = last_messages[
+            : self.summary_buffer_memory.count_lines_to_summarize(last_messages)
+        ]
+        self._summary_job = self._summary_executor.submit(
+            self.summarize_buffer_lines, last_messages
+        )
+
+    def wait_for_summary_job(self) -> None:
+        if self._summary_job is not None:
+            summary_job, self._summary_job = self._summary_job, None
+            summary_job.result()
+
+    def summarize_buffer_lines(self, last_messages: list[dict[str, str]]) -> None:
+        # Only the new lines and a bounded number of summaries go into each
+        # summarizer prompt, so its size does not grow with the conversation
+        summary_levels = self.summary_buffer_memory.load_summary_levels()
+        if not summary_levels:
+            summary_levels.append([])
+        previous_summary = summary_levels[0][-1]["summary"] if summary_levels[0] else ""
+        summary_levels[0].append(
+            memory.create_summary_entry(
+                self.generate_chunk_summary(previous_summary, last_messages),
+                line_count=len(last_messages),
+            )
+        )
+
+        level = 0
+        while level < len(summary_levels):
+            if len(summary_levels[level]) > _SUMMARY_ROLLUP_FANOUT:
+                rolled_up_entries = summary_levels[level][:_SUMMARY_ROLLUP_FANOUT]
+                del summary_levels[level][:_SUMMARY_ROLLUP_FANOUT]
+                if level + 1 == len(summary_levels):
+                    summary_levels.append([])
+                summary_levels[level + 1].append(
+                    memory.create_summary_entry(
+                        self.generate_summary_rollup(
+                            [entry["summary"] for entry in rolled_up_entries]
+                        ),
+                        line_count=sum(
+                            entry["line_count"] for entry in rolled_up_entries
+                        ),
+                    )
+                )
+            level += 1
+
+        # Lines saved meanwhile stay in the buffer, only the summarized ones go
+        self.summary_buffer_memory.replace_summarized_lines_on_disk(
+            # Whole summaries that fit into the prompt's summary share
+            new_summary=memory.compose_summary(
+                summary_levels,
+                count_tokens=self.llm.count_tokens,
+                token_budget=self.prompt_builder.summary_token_budget,
+            ),
+            summarized_line_count=len(last_messages),
+            summary_levels=summary_levels,
+        )
+
+    def generate_chunk_summary(
+        self, previous_summary: str, last_messages: list[dict[str, str]]
+    ) -> str:
+        summarizer_prompt = prompts.prepare_chunk_summarizer_prompt(
+            previous_summary=previous_summary,
             new_messages=last_messages,
             character_name=self.character.name,
             user_name=self.name_of_user,
         )
-        new_summary = self.llm.inference_llm(prompt=summarizer_prompt)
-        return new_summary
+        return self.llm.inference_llm(prompt=summarizer_prompt)
+
+    def generate_summary_rollup(self, summaries: list[str]) -> str:
+        rollup_prompt = prompts.prepare_summary_rollup_prompt(summaries=summaries)
+        return self.llm.inference_llm(prompt=rollup_prompt)
 
 
 class Character:
@@ -173,3 +601,9 @@ class Character:
         self.name = character_name
         self.platform_type = self.character_info[self.name]["platform_type"]
         self.platform_name = self.character_info[self.name]["platform_name"]
+
+
+def _run_timed(name: str, stage: Callable[[], Any]) -> tuple[Any, float]:
+    with tracing.span("turn." + name) as span:
+        result = stage()
+    return result, span["duration"]
@@ -1,14 +1,24 @@
+import os
+import threading
 import tkinter
+from collections.abc import Callable, Iterator
+from typing import Any
 
 import customtkinter
 from PIL import Image
 
-from src.llm_agent_gui import agent, games
+from src.llm_agent_gui import agent, games, session_pool, tracing, turn_pipeline
 from src.llm_agent_gui.utils import character_sessions
 
 customtkinter.set_appearance_mode("system")
 customtkinter.set_default_color_theme("blue")
 
+_TURN_EVENT_POLL_INTERVAL_MS = 50
+_AGENT_ANSWER_MARK = "agent_answer"
+_CHAT_HISTORY_PAGE_SIZE = 50
+# Pause in typing after which the draft message's prompt context is prepared
+_SPECULATIVE_PROMPT_DEBOUNCE_MS = 250
+
 
 class ChooseCharacterSessionWindow(customtkinter.CTkToplevel):
     def __init__(self, cancellable: bool = False) -> None:
@@ -107,13 +117,35 @@ class App(customtkinter.CTk):
         self.character_agent = agent.Agent(
             character_name=selected_character,
         )
+        # Characters switched away from stay loaded, new ones share the models
+        max_cached_documents = int(os.getenv("SESSION_POOL_MAX_CACHED_LINES", "0"))
+        self.session_pool = session_pool.SessionPool(
+            create_session=self.create_character_agent,
+            max_sessions=int(os.getenv("SESSION_POOL_SIZE", "3")),
+            max_cached_documents=max_cached_documents or None,
+            close_evicted_session=self.close_evicted_character_agent,
+        )
+        self.session_pool.put(selected_character, self.character_agent)
+        self._evicted_character_agents: dict[str, agent.Agent] = {}
+        self._evicted_character_agents_lock = threading.Lock()
+        self.turn_pipeline = turn_pipeline.TurnPipeline()
 
         self.create_widgets()
+        self.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.poll_turn_events()
+        self.after_idle(self.character_agent.start_warm_up)
 
     def create_widgets(self) -> None:
         self.chat_history = customtkinter.CTkTextbox(self)
         self.chat_history.configure(state="disabled")
         self.chat_history.grid(row=0, padx=(20, 0), pady=(20, 0), sticky="nsew")
+        self.older_chat_history_cursor: int | None = None
+        for scroll_event in ["<MouseWheel>", "<Button-4>"]:
+            self.chat_history.bind(
+                scroll_event,
+                lambda event: self.after_idle(self.load_older_chat_history),
+                add="+",
+            )
 
         self.typing_game_choice_frame = TypingSummarizingGameChoiceFrame(
             master=self, fg_color="transparent"
@@ -132,6 +164,22 @@ class App(customtkinter.CTk):
         )
         self.user_input_entry.grid(row=2, column=0, padx=(20, 0), sticky="ew")
         self.user_input_entry.bind("<Return>", self.user_input_prompt_handler)
+        self.user_input_entry.bind(
+            "<KeyRelease>", self.schedule_speculative_prompt_preparation, add="+"
+        )
+        self._speculative_prompt_preparation: str | None = None
+
+        # Stage timings of the latest turn, shown over the chat history
+        self.rendering_turn: int | None = None
+        self.rendering_agent: agent.Agent | None = None
+        self.debug_overlay: customtkinter.CTkLabel | None = None
+        if os.getenv("TRACING_DEBUG_OVERLAY", "false").lower() == "true":
+            self.debug_overlay = customtkinter.CTkLabel(
+                self, text="", font=("Courier", 11), justify="left", anchor="nw"
+            )
+            self.debug_overlay.place(
+                in_=self.chat_history, relx=1.0, x=-20, y=10, anchor="ne"
+            )
 
         self.character_image_game_frame = CharacterImageGameFrame(
             master=self, fg_color="transparent"
@@ -149,22 +197,65 @@ class App(customtkinter.CTk):
         else:
             self.restore_chat_history()
 
+    def create_character_agent(self, character_name: str) -> agent.Agent:
+        # An evicted agent not closed yet is taken back instead, it is still loaded
+        with self._evicted_character_agents_lock:
+            evicted_agent = self._evicted_character_agents.pop(character_name, None)
+        if evicted_agent is not None:
+            return evicted_agent
+        return self.character_agent.create_character_session(character_name)
+
+    def close_evicted_character_agent(self, evicted_agent: agent.Agent) -> None:
+        character_name = evicted_agent.character.name
+        with self._evicted_character_agents_lock:
+            self._evicted_character_agents[character_name] = evicted_agent
+
+        # Queued after the turns still pending for the evicted character
+        def close_agent(emit_event: turn_pipeline.EmitEvent) -> None:
+            # Saved before it is given up, a new agent of the character then
+            # finds its last turns on disk without waiting for the close
+            evicted_agent.wait_for_summary_job()
+            evicted_agent.vector_store_memory.flush()
+            with self._evicted_character_agents_lock:
+                still_evicted_agent = self._evicted_character_agents.get(character_name)
+                if still_evicted_agent is not evicted_agent:
+                    return  # taken back by create_character_agent
+                del self._evicted_character_agents[character_name]
+            evicted_agent.close()
+
+        self.turn_pipeline.submit(close_agent)
+
     def initialize_character_greeting(self) -> None:
-        self.chat_history.configure(state="normal")
-        self.typing_game_choice_frame.is_typing_label.configure(text_color="black")
-        self.update()
-        character_response = self.character_agent.inference_system_message()
-        self.chat_history.insert(
-            customtkinter.END,
-            self.character_agent.character.name + ": " + character_response + "\n\n",
-        )
-        self.typing_game_choice_frame.is_typing_label.configure(
-            text_color=self.cget("bg")
-        )
-        self.update()
-        self.chat_history.configure(state="disabled")
+        self.submit_turn(self.run_greeting_turn)
 
-        self.update_character_agent_memory(prompt="", agent_answer=character_response)
+    def submit_turn(
+        self, job: Callable[[turn_pipeline.EmitEvent, agent.Agent], None]
+    ) -> None:
+        # Jobs keep the agent they were submitted for, after a character switch
+        # they finish in the background and their events are not rendered
+        character_agent = self.character_agent
+
+        def run_turn(emit_event: turn_pipeline.EmitEvent) -> None:
+            emit_event("turn_agent", character_agent)
+            job(emit_event, character_agent)
+
+        self.turn_pipeline.submit(run_turn)
+
+    def schedule_speculative_prompt_preparation(self, event=None) -> None:
+        # Debounced, the draft is only worth preparing once typing pauses
+        if self._speculative_prompt_preparation is not None:
+            self.after_cancel(self._speculative_prompt_preparation)
+        self._speculative_prompt_preparation = self.after(
+            _SPECULATIVE_PROMPT_DEBOUNCE_MS, self.start_speculative_prompt_preparation
+        )
+
+    def start_speculative_prompt_preparation(self) -> None:
+        self._speculative_prompt_preparation = None
+        draft_message = self.user_input_entry.get()
+        if draft_message.strip() and not self.character_agent.game_mode:
+            self.character_agent.prepare_prompt_speculatively(
+                draft_message=draft_message
+            )
 
     # TODO: entry bind sends pressed key event as argument, proper catching of argument necessary in method
     def user_input_prompt_handler(self, event=None) -> None:
@@ -176,66 +267,243 @@ class App(customtkinter.CTk):
             self.character_agent.name_of_user + ": " + prompt + "\n\n",
         )
         self.chat_history.configure(state="disabled")
-        self.typing_game_choice_frame.is_typing_label.configure(text_color="black")
-        self.update()
 
-        character_response = self.character_agent.character_agent_response_handler(
-            user_message=prompt
-        )
-        current_character_emotion = self.character_agent.llm.classify_sentiment(
-            character_response=character_response
+        self.submit_turn(
+            lambda emit_event, character_agent: self.run_user_turn(
+                emit_event, character_agent, prompt=prompt
+            )
         )
 
-        self.character_image_game_frame.change_character_image(
-            new_character=self.character_agent.character.name,
-            emotion=current_character_emotion,
+    # Turn jobs run on the pipeline's worker thread and must not touch widgets
+    def run_greeting_turn(
+        self, emit_event: turn_pipeline.EmitEvent, character_agent: agent.Agent
+    ) -> None:
+        with tracing.turn() as turn_id:
+            emit_event("typing_started", turn_id)
+            character_response = self.stream_agent_answer(
+                emit_event, character_agent.stream_system_message()
+            )
+            emit_event("agent_answer_finished", None)
+
+            self.save_turn_to_memory(
+                emit_event, character_agent, prompt="", agent_answer=character_response
+            )
+
+    def run_user_turn(
+        self,
+        emit_event: turn_pipeline.EmitEvent,
+        character_agent: agent.Agent,
+        prompt: str,
+    ) -> None:
+        with tracing.turn() as turn_id:
+            emit_event("typing_started", turn_id)
+            character_response = self.stream_agent_answer(
+                emit_event,
+                character_agent.character_agent_response_stream(user_message=prompt),
+            )
+            # Saved while the sentiment is classified
+            current_character_emotion = character_agent.finish_user_turn(
+                user_message=prompt, character_answer=character_response
+            )
+            emit_event("agent_answer_finished", current_character_emotion)
+
+    def stream_agent_answer(
+        self, emit_event: turn_pipeline.EmitEvent, answer_deltas: Iterator[str]
+    ) -> str:
+        emit_event("agent_answer_started", None)
+        answer_parts = []
+        for delta in answer_deltas:
+            answer_parts.append(delta)
+            emit_event("agent_answer_delta", delta)
+
+        return "".join(answer_parts)
+
+    def run_emotion_update(
+        self,
+        emit_event: turn_pipeline.EmitEvent,
+        character_agent: agent.Agent,
+        character_response: str | None,
+    ) -> None:
+        if character_response is None:
+            character_response = character_agent.last_character_answer()
+        if character_response:
+            emit_event(
+                "character_emotion",
+                character_agent.llm.classify_sentiment(
+                    character_response=character_response
+                ),
+            )
+
+    def save_turn_to_memory(
+        self,
+        emit_event: turn_pipeline.EmitEvent,
+        character_agent: agent.Agent,
+        prompt: str,
+        agent_answer: str,
+    ) -> None:
+        character_agent.save_answer_on_disk_handler(
+            user_message=prompt, character_answer=agent_answer
         )
 
-        self.add_agent_answer_to_chat_history(character_response=character_response)
+    def poll_turn_events(self) -> None:
+        # Rescheduled even if rendering fails, or no later event would render
+        try:
+            self.dispatch_turn_events()
+            if self.character_agent.summary_in_progress:
+                self.typing_game_choice_frame.summarizing_label.grid()
+            else:
+                self.typing_game_choice_frame.summarizing_label.grid_remove()
+        finally:
+            self.after(_TURN_EVENT_POLL_INTERVAL_MS, self.poll_turn_events)
+
+    def dispatch_turn_events(self) -> None:
+        turn_events = self.turn_pipeline.get_events()
+        if not turn_events:
+            return
+
+        with tracing.span("ui.render", events=len(turn_events)) as span:
+            self.render_turn_events(turn_events)
+            span["turn"] = self.rendering_turn
+
+    def render_turn_events(self, turn_events: list[tuple[str, Any]]) -> None:
+        for event, payload in turn_events:
+            if event == "turn_agent":
+                self.rendering_agent = payload
+                continue
+            if event != "error" and self.rendering_agent is not self.character_agent:
+                continue  # turn of a character switched away from
+
+            if event == "typing_started":
+                self.rendering_turn = payload
+                self.typing_game_choice_frame.is_typing_label.configure(
+                    text_color="black"
+                )
+            elif event == "agent_answer_started":
+                self.start_agent_answer_in_chat_history()
+            elif event == "agent_answer_delta":
+                self.append_to_agent_answer_in_chat_history(answer_delta=payload)
+            elif event == "agent_answer_finished":
+                if payload:
+                    self.character_image_game_frame.change_character_image(
+                        new_character=self.character_agent.character.name,
+                        emotion=payload,
+                    )
+                self.finish_agent_answer_in_chat_history()
+                self.update_debug_overlay()
+            elif event == "character_emotion":
+                self.character_image_game_frame.change_character_image(
+                    new_character=self.character_agent.character.name,
+                    emotion=payload,
+                )
+            elif event == "error":
+                self.typing_game_choice_frame.is_typing_label.configure(
+                    text_color=self.cget("bg")
+                )
+                self.report_callback_exception(
+                    type(payload), payload, payload.__traceback__
+                )
+
+    def wait_for_pending_turns(self) -> None:
+        self.turn_pipeline.wait_until_idle()
+        self.dispatch_turn_events()
+        self.character_agent.wait_for_summary_job()
+        self.character_agent.vector_store_memory.flush()
+
+    def on_closing(self) -> None:
+        # Lines still queued for the vector store would be lost otherwise
+        self.wait_for_pending_turns()
+        self.session_pool.close()
+        trace_export_path = os.getenv("TRACING_EXPORT_PATH")
+        if trace_export_path:
+            tracing.tracer.export_jsonl(trace_export_path)
+        self.destroy()
+
+    def update_debug_overlay(self) -> None:
+        if self.debug_overlay is None or self.rendering_turn is None:
+            return
+        self.debug_overlay.configure(
+            text=tracing.format_spans(
+                tracing.tracer.get_spans(turn=self.rendering_turn)
+            )
+            + "\nprompt tokens: "
+            + str(self.character_agent.last_prompt_token_breakdown.get("total", 0))
+        )
 
-        self.update_character_agent_memory(
-            prompt=prompt, agent_answer=character_response
+    def update_character_emotion(self, character_response: str | None = None) -> None:
+        self.submit_turn(
+            lambda emit_event, character_agent: self.run_emotion_update(
+                emit_event, character_agent, character_response=character_response
+            )
         )
 
     def add_agent_answer_to_chat_history(self, character_response: str):
+        self.start_agent_answer_in_chat_history()
+        self.append_to_agent_answer_in_chat_history(answer_delta=character_response)
+        self.finish_agent_answer_in_chat_history()
+
+    def start_agent_answer_in_chat_history(self) -> None:
         self.chat_history.configure(state="normal")
         self.chat_history.insert(
-            customtkinter.END,
-            self.character_agent.character.name + ": " + character_response + "\n\n",
+            customtkinter.END, self.character_agent.character.name + ": \n\n"
         )
+        # Deltas go in at this mark, ahead of user messages queued meanwhile
+        self.chat_history.mark_set(_AGENT_ANSWER_MARK, "end-3c")
+        self.chat_history.mark_gravity(_AGENT_ANSWER_MARK, "right")
         self.chat_history.configure(state="disabled")
+
+    def append_to_agent_answer_in_chat_history(self, answer_delta: str) -> None:
+        if _AGENT_ANSWER_MARK not in self.chat_history.mark_names():
+            return  # the answer was cut off by a character switch
+        self.chat_history.configure(state="normal")
+        self.chat_history.insert(_AGENT_ANSWER_MARK, answer_delta)
+        self.chat_history.configure(state="disabled")
+        self.chat_history.see(customtkinter.END)
+
+    def finish_agent_answer_in_chat_history(self) -> None:
+        self.chat_history.mark_unset(_AGENT_ANSWER_MARK)
         self.typing_game_choice_frame.is_typing_label.configure(
             text_color=self.cget("bg")
         )
-        self.update()
 
     def update_character_agent_memory(self, prompt: str, agent_answer: str) -> None:
-        if self.character_agent.summary_buffer_memory.summary_pending:
-            self.typing_game_choice_frame.summarizing_label.grid()
-            self.update()
-            self.character_agent.save_answer_on_disk_handler(
-                user_message=prompt, character_answer=agent_answer
-            )
-            self.typing_game_choice_frame.summarizing_label.grid_remove()
-            self.update()
-
-        else:
-            self.character_agent.save_answer_on_disk_handler(
-                user_message=prompt, character_answer=agent_answer
+        self.submit_turn(
+            lambda emit_event, character_agent: self.save_turn_to_memory(
+                emit_event, character_agent, prompt=prompt, agent_answer=agent_answer
             )
+        )
 
     def clear_chat_history(self) -> None:
         self.chat_history.configure(state="normal")
         self.chat_history.delete("0.0", customtkinter.END)
         self.chat_history.configure(state="disabled")
+        self.older_chat_history_cursor = None
 
     def restore_chat_history(self) -> None:
+        # Only the most recent page is loaded, older ones follow on scrolling up
+        chat_history_page, self.older_chat_history_cursor = (
+            self.character_agent.get_chat_history_page(limit=_CHAT_HISTORY_PAGE_SIZE)
+        )
         self.chat_history.configure(state="normal")
         self.chat_history.delete("0.0", customtkinter.END)
-        self.chat_history.insert(
-            "0.0", self.character_agent.vector_store_memory.get_full_chat_history()
+        self.chat_history.insert("0.0", chat_history_page)
+        self.chat_history.configure(state="disabled")
+        self.chat_history.see(customtkinter.END)
+        self.update_character_emotion()
+
+    def load_older_chat_history(self) -> None:
+        if self.older_chat_history_cursor is None or self.chat_history.yview()[0] > 0:
+            return
+
+        chat_history_page, self.older_chat_history_cursor = (
+            self.character_agent.get_chat_history_page(
+                before=self.older_chat_history_cursor, limit=_CHAT_HISTORY_PAGE_SIZE
+            )
         )
+        self.chat_history.configure(state="normal")
+        self.chat_history.insert("0.0", chat_history_page)
         self.chat_history.configure(state="disabled")
+        # Keep the previously first message in view instead of jumping to the top
+        self.chat_history.yview(f"1.0 + {len(chat_history_page)} chars")
 
     def reset_game(self):
         self.actions_taken = []
@@ -361,6 +629,13 @@ class SessionButtonsFrame(customtkinter.CTkFrame):
         selected_character = character_window.get_input()
 
         if selected_character:
+            # Turns still queued for the previous character finish unseen
+            self.main_app.dispatch_turn_events()
+            self.main_app.finish_agent_answer_in_chat_history()
+            # Also after switching back, the rest of a turn streaming now has no
+            # answer in the chat history to go to
+            self.main_app.rendering_agent = None
+            self.main_app.rendering_turn = None
             self.set_character_session(character_name=selected_character)
             self.main_app.title(f"Conversation with {selected_character}")
             self.main_app.character_image_game_frame.character_label_image.configure(
@@ -378,26 +653,22 @@ class SessionButtonsFrame(customtkinter.CTkFrame):
                 self.main_app.restore_chat_history()
 
     def set_character_session(self, character_name: str) -> None:
-        self.main_app.character_agent.character.set_character(
-            character_name=character_name
-        )
-        self.main_app.character_agent.set_initial_system_message()
-        self.main_app.character_agent.summary_buffer_memory.character_session = (
-            character_name
-        )
-        self.main_app.character_agent.update_is_new_chat_variable()
-        self.main_app.character_agent.summary_buffer_memory.create_character_file_if_missing()
-        self.main_app.character_agent.summary_buffer_memory.update_buffer_counter()
-        self.main_app.character_agent.vector_store_memory.set_session(
-            character_name=character_name
-        )
+        # Warm if the character was used recently, otherwise loaded anew
+        character_agent = self.main_app.session_pool.get(character_name)
+        character_agent.update_is_new_chat_variable()
+        character_agent.summary_buffer_memory.create_character_file_if_missing()
+        character_agent.summary_buffer_memory.update_buffer_counter()
+        self.main_app.character_agent = character_agent
+        character_agent.start_warm_up()
 
     def reset_session(self) -> None:
         reset_session_window = ResetConversationWindow()
         session_reset_confirmed = reset_session_window.get_input()
         if session_reset_confirmed:
+            self.main_app.wait_for_pending_turns()
             self.main_app.clear_chat_history()
             self.main_app.character_agent.summary_buffer_memory.reset_character_session_on_disk()
+            self.main_app.character_agent.transcript_memory.reset_session()
             self.main_app.character_agent.vector_store_memory.reset_collection(
                 self.main_app.character_agent.character.name
             )
@@ -0,0 +1,145 @@
+import hashlib
+import os
+import threading
+from collections.abc import Callable
+from typing import Any
+
+from src.llm_agent_gui.utils.lru_cache import LruCache
+
+_EMBEDDING_PROVIDERS = ["onnx", "sentence-transformers"]
+
+# Same model as Chroma's default embedding function, so collections embedded
+# before the provider was configurable stay compatible
+_DEFAULT_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+EmbedTexts = Callable[[list[str]], list[list[float]]]
+
+
+class CachedEmbeddingFunction:
+    """Embeds texts in batches and caches the vectors by content hash.
+
+    The model is loaded on first use. Texts that were embedded before, such as
+    a repeated greeting or user message, are served from the cache.
+    """
+
+    def __init__(
+        self,
+        provider: str = "onnx",
+        model_name: str = _DEFAULT_EMBEDDING_MODEL,
+        batch_size: int = 32,
+        num_threads: int | None = None,
+        cache_size: int = 4096,
+        embed_texts: EmbedTexts | None = None,
+    ) -> None:
+        if provider not in _EMBEDDING_PROVIDERS:
+            raise Exception("No valid embedding provider option passed!")
+        if provider == "onnx" and model_name != _DEFAULT_EMBEDDING_MODEL:
+            raise Exception("The onnx embedding provider only runs all-MiniLM-L6-v2!")
+
+        self.provider = provider
+        self.model_name = model_name
+        self._batch_size = batch_size
+        self._num_threads = num_threads
+        self._embed_texts = embed_texts
+        self._model_lock = threading.Lock()
+        self._cache = LruCache(max_size=cache_size)
+
+    def __call__(self, input: list[str]) -> list[list[float]]:
+        text_keys = [_hash_text(text) for text in input]
+
+        # Local copy, the cache may evict vectors before all of them are looked up
+        vectors = {key: self._cache.get(key) for key in text_keys}
+        missing_texts = list(
+            {
+                key: text
+                for key, text in zip(text_keys, input, strict=True)
+                if vectors[key] is None
+            }.items()
+        )
+        for start in range(0, len(missing_texts), self._batch_size):
+            batch = missing_texts[start : start + self._batch_size]
+            batch_vectors = self._get_embed_texts()([text for _, text in batch])
+            for (key, _), vector in zip(batch, batch_vectors, strict=True):
+                vectors[key] = [float(value) for value in vector]
+                self._cache.put(key, vectors[key])
+
+        return [vectors[key] for key in text_keys]
+
+    def warm_up(self) -> None:
+        self._get_embed_texts()
+
+    def _get_embed_texts(self) -> EmbedTexts:
+        with self._model_lock:
+            if self._embed_texts is None:
+                if self.provider == "onnx":
+                    self._embed_texts = self.load_onnx()
+                else:
+                    self._embed_texts = self.load_sentence_transformers()
+            return self._embed_texts
+
+    def load_onnx(self) -> EmbedTexts:
+        from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+
+        onnx_embedding_function = ONNXMiniLM_L6_V2()
+        # Chroma has no option for the session's threads, so the session is
+        # built the way its model property does. These internals are checked
+        # against the pinned chromadb range in test_embeddings.
+        if self._num_threads is not None:
+            onnx_embedding_function._download_model_if_not_exists()
+            session_options = onnx_embedding_function.ort.SessionOptions()
+            session_options.log_severity_level = 3
+            session_options.intra_op_num_threads = self._num_threads
+            session_options.inter_op_num_threads = 1
+            # Stored where the cached model property would put its own session
+            vars(onnx_embedding_function)["model"] = (
+                onnx_embedding_function.ort.InferenceSession(
+                    os.path.join(
+                        onnx_embedding_function.DOWNLOAD_PATH,
+                        onnx_embedding_function.EXTRACTED_FOLDER_NAME,
+                        "model.onnx",
+                    ),
+                    providers=["CPUExecutionProvider"],
+                    sess_options=session_options,
+                )
+            )
+
+        return lambda texts: onnx_embedding_function(texts)  # type: ignore
+
+    def load_sentence_transformers(self) -> EmbedTexts:
+        try:
+            import torch
+            from sentence_transformers import SentenceTransformer
+        except ImportError as error:
+            raise ImportError(
+                "The sentence-transformers embedding provider needs "
+                "sentence-transformers. Install it with:\n"
+                "  uv pip install sentence-transformers\n"
+                "Or use the onnx embedding provider instead."
+            ) from error
+
+        if self._num_threads is not None:
+            torch.set_num_threads(self._num_threads)
+        model = SentenceTransformer(self.model_name, device="cpu")
+
+        def embed_texts(texts: list[str]) -> Any:
+            return model.encode(
+                texts, batch_size=self._batch_size, normalize_embeddings=True
+            )
+
+        return embed_texts
+
+
+def create_embedding_function() -> CachedEmbeddingFunction:
+    # Configured via EMBEDDING_* env vars, see .env.example
+    num_threads = os.getenv("EMBEDDING_NUM_THREADS")
+    return CachedEmbeddingFunction(
+        provider=os.getenv("EMBEDDING_PROVIDER", "onnx"),
+        model_name=os.getenv("EMBEDDING_MODEL", _DEFAULT_EMBEDDING_MODEL),
+        batch_size=int(os.getenv("EMBEDDING_BATCH_SIZE", "32")),
+        num_threads=int(num_threads) if num_threads else None,
+        cache_size=int(os.getenv("EMBEDDING_CACHE_SIZE", "4096")),
+    )
+
+
+def _hash_text(text: str) -> str:
+    return hashlib.sha256(text.encode()).hexdigest()
@@ -188,6 +188,7 @@ class TicTacToe(ctk.CTkFrame):
         self.main_app.add_agent_answer_to_chat_history(
             character_response=charater_reaction
         )
+        self.main_app.update_character_emotion(character_response=charater_reaction)
 
         provisional_user_message = f"We just finished our Tic-Tac-Toe game session. I won {self.user_wins} times and you won {self.ai_wins} time."
         self.main_app.update_character_agent_memory(
@@ -238,8 +239,9 @@ class TicTacToe(ctk.CTkFrame):
             self.user_wins = 0
             self.ai_wins = 0
         while True:
+            # Same prompt on every step, a cached step would repeat forever
             character_action_step = self.main_app.character_agent.llm.inference_llm(
-                [self.game_prompt]
+                [self.game_prompt], use_cache=False
             )
             print(character_action_step)
 
@@ -273,4 +275,7 @@ class TicTacToe(ctk.CTkFrame):
                 self.main_app.add_agent_answer_to_chat_history(
                     character_response=action_input[0]
                 )
+                self.main_app.update_character_emotion(
+                    character_response=action_input[0]
+                )
                 self.actions_taken += "\n" + clean_character_action_step + "\n"
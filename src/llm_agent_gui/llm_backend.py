@@ -1,23 +1,112 @@
-from typing import Any
+import asyncio
+import hashlib
+import importlib.util
+import itertools
+import random
+import threading
+import time
+from collections.abc import AsyncIterator, Coroutine, Iterator
+from typing import Any, TypeVar
 
-try:
-    from llama_cpp import Llama
+from src.llm_agent_gui import response_cache as llm_response_cache
+from src.llm_agent_gui import tracing
+from src.llm_agent_gui.utils import lru_cache
 
-    LLAMA_CPP_AVAILABLE = True
-except ImportError:
-    LLAMA_CPP_AVAILABLE = False
+# llama-cpp, openai and transformers (with torch) are only imported once their
+# models are first needed, which keeps importing this module cheap.
+LLAMA_CPP_AVAILABLE = importlib.util.find_spec("llama_cpp") is not None
+TIKTOKEN_AVAILABLE = importlib.util.find_spec("tiktoken") is not None
 
-from openai import OpenAI
-from transformers import pipeline
+_EMOTION_CLASSIFIER_MODEL = "j-hartmann/emotion-english-distilroberta-base"
+_CLASSIFIER_RUNTIMES = ["pytorch", "quantized", "onnx"]
 
+# Rough count for English text when the backend's tokenizer is not installed
+_CHARACTERS_PER_TOKEN = 4
+# Encoding of the gpt-3.5 and gpt-4 models, for model names tiktoken does not know
+_FALLBACK_TIKTOKEN_ENCODING = "cl100k_base"
 
-class LlmBackend:
-    def __init__(self, backend: str):
-        self.classifier = pipeline(
-            "text-classification",
-            model="j-hartmann/emotion-english-distilroberta-base",
-            return_all_scores=True,
+_T = TypeVar("_T")
+
+
+class _BackgroundEventLoop:
+    """Event loop on a daemon thread, started on first use.
+
+    The async OpenAI client and its connection pool are bound to the loop they
+    are first used on, so every request of a backend runs on this one loop,
+    whichever thread or event loop it comes from.
+    """
+
+    def __init__(self) -> None:
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._lock = threading.Lock()
+
+    def run(self, coroutine: Coroutine[Any, Any, _T]) -> _T:
+        return asyncio.run_coroutine_threadsafe(coroutine, self._get_loop()).result()
+
+    async def run_async(self, coroutine: Coroutine[Any, Any, _T]) -> _T:
+        return await asyncio.wrap_future(
+            asyncio.run_coroutine_threadsafe(coroutine, self._get_loop())
         )
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(target=self._loop.run_forever, daemon=True).start()
+            return self._loop
+
+
+class LlmBackend:
+    def __init__(
+        self,
+        backend: str,
+        lazy_loading: bool = True,
+        classifier_runtime: str = "pytorch",
+        classifier_max_length: int = 512,
+        classifier_batch_size: int = 16,
+        classifier_cache_size: int = 1024,
+        response_cache: llm_response_cache.ResponseCache | None = None,
+        llama_cpp_prompt_cache_bytes: int = 2 << 30,
+        token_count_cache_size: int = 4096,
+        openai_model: str = "gpt-3.5-turbo",
+        openai_context_window: int = 16385,
+        openai_base_url: str | None = None,
+        request_timeout: float = 60.0,
+        connect_timeout: float = 5.0,
+        max_retries: int = 3,
+        retry_initial_delay: float = 0.5,
+        retry_max_delay: float = 8.0,
+        max_concurrent_requests: int = 4,
+    ):
+        self.backend = backend
+        self._openai_model = openai_model
+        self._openai_context_window = openai_context_window
+        self._openai_base_url = openai_base_url
+        self._request_timeout = request_timeout
+        self._connect_timeout = connect_timeout
+        self._max_retries = max_retries
+        self._retry_initial_delay = retry_initial_delay
+        self._retry_max_delay = retry_max_delay
+        self._max_concurrent_requests = max_concurrent_requests
+        self._llama_cpp_prompt_cache_bytes = llama_cpp_prompt_cache_bytes
+        self.response_cache = response_cache
+        if classifier_runtime not in _CLASSIFIER_RUNTIMES:
+            raise Exception("No valid classifier runtime option passed!")
+        self._classifier_runtime = classifier_runtime
+        self._classifier_max_length = classifier_max_length
+        self._classifier_batch_size = classifier_batch_size
+        self._emotion_cache = lru_cache.LruCache(max_size=classifier_cache_size)
+        self._classifier: Any = None
+        self._classifier_lock = threading.Lock()
+        self._llm: Any = None
+        self._llm_lock = threading.Lock()
+        # A llama.cpp context runs one generation at a time, replies, summaries
+        # and game steps come from different threads
+        self._llama_cpp_generation_lock = threading.Lock()
+        # Instructions, summary and buffer lines are counted again every turn
+        self._token_count_cache = lru_cache.LruCache(max_size=token_count_cache_size)
+        self._tiktoken_encoding: Any = None
+
         if backend == "llama-cpp":
             self.initialize_llama_cpp()
         elif backend == "openai":
@@ -25,6 +114,9 @@ class LlmBackend:
         else:
             raise Exception("No valid backend option passed!")
 
+        if not lazy_loading:
+            self.warm_up()
+
     def initialize_llama_cpp(self):
         if not LLAMA_CPP_AVAILABLE:
             raise ImportError(
@@ -35,44 +127,353 @@ class LlmBackend:
                 "Or set LLM_BACKEND=openai to use OpenAI API instead."
             )
 
-        self.llama_cpp_llm = Llama(
-            model_path="src/llm_agent_gui/llm_weights/openhermes-2.5-mistral-7b.Q5_K_M.gguf",
-            n_ctx=4096,
+        self.model_name = (
+            "src/llm_agent_gui/llm_weights/openhermes-2.5-mistral-7b.Q5_K_M.gguf"
+        )
+        self.sampling_params = {
+            "max_tokens": None,
+            "stop": ["<|end_of_turn|>"],
+            "temperature": 0.4,
+        }
+        self.context_window = 4096
+        self._load_llm = self.load_llama_cpp
+        self._inference_backend = self.inference_llama_cpp
+        self._ainference_backend = self.ainference_llama_cpp
+        self._stream_backend = self.stream_llama_cpp
+
+    def initialize_openai(self):
+        self.model_name = self._openai_model
+        self.sampling_params = {}
+        self.context_window = self._openai_context_window
+        self._load_llm = self.load_openai
+        self._inference_backend = self.inference_openai
+        self._ainference_backend = self.ainference_openai
+        self._stream_backend = self.stream_openai
+        self._event_loop = _BackgroundEventLoop()
+        # Bound to the background loop on first use, caps the requests in flight
+        self._request_semaphore = asyncio.Semaphore(self._max_concurrent_requests)
+
+    def load_llama_cpp(self) -> Any:
+        from llama_cpp import Llama, LlamaRAMCache
+
+        llama_cpp_llm = Llama(
+            model_path=self.model_name,
+            n_ctx=self.context_window,
             chat_format="chatml",
             verbose=False,
             n_gpu_layers=-1,  # load all layers to GPU
         )
+        if self._llama_cpp_prompt_cache_bytes:
+            # Keeps KV states keyed by prompt tokens, a new prompt resumes from
+            # the state with the longest common prefix, e.g. a character's
+            # system prompt and summary, and only evaluates the remaining tokens
+            llama_cpp_llm.set_cache(
+                LlamaRAMCache(capacity_bytes=self._llama_cpp_prompt_cache_bytes)
+            )
+        return llama_cpp_llm
 
-        self.inference_llm = self.inference_llama_cpp
+    def load_openai(self) -> Any:
+        import openai
 
-    def initialize_openai(self):
-        self.openai_llm = OpenAI()
-        self.inference_llm = self.inference_openai
+        # One client for all requests, so they share its connection pool.
+        # Retries and the total timeout are done in _create_openai_completion.
+        return openai.AsyncOpenAI(
+            base_url=self._openai_base_url,
+            timeout=openai.Timeout(
+                self._request_timeout, connect=self._connect_timeout
+            ),
+            max_retries=0,
+        )
+
+    def load_classifier(self) -> Any:
+        from transformers import pipeline
+
+        if self._classifier_runtime == "onnx":
+            try:
+                from optimum.onnxruntime import ORTModelForSequenceClassification
+            except ImportError as error:
+                raise ImportError(
+                    "The onnx classifier runtime needs optimum with onnxruntime. "
+                    "Install it with:\n"
+                    "  uv pip install optimum[onnxruntime]\n"
+                    "Or use the pytorch or quantized classifier runtime instead."
+                ) from error
+            from transformers import AutoTokenizer
+
+            return pipeline(
+                "text-classification",
+                model=ORTModelForSequenceClassification.from_pretrained(
+                    _EMOTION_CLASSIFIER_MODEL, export=True
+                ),
+                tokenizer=AutoTokenizer.from_pretrained(_EMOTION_CLASSIFIER_MODEL),
+                return_all_scores=True,
+            )
+
+        classifier = pipeline(
+            "text-classification",
+            model=_EMOTION_CLASSIFIER_MODEL,
+            return_all_scores=True,
+        )
+        if self._classifier_runtime == "quantized":
+            import torch
+
+            # int8 weights for the linear layers, CPU only
+            classifier.model = torch.quantization.quantize_dynamic(
+                classifier.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+        return classifier
+
+    @property
+    def llama_cpp_llm(self) -> Any:
+        return self._get_llm()
+
+    @property
+    def openai_llm(self) -> Any:
+        return self._get_llm()
+
+    @property
+    def classifier(self) -> Any:
+        return self._get_classifier()
+
+    def _get_llm(self) -> Any:
+        with self._llm_lock:
+            if self._llm is None:
+                self._llm = self._load_llm()
+            return self._llm
+
+    def _get_classifier(self) -> Any:
+        with self._classifier_lock:
+            if self._classifier is None:
+                self._classifier = self.load_classifier()
+            return self._classifier
+
+    def warm_up(self) -> None:
+        self._get_llm()
+        self._get_classifier()
+
+    def inference_llm(self, prompt: list[Any], use_cache: bool = True) -> str:
+        with tracing.span("llm.inference", backend=self.backend) as span:
+            if self.response_cache is None or not use_cache:
+                response = self._inference_backend(prompt)
+            else:
+                cache_key = self._response_cache_key(prompt)
+                response = self.response_cache.get(cache_key)
+                span["attributes"]["cached"] = response is not None
+                if response is None:
+                    response = self._inference_backend(prompt)
+                    self.response_cache.put(cache_key, response)
+            span["attributes"]["tokens"] = self.count_tokens(response)
+            return response
+
+    async def ainference_llm(self, prompt: list[Any], use_cache: bool = True) -> str:
+        if self.response_cache is None or not use_cache:
+            return await self._ainference_backend(prompt)
+
+        cache_key = self._response_cache_key(prompt)
+        cached_response = self.response_cache.get(cache_key)
+        if cached_response is not None:
+            return cached_response
+
+        response = await self._ainference_backend(prompt)
+        self.response_cache.put(cache_key, response)
+        return response
+
+    def stream_llm(self, prompt: list[Any], use_cache: bool = True) -> Iterator[str]:
+        with tracing.span("llm.stream", backend=self.backend) as span:
+            start = time.perf_counter()
+            response_parts = []
+            for delta in self._stream_llm(prompt, use_cache=use_cache):
+                if not response_parts:
+                    span["attributes"]["time_to_first_token"] = (
+                        time.perf_counter() - start
+                    )
+                response_parts.append(delta)
+                yield delta
+            span["attributes"]["tokens"] = self.count_tokens("".join(response_parts))
+
+    def _stream_llm(self, prompt: list[Any], use_cache: bool) -> Iterator[str]:
+        if self.response_cache is None or not use_cache:
+            yield from self._stream_backend(prompt)
+            return
+
+        cache_key = self._response_cache_key(prompt)
+        cached_response = self.response_cache.get(cache_key)
+        if cached_response is not None:
+            yield cached_response
+            return
+
+        response_parts = []
+        for delta in self._stream_backend(prompt):
+            response_parts.append(delta)
+            yield delta
+        self.response_cache.put(cache_key, "".join(response_parts))
+
+    def _response_cache_key(self, prompt: list[Any]) -> str:
+        return llm_response_cache.make_cache_key(
+            backend=self.backend,
+            model=self.model_name,
+            sampling_params=self.sampling_params,
+            prompt=prompt,
+        )
+
+    def count_tokens(self, text: str) -> int:
+        text_key = hashlib.sha256(text.encode()).hexdigest()
+        token_count = self._token_count_cache.get(text_key)
+        if token_count is None:
+            if self.backend == "llama-cpp":
+                token_count = len(
+                    self.llama_cpp_llm.tokenize(text.encode(), add_bos=False)
+                )
+            elif TIKTOKEN_AVAILABLE:
+                token_count = len(self._get_tiktoken_encoding().encode(text))
+            else:
+                token_count = -(-len(text) // _CHARACTERS_PER_TOKEN)
+            self._token_count_cache.put(text_key, token_count)
+        return token_count
+
+    def _get_tiktoken_encoding(self) -> Any:
+        if self._tiktoken_encoding is None:
+            import tiktoken
+
+            try:
+                self._tiktoken_encoding = tiktoken.encoding_for_model(self.model_name)
+            except KeyError:
+                # Unknown to tiktoken, e.g. a model on an OpenAI-compatible server
+                self._tiktoken_encoding = tiktoken.get_encoding(
+                    _FALLBACK_TIKTOKEN_ENCODING
+                )
+        return self._tiktoken_encoding
 
     def inference_openai(
         self, prompt: list[Any]
     ) -> str:  # TODO: find proper way to hint types
-        completion = self.openai_llm.chat.completions.create(
-            model="gpt-3.5-turbo", messages=prompt
-        )
+        return self._event_loop.run(self._request_openai_completion(prompt))
+
+    async def ainference_openai(self, prompt: list[Any]) -> str:
+        return await self._event_loop.run_async(self._request_openai_completion(prompt))
 
+    def stream_openai(self, prompt: list[Any]) -> Iterator[str]:
+        deltas = self._stream_openai_completion(prompt)
+        try:
+            while True:
+                try:
+                    delta = self._event_loop.run(anext(deltas))
+                except StopAsyncIteration:
+                    return
+                yield delta
+        finally:
+            self._event_loop.run(deltas.aclose())
+
+    async def _request_openai_completion(self, prompt: list[Any]) -> str:
+        async with self._request_semaphore:
+            completion = await self._create_openai_completion(prompt)
         return completion.choices[0].message.content  # type: ignore
 
+    async def _stream_openai_completion(self, prompt: list[Any]) -> AsyncIterator[str]:
+        async with self._request_semaphore:
+            stream = await self._create_openai_completion(prompt, stream=True)
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    yield delta
+
+    async def _create_openai_completion(self, prompt: list[Any], **kwargs) -> Any:
+        import openai
+
+        for attempt in itertools.count():
+            try:
+                # The client's timeout only bounds each connect and read, this
+                # one the whole request, or a stream until its response starts
+                return await asyncio.wait_for(
+                    self.openai_llm.chat.completions.create(
+                        model=self.model_name,
+                        messages=prompt,
+                        **self.sampling_params,
+                        **kwargs,
+                    ),
+                    self._request_timeout,
+                )
+            # Rate limits, 5xx answers, timeouts and dropped connections
+            except (
+                openai.RateLimitError,
+                openai.InternalServerError,
+                openai.APIConnectionError,
+                asyncio.TimeoutError,
+            ) as error:
+                if attempt >= self._max_retries:
+                    if isinstance(error, asyncio.TimeoutError):
+                        raise TimeoutError(
+                            f"Request timed out after {self._request_timeout} s"
+                        ) from error
+                    raise
+                delay = min(
+                    self._retry_initial_delay * 2**attempt, self._retry_max_delay
+                )
+                # Jittered, so concurrent requests do not retry in lockstep
+                await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+
     def inference_llama_cpp(
         self, prompt: list[Any]
     ) -> str:  # TODO: find proper way to hint types
-        output = self.llama_cpp_llm.create_chat_completion(
-            messages=prompt,
-            max_tokens=None,
-            stop=["<|end_of_turn|>"],
-            temperature=0.4,
-            stream=False,
-        )
+        llama_cpp_llm = self.llama_cpp_llm
+        with self._llama_cpp_generation_lock:
+            output = llama_cpp_llm.create_chat_completion(
+                messages=prompt, stream=False, **self.sampling_params
+            )
         return output["choices"][0]["message"]["content"]  # type: ignore
 
+    async def ainference_llama_cpp(self, prompt: list[Any]) -> str:
+        # Waits in a thread for the generation lock, so concurrent requests run
+        # one after another without blocking the event loop
+        return await asyncio.to_thread(self.inference_llama_cpp, prompt)
+
+    def stream_llama_cpp(self, prompt: list[Any]) -> Iterator[str]:
+        llama_cpp_llm = self.llama_cpp_llm
+        # Held until the stream is consumed or closed, the generator is what
+        # runs the model
+        with self._llama_cpp_generation_lock:
+            stream = llama_cpp_llm.create_chat_completion(
+                messages=prompt, stream=True, **self.sampling_params
+            )
+            for chunk in stream:
+                delta = chunk["choices"][0]["delta"].get("content")  # type: ignore
+                if delta:
+                    yield delta
+
     def classify_sentiment(self, character_response: str):
-        emotion_scores = self.classifier(character_response)[0]  # type: ignore
+        return self.classify_sentiments([character_response])[0]
+
+    def classify_sentiments(self, character_responses: list[str]) -> list[str]:
+        response_keys = [
+            hashlib.sha256(response.encode()).hexdigest()
+            for response in character_responses
+        ]
+        emotion_labels = {}
+        uncached_responses = {}
+        for key, response in zip(response_keys, character_responses, strict=True):
+            cached_label = self._emotion_cache.get(key)
+            if cached_label is None:
+                uncached_responses[key] = response
+            else:
+                emotion_labels[key] = cached_label
 
-        max_emotion = max(emotion_scores, key=lambda x: x["score"])  # type: ignore
+        if uncached_responses:
+            with tracing.span(
+                "llm.classify_sentiment", responses=len(uncached_responses)
+            ):
+                all_emotion_scores = self.classifier(
+                    list(uncached_responses.values()),
+                    batch_size=self._classifier_batch_size,
+                    truncation=True,
+                    max_length=self._classifier_max_length,
+                )
+            for key, emotion_scores in zip(
+                uncached_responses, all_emotion_scores, strict=True
+            ):
+                max_emotion = max(emotion_scores, key=lambda x: x["score"])  # type: ignore
+                emotion_labels[key] = max_emotion["label"]
+                self._emotion_cache.put(key, max_emotion["label"])
 
-        return max_emotion["label"]
+        return [emotion_labels[key] for key in response_keys]
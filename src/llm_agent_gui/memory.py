@@ -1,23 +1,83 @@
 import json
 import os
+import re
+import sqlite3
+import threading
+import time
+from collections.abc import Callable
+from typing import TYPE_CHECKING, Any
+
+from src.llm_agent_gui import embeddings, retrieval, tracing
+from src.llm_agent_gui.utils import format_messages
 
-import chromadb
+if TYPE_CHECKING:
+    from chromadb.api import ClientAPI
+    from chromadb.api.models.Collection import Collection
 
-from src.llm_agent_gui.utils import format_messages
+# Vector store documents are stored as "id<n>" with n counting up from 0 in
+# conversation order
+_STRING_ID_PATTERN = re.compile(r"^id(\d+)$")
+
+# Dense and lexical retrieval each contribute this many candidates per result
+# to the rank fusion, the best fused ones are reranked if a reranker is set
+_RETRIEVAL_CANDIDATES_PER_RESULT = 5
+_RERANK_CANDIDATES_PER_RESULT = 3
+
+# Buffer expansions are appended to a JSON Lines journal next to the snapshot.
+# Once the journal grows past this size it is folded back into the snapshot.
+_JOURNAL_COMPACTION_BYTES = 64 * 1024
 
 
 class SummaryBufferMemory:
-    def __init__(self, buffer_size: int, character_name: str) -> None:
+    """Summary and message buffer of a character session.
+
+    State is a JSON snapshot ``[summary, buffer]`` plus an append-only journal of
+    buffer expansions; summary and buffer resets rewrite the snapshot atomically.
+    The loaded state is kept in memory and every write goes through to disk, so
+    the files are only read again after ``invalidate_cache`` or a session change.
+    Summaries may be swapped in from another thread while the buffer keeps
+    growing, so every access to the state holds the memory's lock.
+
+    A summary is due once the buffer holds ``buffer_size`` lines, or, given a
+    ``buffer_token_budget``, once its lines take more tokens than that. In the
+    token mode only the oldest lines are summarized, the newest ones worth up
+    to ``recent_token_share`` of the budget stay verbatim.
+
+    Summaries can be kept as levels in a third snapshot element: level 0 holds
+    the summaries of single buffer chunks, every higher level roll-ups of the
+    level below. The summary in the first element is composed from them, so
+    readers of the plain summary need not know about the levels.
+    """
+
+    def __init__(
+        self,
+        buffer_size: int,
+        character_name: str,
+        max_buffer_overrun: int = 0,
+        count_tokens: Callable[[str], int] | None = None,
+        buffer_token_budget: int | None = None,
+        max_buffer_token_overrun: int = 0,
+        recent_token_share: float = 0.5,
+        summary_buffer_directory: str | None = None,
+    ) -> None:
+        if buffer_token_budget is not None and count_tokens is None:
+            raise Exception("A token budget needs a count_tokens function!")
         self._buffer_size = buffer_size
+        self._max_buffer_overrun = max_buffer_overrun
+        self._count_tokens = count_tokens
+        self._buffer_token_budget = buffer_token_budget
+        self._max_buffer_token_overrun = max_buffer_token_overrun
+        self._recent_token_share = recent_token_share
         self._buffer_counter = 0
+        self._lock = threading.RLock()
+        self._summary_buffer_logs: list[Any] | None = None
         self.character_session = character_name
-        self.summary_pending = False
 
-        self._SUMMARY_BUFFER_DIRECTORY = (
+        self._SUMMARY_BUFFER_DIRECTORY = summary_buffer_directory or (
             "src/llm_agent_gui/history_logs/summary_buffer/"
         )
-        self._SUMMARY_BUFFER_PATH = (
-            "src/llm_agent_gui/history_logs/summary_buffer/{}.json"
+        self._SUMMARY_BUFFER_PATH = os.path.join(
+            self._SUMMARY_BUFFER_DIRECTORY, "{}.json"
         )
 
         try:
@@ -25,7 +85,36 @@ class SummaryBufferMemory:
         except FileExistsError:
             pass
 
+    @property
+    def character_session(self) -> str:
+        return self._character_session
+
+    @character_session.setter
+    def character_session(self, character_name: str) -> None:
+        self._character_session = character_name
+        self.invalidate_cache()
+
+    def invalidate_cache(self) -> None:
+        """Drop the in-memory state, e.g. after the files were changed externally."""
+        with self._lock:
+            self._summary_buffer_logs = None
+
+    def cached_line_count(self) -> int:
+        with self._lock:
+            if self._summary_buffer_logs is None:
+                return 0
+            return len(self._summary_buffer_logs[1])
+
+    def reload_from_disk(self) -> None:
+        with self._lock:
+            self.invalidate_cache()
+            self._read_summary_buffer_logs()
+
     def has_empty_buffer_history(self) -> bool:
+        with self._lock:
+            if self._summary_buffer_logs is not None:
+                return not self._summary_buffer_logs[1]
+
         try:
             open(
                 self._SUMMARY_BUFFER_PATH.format(self.character_session),
@@ -41,126 +130,595 @@ class SummaryBufferMemory:
                 return True
 
     def create_character_file_if_missing(self) -> None:
-        try:
-            f = open(
-                self._SUMMARY_BUFFER_PATH.format(self.character_session),
-            )
-
-        except FileNotFoundError:
-            with open(
-                self._SUMMARY_BUFFER_PATH.format(self.character_session),
-                "w",
-            ) as f:
-                json.dump(["", []], f, indent=4)
+        if not os.path.exists(self._snapshot_path()):
+            self._write_snapshot(["", []])
 
     def reset_character_session_on_disk(self) -> None:
-        with open(
-            self._SUMMARY_BUFFER_PATH.format(self.character_session),
-            "w",
-        ) as f:
-            json.dump(["", []], f, indent=4)
+        self._write_snapshot(["", []])
 
     def save_new_summary_on_disk(self, new_summary: str | None) -> None:
-        with open(
-            self._SUMMARY_BUFFER_PATH.format(self.character_session),
-            "r+",
-        ) as f:
-            summary_buffer_logs = json.load(f)
-            summary_buffer_logs[0] = new_summary
-            f.seek(0)
-            f.truncate()
-            json.dump(summary_buffer_logs, f, indent=4)
+        with self._lock:
+            summary_buffer_logs = self._read_summary_buffer_logs()
+            self._write_snapshot([new_summary, summary_buffer_logs[1]])
+
+    def replace_summarized_lines_on_disk(
+        self,
+        new_summary: str,
+        summarized_line_count: int,
+        summary_levels: list[list[dict[str, Any]]] | None = None,
+    ) -> None:
+        """Swap in a summary of the oldest buffer lines and drop those lines."""
+        with self._lock:
+            summary_buffer_logs = self._read_summary_buffer_logs()
+            new_summary_buffer_logs = [
+                new_summary,
+                summary_buffer_logs[1][summarized_line_count:],
+            ]
+            if summary_levels is not None:
+                new_summary_buffer_logs.append(summary_levels)
+            self._write_snapshot(new_summary_buffer_logs)
+            self.update_buffer_counter()
 
     def save_initial_buffer_on_disk(
         self, character_greeting: list[dict[str, str]]
     ) -> None:
-        with open(
-            self._SUMMARY_BUFFER_PATH.format(self.character_session),
-            "w",
-        ) as f:
-            new_lines_formatted = ["", character_greeting]
-            json.dump(new_lines_formatted, f, indent=4)
+        self._write_snapshot(["", character_greeting])
 
     def expand_buffer_on_disk(self, new_lines: list[dict[str, str]]) -> None:
-        with open(
-            self._SUMMARY_BUFFER_PATH.format(self.character_session),
-            "r+",
-        ) as f:
-            summary_buffer_logs = json.load(f)
-            summary_buffer_logs[1] += new_lines
-            f.seek(0)
-            f.truncate()
-            json.dump(summary_buffer_logs, f, indent=4)
+        with self._lock:
+            self._recover_interrupted_compaction()
+            with (
+                tracing.span("summary_buffer.append", lines=len(new_lines)),
+                open(self._journal_path(), "a") as f,
+            ):
+                f.write(json.dumps({"new_lines": new_lines}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+                journal_size = f.tell()
+
+            if self._summary_buffer_logs is not None:
+                self._summary_buffer_logs[1] += new_lines
+
+            if journal_size > _JOURNAL_COMPACTION_BYTES:
+                self.compact_on_disk()
 
     def load_summary_from_disk(self) -> str:
-        with open(
-            self._SUMMARY_BUFFER_PATH.format(self.character_session),
-        ) as f:
-            summary_buffer_logs = json.load(f)
-            latest_summary = summary_buffer_logs[0]
+        latest_summary = self._read_summary_buffer_logs()[0]
 
         if not latest_summary:
             latest_summary = "You have no conversation summary with the user yet."
         return latest_summary
 
+    def load_summary_levels(self) -> list[list[dict[str, Any]]]:
+        with self._lock:
+            summary_buffer_logs = self._read_summary_buffer_logs()
+            if len(summary_buffer_logs) > 2:
+                return [list(level) for level in summary_buffer_logs[2]]
+            if not summary_buffer_logs[0]:
+                return []
+
+            # Summary written before the levels existed, ranks above the chunks
+            return [[], [create_summary_entry(summary_buffer_logs[0], 0)]]
+
     def load_buffer_from_disk(self) -> list[dict[str, str]]:
-        with open(
-            self._SUMMARY_BUFFER_PATH.format(self.character_session),
-        ) as f:
-            summary_buffer_logs = json.load(f)
-            last_messages = summary_buffer_logs[1]
+        with self._lock:
+            last_messages = list(self._read_summary_buffer_logs()[1])
+
+        return last_messages
 
-            return last_messages
+    def load_summary_and_buffer_from_disk(self) -> tuple[str, list[dict[str, str]]]:
+        with self._lock:
+            return self.load_summary_from_disk(), self.load_buffer_from_disk()
 
     def reset_buffer_on_disk(self) -> None:
-        with open(
-            self._SUMMARY_BUFFER_PATH.format(self.character_session),
-            "r+",
-        ) as f:
-            summary_buffer_logs = json.load(f)
-            summary_buffer_logs[1] = []
-            f.seek(0)
-            f.truncate()
-            json.dump(summary_buffer_logs, f, indent=4)
+        with self._lock:
+            summary_buffer_logs = self._read_summary_buffer_logs()
+            self._write_snapshot([summary_buffer_logs[0], [], *summary_buffer_logs[2:]])
 
     def update_buffer_counter(self) -> None:
-        self._buffer_counter = len(self.load_buffer_from_disk())
-        self.summary_pending = not (
-            self._buffer_counter < self._buffer_size
-        )  # parentheses for better readability, otherwise not needed due to operator precedence
+        with self._lock:
+            self._buffer_counter = len(self._read_summary_buffer_logs()[1])
+
+    @property
+    def summary_pending(self) -> bool:
+        # Tokens are only counted here, the tokenizer may have to load first
+        with self._lock:
+            if self._buffer_token_budget is None:
+                return not (
+                    self._buffer_counter < self._buffer_size
+                )  # parentheses for better readability, otherwise not needed due to operator precedence
+            return self._count_buffer_tokens() > self._buffer_token_budget
+
+    def exceeds_buffer_overrun(self) -> bool:
+        """Whether the buffer outgrew its size by more than a pending summary may allow."""
+        with self._lock:
+            if self._buffer_token_budget is None:
+                return (
+                    self._buffer_counter >= self._buffer_size + self._max_buffer_overrun
+                )
+            return (
+                self._count_buffer_tokens()
+                >= self._buffer_token_budget + self._max_buffer_token_overrun
+            )
+
+    def count_lines_to_summarize(self, buffer: list[dict[str, str]]) -> int:
+        """Number of oldest buffer lines the next summary should take in."""
+        if self._buffer_token_budget is None:
+            return len(buffer)
+
+        recent_token_budget = self._buffer_token_budget * self._recent_token_share
+        recent_tokens = 0
+        kept_line_count = 0
+        for line in reversed(buffer):
+            recent_tokens += self._count_tokens(line["content"])  # type: ignore
+            if recent_tokens > recent_token_budget:
+                break
+            kept_line_count += 1
+
+        # At least one line, otherwise a pending summary would never shrink it
+        return max(len(buffer) - kept_line_count, 1 if buffer else 0)
+
+    def _count_buffer_tokens(self) -> int:
+        return sum(
+            self._count_tokens(line["content"])  # type: ignore
+            for line in self._read_summary_buffer_logs()[1][: self._buffer_counter]
+        )
+
+    def compact_on_disk(self) -> None:
+        """Fold the journal into the snapshot."""
+        with self._lock:
+            self._write_snapshot(self._read_summary_buffer_logs())
+
+    def _snapshot_path(self) -> str:
+        return self._SUMMARY_BUFFER_PATH.format(self.character_session)
+
+    def _journal_path(self) -> str:
+        return os.path.splitext(self._snapshot_path())[0] + ".jsonl"
+
+    def _read_summary_buffer_logs(self) -> list[Any]:
+        with self._lock:
+            if self._summary_buffer_logs is None:
+                with tracing.span("summary_buffer.load"):
+                    self._summary_buffer_logs = (
+                        self._load_summary_buffer_logs_from_disk()
+                    )
+
+            return self._summary_buffer_logs
+
+    def _load_summary_buffer_logs_from_disk(self) -> list[Any]:
+        self._recover_interrupted_compaction()
+        with open(self._snapshot_path()) as f:
+            summary_buffer_logs = json.load(f)
+
+        try:
+            with open(self._journal_path()) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue  # torn write of a crashed append
+                    summary_buffer_logs[1] += record["new_lines"]
+        except FileNotFoundError:
+            pass
+
+        return summary_buffer_logs
+
+    def _write_snapshot(self, summary_buffer_logs: list[Any]) -> None:
+        # The complete temporary snapshot supersedes snapshot + journal, so a
+        # crash at any point leaves a state _recover_interrupted_compaction
+        # can restore without losing or duplicating lines.
+        with self._lock, tracing.span("summary_buffer.write_snapshot"):
+            snapshot_path = self._snapshot_path()
+            temporary_path = snapshot_path + ".tmp"
+            with open(temporary_path, "w") as f:
+                json.dump(summary_buffer_logs, f, indent=4)
+                f.flush()
+                os.fsync(f.fileno())
+
+            try:
+                os.remove(self._journal_path())
+            except FileNotFoundError:
+                pass
+            os.replace(temporary_path, snapshot_path)
+            _fsync_directory(os.path.dirname(snapshot_path))
+
+            self._summary_buffer_logs = [
+                summary_buffer_logs[0],
+                list(summary_buffer_logs[1]),
+                *summary_buffer_logs[2:],
+            ]
+
+    def _recover_interrupted_compaction(self) -> None:
+        self._cut_torn_journal_line()
+        temporary_path = self._snapshot_path() + ".tmp"
+        try:
+            with open(temporary_path) as f:
+                json.load(f)
+        except FileNotFoundError:
+            return
+        except json.JSONDecodeError:
+            # Crashed while writing the new snapshot, old snapshot + journal hold
+            os.remove(temporary_path)
+            return
+
+        try:
+            os.remove(self._journal_path())
+        except FileNotFoundError:
+            pass
+        os.replace(temporary_path, self._snapshot_path())
+
+    def _cut_torn_journal_line(self) -> None:
+        # A crashed append leaves a line without newline, the next append
+        # would be written onto it and be unreadable as well
+        try:
+            with open(self._journal_path(), "rb+") as f:
+                journal = f.read()
+                if journal and not journal.endswith(b"\n"):
+                    f.truncate(journal.rfind(b"\n") + 1)
+                    f.flush()
+                    os.fsync(f.fileno())
+        except FileNotFoundError:
+            pass
+
+
+def create_summary_entry(summary: str, line_count: int) -> dict[str, Any]:
+    return {"summary": summary, "line_count": line_count, "created_at": time.time()}
+
+
+def compose_summary(
+    summary_levels: list[list[dict[str, Any]]],
+    count_tokens: Callable[[str], int] | None = None,
+    token_budget: int | None = None,
+) -> str:
+    """Join the summaries of the levels, oldest and most condensed first.
+
+    Given a token budget, only whole summaries that fit are kept: the top level
+    first, as it condenses the start of the conversation, then the levels below
+    from the latest chunk summary backwards, up to the first one that does not
+    fit.
+    """
+    # Levels cover consecutive parts of the conversation, the top level the oldest
+    entries = [entry for level in reversed(summary_levels) for entry in level]
+    if count_tokens is None or token_budget is None:
+        return "\n\n".join(entry["summary"] for entry in entries)
+
+    top_level = summary_levels[-1] if len(summary_levels) > 1 else []
+    separator_tokens = count_tokens("\n\n")
+    selected_positions = set()
+    used_tokens = 0
+    for candidates in [
+        range(len(top_level) - 1, -1, -1),
+        range(len(entries) - 1, len(top_level) - 1, -1),
+    ]:
+        for position in candidates:
+            entry_tokens = count_tokens(entries[position]["summary"])
+            if used_tokens + entry_tokens > token_budget:
+                break
+            selected_positions.add(position)
+            used_tokens += entry_tokens + separator_tokens
+
+    return "\n\n".join(
+        entry["summary"]
+        for position, entry in enumerate(entries)
+        if position in selected_positions
+    )
+
+
+def parse_sequence_number(str_id: str) -> int:
+    id_match = _STRING_ID_PATTERN.match(str_id)
+    return int(id_match.group(1)) if id_match else -1
+
+
+def _fsync_directory(directory: str) -> None:
+    if os.name != "posix":
+        return  # directories cannot be opened for fsync on Windows
+    directory_fd = os.open(directory or ".", os.O_RDONLY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+
+class TranscriptMemory:
+    """Chronological transcript of every character session in a SQLite table.
+
+    The transcript is the source of truth for the chat history. Each message is
+    numbered per session in conversation order, and the vector store documents
+    carry the same numbers as ids, so the vector index can always be rebuilt
+    from here.
+    """
+
+    def __init__(self, character_name: str, transcript_path: str | None = None):
+        self._TRANSCRIPT_PATH = transcript_path or (
+            "src/llm_agent_gui/history_logs/transcript.sqlite3"
+        )
+        self._lock = threading.Lock()
+        self.set_session(character_name=character_name)
+
+        os.makedirs(os.path.dirname(self._TRANSCRIPT_PATH) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(
+            self._TRANSCRIPT_PATH, check_same_thread=False
+        )
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                "session TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, "
+                "speaker TEXT NOT NULL, content TEXT NOT NULL, "
+                "created_at REAL NOT NULL, PRIMARY KEY (session, seq))"
+            )
+
+    def set_session(self, character_name: str) -> None:
+        self._session = character_name.replace(" ", "_")
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def save_new_lines(
+        self, new_lines: list[dict[str, str]], character_name: str, user_name: str
+    ) -> list[int]:
+        speakers = [
+            character_name if line["role"] == "assistant" else user_name
+            for line in new_lines
+        ]
+        with (
+            self._lock,
+            self._connection,
+            tracing.span("transcript.save", lines=len(new_lines)),
+        ):
+            first_seq = self._get_next_seq()
+            sequence_numbers = list(range(first_seq, first_seq + len(new_lines)))
+            now = time.time()
+            self._connection.executemany(
+                "INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (self._session, seq, line["role"], speaker, line["content"], now)
+                    for seq, line, speaker in zip(
+                        sequence_numbers, new_lines, speakers, strict=True
+                    )
+                ],
+            )
+
+        return sequence_numbers
+
+    def import_documents(
+        self, sequence_numbers: list[int], documents: list[str], character_name: str
+    ) -> None:
+        # Documents of the vector store are formatted as "Name: text"
+        rows = []
+        now = time.time()
+        for seq, document in zip(sequence_numbers, documents, strict=True):
+            speaker, _, content = document.partition(": ")
+            role = "assistant" if speaker == character_name else "user"
+            rows.append((self._session, seq, role, speaker, content, now))
+
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def is_empty(self) -> bool:
+        return self.message_count() == 0
+
+    def message_count(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM messages WHERE session = ?", (self._session,)
+            ).fetchone()[0]
+
+    def get_documents(self) -> tuple[list[int], list[str]]:
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT seq, speaker, content FROM messages WHERE session = ? "
+                "ORDER BY seq",
+                (self._session,),
+            ).fetchall()
+
+        return [seq for seq, _, _ in rows], [
+            speaker + ": " + content for _, speaker, content in rows
+        ]
+
+    def get_document_metadatas(self) -> list[dict[str, Any]]:
+        # The app session a line was said in is not recorded here
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT seq, role, created_at FROM messages WHERE session = ? "
+                "ORDER BY seq",
+                (self._session,),
+            ).fetchall()
+
+        return [
+            {"seq": seq, "role": role, "timestamp": created_at}
+            for seq, role, created_at in rows
+        ]
+
+    def get_full_chat_history(self) -> str:
+        _, documents = self.get_documents()
+        return format_chat_history(documents)
+
+    def get_chat_history_page(
+        self, before: int | None = None, limit: int = 50
+    ) -> tuple[str, int | None]:
+        """Return up to ``limit`` messages preceding message number ``before``.
+
+        Pages run from the most recent message backwards. The second value is
+        the cursor for the next older page, None once the start is reached.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT seq, speaker, content FROM messages "
+                "WHERE session = ? AND seq < ? ORDER BY seq DESC LIMIT ?",
+                (self._session, before if before is not None else 2**63 - 1, limit + 1),
+            ).fetchall()
+
+        has_older_messages = len(rows) > limit
+        page_rows = rows[:limit][::-1]
+        chat_messages = [speaker + ": " + content for _, speaker, content in page_rows]
+        next_cursor = page_rows[0][0] if has_older_messages else None
+
+        return format_chat_history(chat_messages), next_cursor
+
+    def reset_session(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM messages WHERE session = ?", (self._session,)
+            )
+
+    def _get_next_seq(self) -> int:
+        return self._connection.execute(
+            "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE session = ?",
+            (self._session,),
+        ).fetchone()[0]
 
 
 class VectorStoreMemory:
+    """Chroma collection of all messages of a character session.
+
+    New lines are queued and written behind the conversation by a worker thread,
+    which embeds them in batches of up to ``write_batch_size`` lines, or whatever
+    has queued up after ``write_batch_delay`` seconds. ``flush`` waits until all
+    of them are stored.
+
+    Retrieval fuses the dense query with a BM25 index of the session, which is
+    loaded from the collection once and then kept up to date as lines are
+    queued, so it already covers lines that are not embedded yet. The optional
+    reranker only runs if its estimated time fits the latency budget.
+
+    Every line is stored with its sequence number, role, timestamp and session
+    epoch as metadata. Lines stored before metadata existed have none and pass
+    every role filter.
+    """
+
     def __init__(
         self,
         num_query_results: int,
         character_name: str,
         vector_store_path: str | None = None,
+        write_batch_size: int = 16,
+        write_batch_delay: float = 0.5,
+        embedding_function: embeddings.EmbedTexts | None = None,
+        reranker: retrieval.CrossEncoderReranker | None = None,
+        retrieval_latency_budget: float = 0.05,
+        recency_half_life: float | None = None,
     ):
         self._VECTOR_STORE_PATH = vector_store_path or (
             "src/llm_agent_gui/history_logs/vectore_store"
         )
-        self.chroma_client = chromadb.PersistentClient(path=self._VECTOR_STORE_PATH)
+        # The client and collection are opened on first use, importing chromadb
+        # alone takes about a second
+        self._chroma_client: ClientAPI | None = None
+        self._collection: Collection | None = None
+        self._client_lock = threading.Lock()
+        self._next_id: int | None = None
+        self._id_lock = threading.Lock()
         self.num_query_results = num_query_results
+        # Documents and queries are embedded here rather than by Chroma's implicit
+        # default embedding function
+        self.embedding_function = (
+            embedding_function or embeddings.CachedEmbeddingFunction()
+        )
+
+        self.reranker = reranker
+        self.retrieval_latency_budget = retrieval_latency_budget
+        # Lines this many messages older than the latest one get half its boost
+        self.recency_half_life = recency_half_life
+        self._lexical_index: retrieval.Bm25Index | None = None
+        self._document_metadata: dict[int, dict[str, Any]] = {}
+        self._lexical_index_lock = threading.Lock()
+
+        self._write_batch_size = write_batch_size
+        self._write_batch_delay = write_batch_delay
+        self._pending_writes: list[tuple[str, str, dict[str, Any]]] = []
+        self._writing_batch: list[tuple[str, str, dict[str, Any]]] = []
+        self._write_error: Exception | None = None
+        self._flush_waiters = 0
+        self._write_condition = threading.Condition()
+        self._write_worker: threading.Thread | None = None
+        self._closed = False
+
         self.set_session(character_name=character_name)
 
+    @property
+    def chroma_client(self) -> "ClientAPI":
+        with self._client_lock:
+            if self._chroma_client is None:
+                import chromadb
+
+                self._chroma_client = chromadb.PersistentClient(
+                    path=self._VECTOR_STORE_PATH
+                )
+            return self._chroma_client
+
+    @property
+    def collection(self) -> "Collection":
+        return self.open_collection()
+
+    def open_collection(self) -> "Collection":
+        if self._collection is None:
+            self._collection = self.chroma_client.get_or_create_collection(
+                name=self._collection_name
+            )
+        return self._collection
+
+    @collection.setter
+    def collection(self, collection: "Collection") -> None:
+        self._collection = collection
+        self._next_id = None
+        self._lexical_index = None
+
     def set_session(self, character_name: str) -> None:
-        character_name_formatted = character_name.replace(" ", "_")
-        self.collection = self.chroma_client.get_or_create_collection(
-            name=character_name_formatted
-        )
+        self.flush()  # queued lines belong to the previous session
+        self._collection_name = character_name.replace(" ", "_")
+        self._collection = None
+        self._next_id = None
+        self._lexical_index = None
+        # Tells the lines of this app session apart from earlier ones
+        self._session_epoch = int(time.time())
+
+    def load_lexical_index(self) -> retrieval.Bm25Index:
+        with self._lexical_index_lock:
+            if self._lexical_index is None:
+                with self._write_condition:
+                    queued_lines = self._writing_batch + self._pending_writes
+                stored_messages = self.collection.get(
+                    include=["documents", "metadatas"]
+                )
+
+                lexical_index = retrieval.Bm25Index()
+                self._document_metadata = {}
+                for str_id, document, metadata in [
+                    *zip(
+                        stored_messages["ids"],
+                        stored_messages["documents"] or [],
+                        stored_messages["metadatas"] or [],
+                        strict=True,
+                    ),
+                    *queued_lines,
+                ]:
+                    doc_id = parse_sequence_number(str_id)
+                    lexical_index.add(doc_id, document)
+                    self._document_metadata[doc_id] = dict(metadata or {})
+                self._lexical_index = lexical_index
+            return self._lexical_index
 
     def save_initial_lines_as_vectors(
-        self, character_greeting: dict[str, str], character_name: str
+        self,
+        character_greeting: dict[str, str],
+        character_name: str,
+        sequence_numbers: list[int] | None = None,
     ) -> None:
         role_and_content_formatted = format_messages.format_vector_store_messages(
             character_greeting=character_greeting, character_name=character_name
         )
-        str_ids = self.create_string_ids(1)
-        self.collection.add(documents=role_and_content_formatted, ids=str_ids)
+        str_ids = self.create_string_ids(1, sequence_numbers)
+        self._queue_writes(str_ids, [role_and_content_formatted], ["assistant"])
 
     def save_new_lines_as_vectors(
-        self, new_lines: list[dict[str, str]], character_name: str, user_name: str
+        self,
+        new_lines: list[dict[str, str]],
+        character_name: str,
+        user_name: str,
+        sequence_numbers: list[int] | None = None,
     ) -> None:
         roles_and_contents_formatted = (
             format_messages.format_multiple_vector_store_messages(
@@ -169,38 +727,280 @@ class VectorStoreMemory:
                 user_name=user_name,
             )
         )
-        str_ids = self.create_string_ids(len(roles_and_contents_formatted))
-        self.collection.add(documents=roles_and_contents_formatted, ids=str_ids)
-
-    def retreive_related_information(self, user_message: str) -> list[str]:
-        results = self.collection.query(
-            query_texts=user_message,
-            n_results=self.num_query_results,
+        str_ids = self.create_string_ids(
+            len(roles_and_contents_formatted), sequence_numbers
+        )
+        self._queue_writes(
+            str_ids,
+            roles_and_contents_formatted,
+            [message["role"] for message in new_lines],
         )
 
-        return results["documents"][0]  # type: ignore
+    def retreive_related_information(
+        self,
+        user_message: str,
+        exclude_recent: int = 0,
+        roles: list[str] | None = None,
+    ) -> list[str]:
+        """Return the stored lines most related to ``user_message``.
+
+        ``exclude_recent`` skips the latest lines, e.g. the ones already in the
+        summary buffer, and ``roles`` restricts the results to lines of these
+        roles.
+        """
+        start = time.perf_counter()
+        candidate_count = self.num_query_results * _RETRIEVAL_CANDIDATES_PER_RESULT
+        lexical_index = self.load_lexical_index()
+        with self._id_lock:
+            next_id = self._get_next_id()
+        retrievable_before = next_id - exclude_recent
+
+        def is_retrievable(doc_id: int) -> bool:
+            role = self._document_metadata.get(doc_id, {}).get("role")
+            return doc_id < retrievable_before and (
+                roles is None or role is None or role in roles
+            )
+
+        # Filtered after the search, so each side fetches enough to fill up
+        fetch_count = candidate_count * (2 if roles else 1) + exclude_recent
+        lexical_ranking = [
+            doc_id
+            for doc_id, _ in lexical_index.search(user_message, fetch_count)
+            if is_retrievable(doc_id)
+        ][:candidate_count]
+        query_embeddings = self.embedding_function([user_message])
+        with tracing.span("vector_store.query", n_results=fetch_count):
+            results = self.collection.query(
+                query_embeddings=query_embeddings,
+                n_results=fetch_count,
+                include=["documents"],
+            )
+        dense_documents: list[str] = results["documents"][0]  # type: ignore
+        documents = {
+            doc_id: document
+            for doc_id, document in zip(
+                map(parse_sequence_number, results["ids"][0]),
+                dense_documents,
+                strict=True,
+            )
+            if is_retrievable(doc_id)
+        }
+        dense_ranking = list(documents)[:candidate_count]
+        for doc_id in lexical_ranking:
+            documents.setdefault(doc_id, lexical_index.get_document(doc_id))
+
+        recency_weights = None
+        if self.recency_half_life:
+            recency_weights = {
+                doc_id: 1 + 0.5 ** ((next_id - 1 - doc_id) / self.recency_half_life)
+                for doc_id in documents
+            }
+        fused_ranking = retrieval.reciprocal_rank_fusion(
+            [dense_ranking, lexical_ranking], weights=recency_weights
+        )
+        if self.reranker is not None:
+            rerank_candidates = fused_ranking[
+                : self.num_query_results * _RERANK_CANDIDATES_PER_RESULT
+            ]
+            remaining_seconds = self.retrieval_latency_budget - (
+                time.perf_counter() - start
+            )
+            if self.reranker.estimate_seconds(len(rerank_candidates)) <= (
+                remaining_seconds
+            ):
+                with tracing.span(
+                    "vector_store.rerank", documents=len(rerank_candidates)
+                ):
+                    reranked_order = self.reranker.rerank(
+                        user_message,
+                        [documents[doc_id] for doc_id in rerank_candidates],
+                    )
+                fused_ranking = [rerank_candidates[i] for i in reranked_order]
+
+        return [documents[doc_id] for doc_id in fused_ranking[: self.num_query_results]]
+
+    def pending(self) -> int:
+        with self._write_condition:
+            return len(self._pending_writes) + len(self._writing_batch)
+
+    def flush(self) -> None:
+        with self._write_condition:
+            self._flush_waiters += 1
+            self._write_condition.notify_all()
+            self._write_condition.wait_for(lambda: not self.pending())
+            self._flush_waiters -= 1
+            write_error, self._write_error = self._write_error, None
+        if write_error is not None:
+            raise write_error
+
+    def close(self) -> None:
+        """Store the queued lines and stop the writer thread."""
+        self.flush()
+        with self._write_condition:
+            self._closed = True
+            self._write_condition.notify_all()
+
+    def cached_document_count(self) -> int:
+        with self._lexical_index_lock:
+            return 0 if self._lexical_index is None else len(self._lexical_index)
+
+    def _queue_writes(
+        self, str_ids: list[str], documents: list[str], roles: list[str]
+    ) -> None:
+        now = time.time()
+        queued_lines = [
+            (
+                str_id,
+                document,
+                {
+                    "seq": parse_sequence_number(str_id),
+                    "role": role,
+                    "timestamp": now,
+                    "epoch": self._session_epoch,
+                },
+            )
+            for str_id, document, role in zip(str_ids, documents, roles, strict=True)
+        ]
+
+        with self._lexical_index_lock:
+            if self._lexical_index is not None:
+                for str_id, document, metadata in queued_lines:
+                    doc_id = parse_sequence_number(str_id)
+                    self._lexical_index.add(doc_id, document)
+                    self._document_metadata[doc_id] = metadata
+
+        with self._write_condition:
+            self._pending_writes += queued_lines
+            if self._write_worker is None:
+                self._write_worker = threading.Thread(
+                    target=self._write_queued_lines, daemon=True
+                )
+                self._write_worker.start()
+            self._write_condition.notify_all()
+
+    def _write_queued_lines(self) -> None:
+        while True:
+            with self._write_condition:
+                self._write_condition.wait_for(
+                    lambda: self._pending_writes or self._closed
+                )
+                if not self._pending_writes:
+                    self._write_worker = None
+                    return
+                # Gives further lines the chance to join the batch, flush and
+                # a full batch cut the wait short
+                self._write_condition.wait_for(
+                    lambda: (
+                        len(self._pending_writes) >= self._write_batch_size
+                        or self._flush_waiters > 0
+                    ),
+                    timeout=self._write_batch_delay,
+                )
+                self._writing_batch = self._pending_writes[: self._write_batch_size]
+                del self._pending_writes[: self._write_batch_size]
+
+            try:
+                documents = [document for _, document, _ in self._writing_batch]
+                with tracing.span("vector_store.add", documents=len(documents)):
+                    self.collection.add(
+                        ids=[str_id for str_id, _, _ in self._writing_batch],
+                        documents=documents,
+                        embeddings=self.embedding_function(documents),
+                        metadatas=[metadata for _, _, metadata in self._writing_batch],  # type: ignore
+                    )
+            except Exception as error:
+                self._write_error = error
+            finally:
+                with self._write_condition:
+                    self._writing_batch = []
+                    self._write_condition.notify_all()
+
+    def create_string_ids(
+        self, doc_count: int, sequence_numbers: list[int] | None = None
+    ) -> list[str]:
+        if sequence_numbers is not None:
+            # Numbered by the transcript, the counter only has to stay ahead
+            with self._id_lock:
+                self._next_id = max(self._get_next_id(), max(sequence_numbers) + 1)
+            int_ids = sequence_numbers
+        else:
+            with self._id_lock:
+                first_id = self._get_next_id()
+                self._next_id = first_id + doc_count
+            int_ids = list(range(first_id, first_id + doc_count))
 
-    def create_string_ids(self, doc_count: int) -> list[str]:
-        current_id_count = self.collection.count()
-        int_ids = list(range(current_id_count, current_id_count + doc_count))
         str_ids = list(map(lambda x: "id" + str(x), int_ids))
 
         return str_ids
 
+    def _get_next_id(self) -> int:
+        # The counter continues after the highest stored id, read once per
+        # session, so ids stay unique after deletes without a query per insert
+        if self._next_id is None:
+            stored_ids = self.collection.get(include=[])["ids"]
+            self._next_id = max(map(parse_sequence_number, stored_ids), default=-1) + 1
+        return self._next_id
+
     def reset_collection(self, character_session: str) -> None:
-        if character_session in [c.name for c in self.chroma_client.list_collections()]:
-            message_ids = self.collection.get()["ids"]
-            self.collection.delete(message_ids)
+        self.flush()
         formatted_character_name = character_session.replace(" ", "_")
+        # Dropped instead of emptied so a new embedding dimension also fits
+        collection_names = [c.name for c in self.chroma_client.list_collections()]
+        if formatted_character_name in collection_names:
+            self.chroma_client.delete_collection(formatted_character_name)
         self.collection = self.chroma_client.get_or_create_collection(
             name=formatted_character_name
         )
 
-    def get_full_chat_history(self) -> str:
-        chat_messages = self.collection.get()["documents"]
-        chat_history_str = ""
-        if chat_messages:
-            for line in chat_messages:
-                chat_history_str += line.capitalize() + "\n\n"
+    def rebuild_from_transcript(
+        self,
+        transcript_memory: TranscriptMemory,
+        character_name: str,
+        batch_size: int = 256,
+    ) -> None:
+        """Replace the collection with freshly embedded transcript messages."""
+        # Sessions recorded before the transcript store only exist as vectors,
+        # they are copied over first so the reset does not lose them
+        sequence_numbers, documents = self.get_stored_documents()
+        transcript_memory.import_documents(
+            sequence_numbers=sequence_numbers,
+            documents=documents,
+            character_name=character_name,
+        )
+
+        self.reset_collection(self._collection_name)
+        sequence_numbers, documents = transcript_memory.get_documents()
+        metadatas = transcript_memory.get_document_metadatas()
+        for start in range(0, len(documents), batch_size):
+            batch_sequence_numbers = sequence_numbers[start : start + batch_size]
+            batch_documents = documents[start : start + batch_size]
+            self.collection.add(
+                documents=batch_documents,
+                metadatas=metadatas[start : start + batch_size],  # type: ignore
+                embeddings=self.embedding_function(batch_documents),
+                ids=self.create_string_ids(
+                    len(batch_sequence_numbers), batch_sequence_numbers
+                ),
+            )
+
+    def get_stored_documents(self) -> tuple[list[int], list[str]]:
+        self.flush()
+        stored_messages = self.collection.get(include=["documents"])
+        sequence_numbers_and_documents = sorted(
+            zip(
+                map(parse_sequence_number, stored_messages["ids"]),
+                stored_messages["documents"] or [],
+                strict=True,
+            )
+        )
+        return [seq for seq, _ in sequence_numbers_and_documents], [
+            document for _, document in sequence_numbers_and_documents
+        ]
+
+
+def format_chat_history(chat_messages: list[str]) -> str:
+    chat_history_str = ""
+    for line in chat_messages:
+        chat_history_str += line.capitalize() + "\n\n"
 
-        return chat_history_str
+    return chat_history_str
@@ -0,0 +1,187 @@
+from collections.abc import Callable
+
+from src.llm_agent_gui.utils import format_messages, prompts
+
+# Role markers and separators the chat format adds around every message
+_MESSAGE_TOKEN_OVERHEAD = 4
+
+
+class PromptBuilder:
+    """Assembles chat prompts that fit into the model's context window.
+
+    The window minus the tokens reserved for the answer is split between the
+    sections. Instructions and the user message are always included, trimmed
+    only if either alone would take more than ``max_required_share`` of the
+    budget. The summary and the related information get at most their share,
+    and the recent turns fill whatever is left, newest first. Trimming only
+    depends on the token counts, so identical input always gives the same
+    prompt.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        context_window: int,
+        response_token_reserve: int = 512,
+        summary_share: float = 0.25,
+        related_information_share: float = 0.15,
+        max_required_share: float = 0.25,
+    ) -> None:
+        self._count_tokens = count_tokens
+        self.prompt_token_budget = context_window - response_token_reserve
+        self._summary_share = summary_share
+        self._related_information_share = related_information_share
+        self._max_required_share = max_required_share
+
+    @property
+    def summary_token_budget(self) -> int:
+        """Tokens left for the summary text in its share of the budget."""
+        summary_budget = int(self.prompt_token_budget * self._summary_share)
+        # The template's own tokens count into the share
+        template_tokens = self._count_message_tokens(
+            prompts.prepare_summary_context_prompt(current_summary="")
+        )
+        return summary_budget - template_tokens
+
+    def build(
+        self,
+        user_message: str,
+        recent_messages: list[dict[str, str]],
+        instructions: str | None = None,
+        summary: str | None = None,
+        related_information: list[str] | None = None,
+    ) -> tuple[list[dict[str, str]], dict[str, int]]:
+        """Return the prompt and its token count per section.
+
+        The prompt is ordered [instructions, summary] + recent messages +
+        [related information, user message], keeping the sections that change
+        least at the front for prompt prefix caching.
+        """
+        max_required_tokens = int(self.prompt_token_budget * self._max_required_share)
+
+        user_message = self._truncate(user_message, max_required_tokens)
+        user_message_tokens = self._count_message_tokens(user_message)
+
+        stable_prefix = []
+        instructions_tokens = 0
+        if instructions is not None:
+            instructions = self._truncate(instructions, max_required_tokens)
+            instructions_tokens = self._count_message_tokens(instructions)
+            stable_prefix.append(instructions)
+
+        summary_tokens = 0
+        if summary is not None:
+            summary_message = prompts.prepare_summary_context_prompt(
+                current_summary=self._truncate(
+                    summary, self.summary_token_budget, keep_end=True
+                )
+            )
+            summary_tokens = self._count_message_tokens(summary_message)
+            stable_prefix.append(summary_message)
+
+        related_information_message = None
+        related_information_tokens = 0
+        if related_information:
+            related_information_budget = int(
+                self.prompt_token_budget * self._related_information_share
+            )
+            included_lines: list[str] = []
+            for line in related_information:
+                candidate_message = prompts.prepare_related_information_prompt(
+                    context_sentences=included_lines + [line]
+                )
+                candidate_tokens = self._count_message_tokens(candidate_message)
+                if candidate_tokens > related_information_budget:
+                    break
+                included_lines.append(line)
+                related_information_message = candidate_message
+                related_information_tokens = candidate_tokens
+
+        recent_turns_budget = self.prompt_token_budget - (
+            user_message_tokens
+            + instructions_tokens
+            + summary_tokens
+            + related_information_tokens
+        )
+        included_messages: list[dict[str, str]] = []
+        recent_turns_tokens = 0
+        for message in reversed(recent_messages):
+            message_tokens = self._count_message_tokens(message["content"])
+            if recent_turns_tokens + message_tokens > recent_turns_budget:
+                if not included_messages:
+                    # The latest turn is kept in part rather than dropped
+                    message = format_messages.assign_role_to_message(
+                        role=message["role"],
+                        message=self._truncate(
+                            message["content"],
+                            recent_turns_budget - _MESSAGE_TOKEN_OVERHEAD,
+                            keep_end=True,
+                        ),
+                    )
+                    message_tokens = self._count_message_tokens(message["content"])
+                    included_messages.append(message)
+                    recent_turns_tokens += message_tokens
+                break
+            included_messages.append(message)
+            recent_turns_tokens += message_tokens
+        included_messages.reverse()
+
+        chat_prompt = (
+            format_messages.assign_multiple_roles_to_messages(
+                roles=["system"] * len(stable_prefix), messages=stable_prefix
+            )
+            + included_messages
+        )
+        if related_information_message is not None:
+            chat_prompt.append(
+                format_messages.assign_role_to_message(
+                    role="system", message=related_information_message
+                )
+            )
+        chat_prompt.append(
+            format_messages.assign_role_to_message(role="user", message=user_message)
+        )
+
+        token_breakdown = {
+            "instructions": instructions_tokens,
+            "summary": summary_tokens,
+            "related_information": related_information_tokens,
+            "recent_turns": recent_turns_tokens,
+            "user_message": user_message_tokens,
+            "dropped_messages": len(recent_messages) - len(included_messages),
+        }
+        token_breakdown["total"] = (
+            instructions_tokens
+            + summary_tokens
+            + related_information_tokens
+            + recent_turns_tokens
+            + user_message_tokens
+        )
+        return chat_prompt, token_breakdown
+
+    def _count_message_tokens(self, content: str) -> int:
+        return self._count_tokens(content) + _MESSAGE_TOKEN_OVERHEAD
+
+    def _truncate(self, text: str, max_tokens: int, keep_end: bool = False) -> str:
+        if self._count_tokens(text) <= max_tokens:
+            return text
+        if max_tokens <= 0:
+            return ""
+
+        # Longest run of whole words from the kept end that fits
+        words = text.split(" ")
+        fitting_word_count, too_many_word_count = 0, len(words)
+        while too_many_word_count - fitting_word_count > 1:
+            word_count = (fitting_word_count + too_many_word_count) // 2
+            kept_words = words[-word_count:] if keep_end else words[:word_count]
+            if self._count_tokens(" ".join(kept_words)) <= max_tokens:
+                fitting_word_count = word_count
+            else:
+                too_many_word_count = word_count
+
+        if fitting_word_count == 0:
+            return ""
+        kept_words = (
+            words[-fitting_word_count:] if keep_end else words[:fitting_word_count]
+        )
+        return " ".join(kept_words)
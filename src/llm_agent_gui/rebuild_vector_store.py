@@ -0,0 +1,43 @@
+"""Rebuild the vector store of character sessions from their transcripts.
+
+The transcript is the source of truth, so the vector index can be dropped and
+re-embedded at any time, e.g. after switching the embedding model with the
+EMBEDDING_* env vars. Run from the repository root while the app is closed:
+
+    uv run python -m src.llm_agent_gui.rebuild_vector_store [character ...]
+"""
+
+import argparse
+import sys
+
+from src.llm_agent_gui import embeddings, memory
+from src.llm_agent_gui.utils import character_sessions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "characters",
+        nargs="*",
+        help="characters to rebuild, all characters if omitted",
+    )
+    args = parser.parse_args()
+
+    character_names = args.characters or list(character_sessions.get_character_list())
+    embedding_function = embeddings.create_embedding_function()
+    for character_name in character_names:
+        transcript_memory = memory.TranscriptMemory(character_name=character_name)
+        vector_store_memory = memory.VectorStoreMemory(
+            num_query_results=2,
+            character_name=character_name,
+            embedding_function=embedding_function,
+        )
+        vector_store_memory.rebuild_from_transcript(
+            transcript_memory, character_name=character_name
+        )
+        print(f"{character_name}: {transcript_memory.message_count()} messages")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
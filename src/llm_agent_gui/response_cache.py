@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+
+
+def make_cache_key(
+    backend: str, model: str, sampling_params: dict[str, Any], prompt: list[Any]
+) -> str:
+    # Whitespace differences in otherwise identical prompts map to the same key
+    normalized_prompt = [
+        {"role": message["role"], "content": " ".join(message["content"].split())}
+        for message in prompt
+    ]
+    key_material = json.dumps(
+        [backend, model, sampling_params, normalized_prompt],
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(key_material.encode()).hexdigest()
+
+
+class ResponseCache:
+    """On-disk LLM response cache with a time to live and a size limit.
+
+    Entries expire ``ttl_seconds`` after they were written, and once more than
+    ``max_entries`` are stored the least recently read ones are evicted.
+    """
+
+    def __init__(
+        self, cache_path: str, ttl_seconds: float | None, max_entries: int
+    ) -> None:
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+        self._connection = sqlite3.connect(cache_path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "created_at REAL NOT NULL, last_read_at REAL NOT NULL)"
+            )
+            self._connection.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_read_at "
+                "ON responses (last_read_at)"
+            )
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+
+            response, created_at = row
+            if self._ttl_seconds is not None and now - created_at > self._ttl_seconds:
+                self._connection.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+
+            self._connection.execute(
+                "UPDATE responses SET last_read_at = ? WHERE key = ?", (now, key)
+            )
+            return response
+
+    def put(self, key: str, response: str) -> None:
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            )
+            if self._ttl_seconds is not None:
+                self._connection.execute(
+                    "DELETE FROM responses WHERE created_at < ?",
+                    (now - self._ttl_seconds,),
+                )
+            self._connection.execute(
+                "DELETE FROM responses WHERE key IN ("
+                "SELECT key FROM responses ORDER BY last_read_at DESC "
+                "LIMIT -1 OFFSET ?)",
+                (self._max_entries,),
+            )
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM responses")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute(
+                "SELECT COUNT(*) FROM responses"
+            ).fetchone()[0]
@@ -0,0 +1,171 @@
+import heapq
+import math
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Any
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+# Words in more than this share of the documents (names, "the", "you", ...) say
+# little about relevance but have the longest postings, so larger indexes skip
+# them to keep searches in the low milliseconds
+_MAX_DOCUMENT_FREQUENCY = 0.25
+_MIN_DOCUMENTS_FOR_FREQUENCY_CUTOFF = 1000
+
+
+def tokenize(text: str) -> list[str]:
+    return _WORD_PATTERN.findall(text.lower())
+
+
+class Bm25Index:
+    """Incrementally maintained BM25 index over numbered documents."""
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75) -> None:
+        self._k1 = k1
+        self._b = b
+        self._postings: dict[str, dict[int, int]] = defaultdict(dict)
+        self._documents: dict[int, str] = {}
+        self._document_lengths: dict[int, int] = {}
+        self._total_length = 0
+        self._lock = threading.Lock()
+
+    def add(self, doc_id: int, document: str) -> None:
+        with self._lock:
+            self._remove(doc_id)
+            terms = tokenize(document)
+            for term, term_frequency in Counter(terms).items():
+                self._postings[term][doc_id] = term_frequency
+            self._documents[doc_id] = document
+            self._document_lengths[doc_id] = len(terms)
+            self._total_length += len(terms)
+
+    def remove(self, doc_id: int) -> None:
+        with self._lock:
+            self._remove(doc_id)
+
+    def get_document(self, doc_id: int) -> str | None:
+        with self._lock:
+            return self._documents.get(doc_id)
+
+    def search(self, query: str, limit: int) -> list[tuple[int, float]]:
+        with self._lock:
+            document_count = len(self._documents)
+            if document_count == 0:
+                return []
+            average_length = self._total_length / document_count
+
+            scores: dict[int, float] = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                document_frequency = len(postings)
+                if (
+                    document_count >= _MIN_DOCUMENTS_FOR_FREQUENCY_CUTOFF
+                    and document_frequency > document_count * _MAX_DOCUMENT_FREQUENCY
+                ):
+                    continue
+
+                idf = math.log(
+                    1
+                    + (document_count - document_frequency + 0.5)
+                    / (document_frequency + 0.5)
+                )
+                for doc_id, term_frequency in postings.items():
+                    length_norm = (
+                        1
+                        - self._b
+                        + self._b * (self._document_lengths[doc_id] / average_length)
+                    )
+                    scores[doc_id] += (
+                        idf
+                        * term_frequency
+                        * (self._k1 + 1)
+                        / (term_frequency + self._k1 * length_norm)
+                    )
+
+        return heapq.nlargest(limit, scores.items(), key=lambda item: item[1])
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._documents)
+
+    def _remove(self, doc_id: int) -> None:
+        document = self._documents.pop(doc_id, None)
+        if document is None:
+            return
+
+        for term in set(tokenize(document)):
+            self._postings[term].pop(doc_id, None)
+            if not self._postings[term]:
+                del self._postings[term]
+        self._total_length -= self._document_lengths.pop(doc_id)
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[int]], k: int = 60, weights: dict[int, float] | None = None
+) -> list[int]:
+    fused_scores: dict[int, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            fused_scores[doc_id] += 1 / (k + rank + 1)
+    if weights is not None:
+        for doc_id in fused_scores:
+            fused_scores[doc_id] *= weights.get(doc_id, 1.0)
+
+    return sorted(fused_scores, key=lambda doc_id: fused_scores[doc_id], reverse=True)
+
+
+class CrossEncoderReranker:
+    """Reorders retrieval candidates with a small cross-encoder.
+
+    The model loads on first use. ``estimate_seconds`` extrapolates from the
+    previous reranks, so callers can skip reranking that would not fit their
+    latency budget.
+    """
+
+    def __init__(
+        self, model_name: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    ) -> None:
+        self.model_name = model_name
+        self._model: Any = None
+        self._model_lock = threading.Lock()
+        self._seconds_per_document: float | None = None
+
+    def warm_up(self) -> None:
+        self._get_model()
+
+    def estimate_seconds(self, document_count: int) -> float:
+        if self._seconds_per_document is None:
+            return 0.0
+        return self._seconds_per_document * document_count
+
+    def rerank(self, query: str, documents: list[str]) -> list[int]:
+        model = self._get_model()  # loading must not count into the estimate
+        start = time.perf_counter()
+        scores = model.predict([(query, document) for document in documents])
+        seconds_per_document = (time.perf_counter() - start) / max(len(documents), 1)
+        # Smoothed, so single slow calls barely move the estimate
+        self._seconds_per_document = (
+            seconds_per_document
+            if self._seconds_per_document is None
+            else 0.8 * self._seconds_per_document + 0.2 * seconds_per_document
+        )
+
+        return sorted(range(len(documents)), key=lambda i: scores[i], reverse=True)
+
+    def _get_model(self) -> Any:
+        with self._model_lock:
+            if self._model is None:
+                try:
+                    from sentence_transformers import CrossEncoder
+                except ImportError as error:
+                    raise ImportError(
+                        "Reranking needs sentence-transformers. Install it with:\n"
+                        "  uv pip install sentence-transformers\n"
+                        "Or leave RETRIEVAL_RERANKER_MODEL unset."
+                    ) from error
+                self._model = CrossEncoder(self.model_name, device="cpu")
+            return self._model
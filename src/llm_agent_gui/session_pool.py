@@ -0,0 +1,90 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Callable
+
+from src.llm_agent_gui import agent
+
+
+class SessionPool:
+    """Agents of recently used characters, kept warm for switching back.
+
+    Each agent keeps its character's summary and buffer, vector store
+    collection, lexical index and prompts loaded. Beyond ``max_sessions``
+    agents, or while the agents together cache more than
+    ``max_cached_documents`` lines, the least recently used ones are closed
+    whenever an agent is requested. The agent returned last is never evicted.
+    Evicted agents are handed to ``close_evicted_session``, which closes them
+    right away by default.
+    """
+
+    def __init__(
+        self,
+        create_session: Callable[[str], agent.Agent],
+        max_sessions: int = 3,
+        max_cached_documents: int | None = None,
+        close_evicted_session: Callable[[agent.Agent], None] | None = None,
+    ) -> None:
+        self._create_session = create_session
+        self._max_sessions = max_sessions
+        self._max_cached_documents = max_cached_documents
+        self._close_evicted_session = close_evicted_session or _close_session
+        self._sessions: OrderedDict[str, agent.Agent] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, character_name: str) -> agent.Agent:
+        with self._lock:
+            if character_name not in self._sessions:
+                self._sessions[character_name] = self._create_session(character_name)
+            self._sessions.move_to_end(character_name)
+            session = self._sessions[character_name]
+            evicted_sessions = self._evict()
+
+        # Closing waits for pending summaries and writes, so outside the lock
+        for evicted_session in evicted_sessions:
+            self._close_evicted_session(evicted_session)
+        return session
+
+    def put(self, character_name: str, session: agent.Agent) -> None:
+        with self._lock:
+            self._sessions[character_name] = session
+            self._sessions.move_to_end(character_name)
+            evicted_sessions = self._evict()
+
+        for evicted_session in evicted_sessions:
+            self._close_evicted_session(evicted_session)
+
+    def close(self) -> None:
+        with self._lock:
+            sessions = list(self._sessions.values())
+            self._sessions.clear()
+        for session in sessions:
+            session.close()
+
+    def __contains__(self, character_name: str) -> bool:
+        with self._lock:
+            return character_name in self._sessions
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def _evict(self) -> list[agent.Agent]:
+        evicted_sessions = []
+        while len(self._sessions) > 1 and (
+            len(self._sessions) > self._max_sessions
+            or (
+                self._max_cached_documents is not None
+                and sum(
+                    session.cached_document_count()
+                    for session in self._sessions.values()
+                )
+                > self._max_cached_documents
+            )
+        ):
+            _, session = self._sessions.popitem(last=False)
+            evicted_sessions.append(session)
+        return evicted_sessions
+
+
+def _close_session(session: agent.Agent) -> None:
+    session.close()
@@ -0,0 +1,102 @@
+import contextlib
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+from collections import deque
+from collections.abc import Iterator
+from typing import Any
+
+_current_turn: contextvars.ContextVar[int | None] = contextvars.ContextVar(
+    "current_turn", default=None
+)
+_turn_ids = itertools.count(1)
+
+
+class Tracer:
+    """Keeps the latest spans in a ring buffer.
+
+    A span is a dict with its name, the turn it belongs to, the thread it ran
+    on, its wall clock start, its duration in seconds and free-form attributes.
+    Spans opened inside ``turn()`` belong to that turn, also in threads started
+    with a copy of its context.
+    """
+
+    def __init__(self, capacity: int = 2048) -> None:
+        self._spans: deque[dict[str, Any]] = deque(maxlen=capacity)
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(
+        self, name: str, turn: int | None = None, **attributes: Any
+    ) -> Iterator[dict[str, Any]]:
+        span = {
+            "name": name,
+            "turn": turn if turn is not None else _current_turn.get(),
+            "thread": threading.current_thread().name,
+            "start": time.time(),
+            "duration": None,
+            "attributes": attributes,
+        }
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as error:
+            span["attributes"]["error"] = type(error).__name__
+            raise
+        finally:
+            span["duration"] = time.perf_counter() - start
+            with self._lock:
+                self._spans.append(span)
+
+    def get_spans(self, turn: int | None = None) -> list[dict[str, Any]]:
+        with self._lock:
+            return [
+                span for span in self._spans if turn is None or span["turn"] == turn
+            ]
+
+    def export_jsonl(self, path: str) -> int:
+        spans = self.get_spans()
+        with open(path, "a") as f:
+            for span in spans:
+                f.write(json.dumps(span, default=str) + "\n")
+        return len(spans)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._spans.clear()
+
+
+tracer = Tracer(capacity=int(os.getenv("TRACING_BUFFER_SIZE", "2048")))
+
+
+def span(
+    name: str, turn: int | None = None, **attributes: Any
+) -> contextlib.AbstractContextManager[dict[str, Any]]:
+    return tracer.span(name, turn=turn, **attributes)
+
+
+@contextlib.contextmanager
+def turn() -> Iterator[int]:
+    turn_id = next(_turn_ids)
+    token = _current_turn.set(turn_id)
+    try:
+        yield turn_id
+    finally:
+        _current_turn.reset(token)
+
+
+def format_spans(spans: list[dict[str, Any]]) -> str:
+    lines = []
+    for span in spans:
+        attributes = span["attributes"]
+        line = f"{span['name']:<32}{span['duration'] * 1000:>9.1f} ms"
+        if "time_to_first_token" in attributes:
+            first_token_ms = attributes["time_to_first_token"] * 1000
+            line += f"  first token {first_token_ms:.1f} ms"
+        if "tokens" in attributes:
+            line += f"  {attributes['tokens']} tokens"
+        lines.append(line)
+    return "\n".join(lines)
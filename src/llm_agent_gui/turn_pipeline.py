@@ -0,0 +1,71 @@
+import queue
+import threading
+from collections.abc import Callable
+from typing import Any
+
+EmitEvent = Callable[[str, Any], None]
+TurnJob = Callable[[EmitEvent], None]
+
+
+class TurnPipeline:
+    """Runs turn jobs one after another on a worker thread.
+
+    Jobs report progress by emitting ``(event, payload)`` tuples, which the Tk
+    main loop collects with ``get_events`` from an ``after()`` callback. Widgets
+    must only be touched from the main loop, never from inside a job.
+    """
+
+    def __init__(self) -> None:
+        self._jobs: queue.Queue[TurnJob | None] = queue.Queue()
+        self._events: queue.Queue[tuple[str, Any]] = queue.Queue()
+        self._pending_jobs = 0
+        self._pending_lock = threading.Lock()
+
+        self._worker = threading.Thread(target=self._run_jobs, daemon=True)
+        self._worker.start()
+
+    def submit(self, job: TurnJob) -> None:
+        with self._pending_lock:
+            self._pending_jobs += 1
+        self._jobs.put(job)
+
+    def pending(self) -> int:
+        with self._pending_lock:
+            return self._pending_jobs
+
+    def is_busy(self) -> bool:
+        return self.pending() > 0
+
+    def get_events(self) -> list[tuple[str, Any]]:
+        events = []
+        while True:
+            try:
+                events.append(self._events.get_nowait())
+            except queue.Empty:
+                return events
+
+    def wait_until_idle(self) -> None:
+        self._jobs.join()
+
+    def shutdown(self) -> None:
+        self._jobs.put(None)
+        self._worker.join()
+
+    def _emit(self, event: str, payload: Any = None) -> None:
+        self._events.put((event, payload))
+
+    def _run_jobs(self) -> None:
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                self._jobs.task_done()
+                return
+
+            try:
+                job(self._emit)
+            except Exception as error:
+                self._emit("error", error)
+            finally:
+                with self._pending_lock:
+                    self._pending_jobs -= 1
+                self._jobs.task_done()
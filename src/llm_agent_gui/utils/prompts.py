@@ -13,19 +13,26 @@ def prepare_initial_system_prompt(character, user_name: str) -> str:
     return prompt
 
 
-_SUMMARIZER_SYSTEM_TEMPLATE = "Progressively summarize the new lines of conversation. Use the provided current summary and the new lines of conversation to create an updated summary.\n"
+_CHUNK_SUMMARIZER_SYSTEM_TEMPLATE = "Summarize the new lines of conversation. The summary of the preceding lines is only context, do not repeat it in your summary.\n"
 
-_SUMMARIZER_USER_TEMPLATE = """Current summary:
-{current_summary}
+_CHUNK_SUMMARIZER_USER_TEMPLATE = """Summary of the preceding lines:
+{previous_summary}
 
 New lines of conversation:
 {new_lines}
 
-Updated summary:"""
+Summary of the new lines:"""
 
+_SUMMARY_ROLLUP_SYSTEM_TEMPLATE = "Combine the consecutive summaries of a conversation into one shorter summary. Keep the facts that matter for the rest of the conversation.\n"
 
-def prepare_summarizer_prompt(
-    current_summary: str,
+_SUMMARY_ROLLUP_USER_TEMPLATE = """Consecutive summaries, oldest first:
+{summaries}
+
+Combined summary:"""
+
+
+def prepare_chunk_summarizer_prompt(
+    previous_summary: str,
     new_messages: list[dict[str, str]],
     character_name: str,
     user_name: str,
@@ -43,11 +50,12 @@ def prepare_summarizer_prompt(
             new_messages_formatted += message["role"] + ": " + message["content"] + "\n"
 
     summary_prompt = [
-        {"role": "system", "content": _SUMMARIZER_SYSTEM_TEMPLATE},
+        {"role": "system", "content": _CHUNK_SUMMARIZER_SYSTEM_TEMPLATE},
         {
             "role": "user",
-            "content": _SUMMARIZER_USER_TEMPLATE.format(
-                current_summary=current_summary, new_lines=new_messages_formatted
+            "content": _CHUNK_SUMMARIZER_USER_TEMPLATE.format(
+                previous_summary=previous_summary or "None yet.",
+                new_lines=new_messages_formatted,
             ),
         },
     ]
@@ -55,40 +63,60 @@ def prepare_summarizer_prompt(
     return summary_prompt
 
 
+def prepare_summary_rollup_prompt(summaries: list[str]) -> list[dict[str, str]]:
+    return [
+        {"role": "system", "content": _SUMMARY_ROLLUP_SYSTEM_TEMPLATE},
+        {
+            "role": "user",
+            "content": _SUMMARY_ROLLUP_USER_TEMPLATE.format(
+                summaries="\n\n".join(summaries)
+            ),
+        },
+    ]
+
+
 _SYSTEM_CHAT_TEMPLATE = """You are roleplaying as the character {character_name} from the {platform_type} {platform_name}. Use the following information to continue the roleplay conversation between you and the user.
 
 Roleplay instruction rules:
 {roleplay_instructions}
+"""
 
-Use the following summary of the conversation so far as context:
+_SUMMARY_CONTEXT_TEMPLATE = """Use the following summary of the conversation so far as context:
 {current_summary}
+"""
 
-Additionally, use the following related messages as context:
+_RELATED_INFORMATION_TEMPLATE = """Additionally, use the following related messages as context:
 {related_information}
 """
 
 
-def prepare_system_chat_prompt(
-    character,
-    system_message: str,
-    current_summary: str,
-    context_sentences: str | list[Any],
-) -> str:
-    context_sentences_formatted = ""
-
-    for sentence in context_sentences:
-        context_sentences_formatted += sentence + "\n"
-
+# The chat prompt is split so that its stable parts form a prefix: instructions
+# never change for a character, the summary only on rollover, while related
+# information changes every turn and goes right before the user message.
+def prepare_system_chat_prompt(character, system_message: str) -> str:
     return _SYSTEM_CHAT_TEMPLATE.format(
         roleplay_instructions=system_message,
-        current_summary=current_summary,
-        related_information=context_sentences_formatted,
         character_name=character.name,
         platform_type=character.platform_type,
         platform_name=character.platform_name,
     )
 
 
+def prepare_summary_context_prompt(current_summary: str) -> str:
+    return _SUMMARY_CONTEXT_TEMPLATE.format(current_summary=current_summary)
+
+
+def prepare_related_information_prompt(context_sentences: str | list[Any]) -> str:
+    context_sentences_formatted = ""
+
+    for sentence in context_sentences:
+        context_sentences_formatted += sentence + "\n"
+
+    return _RELATED_INFORMATION_TEMPLATE.format(
+        related_information=context_sentences_formatted
+    )
+
+
 _GAME_START_PROMPT = """The user wants to play the game {game} with you and started a session right now. Do not draw the board visually, keep everything in plain text. You will make the first move in the game. For that, use the following rules to play the game with him:
 
 Roleplay instruction rules:
@@ -0,0 +1,253 @@
+import os
+import threading
+import time
+from collections.abc import Iterator
+from tempfile import TemporaryDirectory
+from typing import Any
+
+import pytest
+
+from src.llm_agent_gui import agent, embeddings, llm_backend
+from src.llm_agent_gui.utils import character_sessions
+
+CHARACTER_NAME = next(iter(character_sessions.get_character_list()))
+
+
+def embed_by_length(texts: list[str]) -> list[list[float]]:
+    # Stands in for the embedding model, which has to be downloaded
+    return [[float(len(text)), 1.0] for text in texts]
+
+
+class StubLlmBackend(llm_backend.LlmBackend):
+    """OpenAI backend answering with a fixed reply, without any request."""
+
+    def __init__(self) -> None:
+        super().__init__("openai")
+
+    def load_openai(self) -> Any:
+        return None
+
+    def load_classifier(self) -> Any:
+        return lambda texts, **kwargs: [[{"label": "joy", "score": 1.0}] for _ in texts]
+
+    def inference_openai(self, prompt: list[Any]) -> str:
+        return "General Kenobi"
+
+    def stream_openai(self, prompt: list[Any]) -> Iterator[str]:
+        yield from ["General ", "Kenobi"]
+
+
+@pytest.fixture
+def character_agent() -> Iterator[agent.Agent]:
+    with TemporaryDirectory() as tmpdir:
+        character_agent = agent.Agent(
+            character_name=CHARACTER_NAME,
+            llm=StubLlmBackend(),
+            embedding_function=embeddings.CachedEmbeddingFunction(
+                embed_texts=embed_by_length
+            ),
+            history_directory=tmpdir,
+        )
+        yield character_agent
+        character_agent.close()
+
+
+@pytest.fixture
+def ongoing_chat(character_agent: agent.Agent, monkeypatch) -> agent.Agent:
+    character_agent.summary_buffer_memory.save_initial_buffer_on_disk(
+        [{"role": "assistant", "content": "Hello there!"}]
+    )
+    character_agent.summary_buffer_memory.save_new_summary_on_disk("We met yesterday.")
+    character_agent.is_new_chat = False
+    monkeypatch.setattr(
+        character_agent.vector_store_memory,
+        "retreive_related_information",
+        lambda user_message, exclude_recent: [f"related to {user_message}"],
+    )
+    return character_agent
+
+
+class TestAgent:
+    def test_response_cache_is_stored_in_history_directory(self, monkeypatch):
+        monkeypatch.setenv("LLM_BACKEND", "openai")
+        monkeypatch.setenv("LLM_RESPONSE_CACHE", "true")
+
+        with TemporaryDirectory() as tmpdir:
+            character_agent = agent.Agent(
+                character_name=CHARACTER_NAME,
+                embedding_function=embed_by_length,
+                history_directory=tmpdir,
+            )
+
+            assert character_agent.llm.response_cache is not None
+            assert os.path.exists(os.path.join(tmpdir, "response_cache.sqlite3"))
+            character_agent.close()
+
+
+class TestPromptSpeculation:
+    @pytest.fixture
+    def loaded_messages(self, ongoing_chat: agent.Agent, monkeypatch) -> list[str]:
+        loaded_messages = []
+        load_prompt_context = ongoing_chat.load_prompt_context
+
+        def record_load_prompt_context(user_message):
+            loaded_messages.append(user_message)
+            return load_prompt_context(user_message)
+
+        monkeypatch.setattr(
+            ongoing_chat, "load_prompt_context", record_load_prompt_context
+        )
+        return loaded_messages
+
+    def test_matching_draft_is_reused(
+        self, ongoing_chat: agent.Agent, loaded_messages: list[str]
+    ):
+        ongoing_chat.prepare_prompt_speculatively(draft_message="Hello")
+
+        (summary, last_messages, related_information), stage_timings = (
+            ongoing_chat.take_prompt_context(user_message="Hello")
+        )
+
+        assert loaded_messages == ["Hello"]
+        assert summary == "We met yesterday."
+        assert last_messages == [{"role": "assistant", "content": "Hello there!"}]
+        assert related_information == ["related to Hello"]
+        assert "speculation_wait" in stage_timings
+
+    def test_mismatched_draft_is_discarded(
+        self, ongoing_chat: agent.Agent, loaded_messages: list[str]
+    ):
+        ongoing_chat.prepare_prompt_speculatively(draft_message="Hel")
+
+        (_, _, related_information), stage_timings = ongoing_chat.take_prompt_context(
+            user_message="Hello"
+        )
+
+        assert loaded_messages[-1] == "Hello"
+        assert related_information == ["related to Hello"]
+        assert "speculation_wait" not in stage_timings
+
+    def test_failed_speculation_falls_back_to_fresh_load(
+        self, ongoing_chat: agent.Agent, monkeypatch
+    ):
+        load_prompt_context = ongoing_chat.load_prompt_context
+        loaded_messages = []
+
+        def fail_first_load(user_message):
+            loaded_messages.append(user_message)
+            if len(loaded_messages) == 1:
+                raise RuntimeError("vector store unavailable")
+            return load_prompt_context(user_message)
+
+        monkeypatch.setattr(ongoing_chat, "load_prompt_context", fail_first_load)
+        ongoing_chat.prepare_prompt_speculatively(draft_message="Hello")
+
+        (_, _, related_information), _ = ongoing_chat.take_prompt_context(
+            user_message="Hello"
+        )
+
+        assert loaded_messages == ["Hello", "Hello"]
+        assert related_information == ["related to Hello"]
+
+    @pytest.mark.parametrize("change", ["buffer", "summary"])
+    def test_state_change_invalidates_speculation(
+        self, ongoing_chat: agent.Agent, monkeypatch, change: str
+    ):
+        load_prompt_context = ongoing_chat.load_prompt_context
+        loaded_messages = []
+        speculation_loaded = threading.Event()
+
+        def record_load_prompt_context(user_message):
+            loaded_messages.append(user_message)
+            prompt_context = load_prompt_context(user_message)
+            speculation_loaded.set()
+            return prompt_context
+
+        monkeypatch.setattr(
+            ongoing_chat, "load_prompt_context", record_load_prompt_context
+        )
+        ongoing_chat.prepare_prompt_speculatively(draft_message="Hello")
+        assert speculation_loaded.wait(timeout=5)
+        if change == "buffer":
+            ongoing_chat.summary_buffer_memory.expand_buffer_on_disk(
+                [{"role": "user", "content": "Are you there?"}]
+            )
+        else:
+            ongoing_chat.summary_buffer_memory.save_new_summary_on_disk(
+                "We fought a duel."
+            )
+
+        (summary, last_messages, _), stage_timings = ongoing_chat.take_prompt_context(
+            user_message="Hello"
+        )
+
+        assert loaded_messages == ["Hello", "Hello"]
+        assert "speculation_wait" not in stage_timings
+        if change == "buffer":
+            assert last_messages[-1] == {"role": "user", "content": "Are you there?"}
+        else:
+            assert summary == "We fought a duel."
+
+
+class TestTurnStages:
+    def test_stage_results_and_timings(self, character_agent: agent.Agent):
+        stage_results, stage_timings = character_agent.run_stages(
+            {"sentiment": lambda: "joy", "buffer_write": lambda: None}
+        )
+
+        assert stage_results == {"sentiment": "joy", "buffer_write": None}
+        assert set(stage_timings) == {"sentiment", "buffer_write"}
+        assert all(seconds >= 0 for seconds in stage_timings.values())
+
+    def test_failing_stage_raises_after_siblings_finished(
+        self, character_agent: agent.Agent
+    ):
+        sibling_finished = threading.Event()
+
+        def slow_sibling():
+            time.sleep(0.1)
+            sibling_finished.set()
+
+        def failing_stage():
+            raise RuntimeError("disk full")
+
+        with pytest.raises(RuntimeError, match="disk full"):
+            character_agent.run_stages(
+                {"buffer_write": failing_stage, "sentiment": slow_sibling}
+            )
+        assert sibling_finished.is_set()
+
+    def test_turn_keeps_stores_in_step(self, character_agent: agent.Agent):
+        greeting = "".join(character_agent.stream_system_message())
+        character_agent.save_answer_on_disk_handler(
+            user_message="", character_answer=greeting
+        )
+        for user_message in ["Hello there!", "You are a bold one."]:
+            answer = "".join(
+                character_agent.character_agent_response_stream(
+                    user_message=user_message
+                )
+            )
+            assert (
+                character_agent.finish_user_turn(
+                    user_message=user_message, character_answer=answer
+                )
+                == "joy"
+            )
+
+        transcript_sequence_numbers, transcript_documents = (
+            character_agent.transcript_memory.get_documents()
+        )
+        vector_sequence_numbers, vector_documents = (
+            character_agent.vector_store_memory.get_stored_documents()
+        )
+        buffer = character_agent.summary_buffer_memory.load_buffer_from_disk()
+
+        assert transcript_sequence_numbers == vector_sequence_numbers == [0, 1, 2, 3, 4]
+        assert transcript_documents == vector_documents
+        assert len(buffer) == len(transcript_documents)
+        for line, document in zip(buffer, transcript_documents, strict=True):
+            assert document.lower().endswith(line["content"].lower())
+        assert {"prompt_build", "sentiment", "buffer_write"} <= set(
+            character_agent.last_turn_stage_timings
+        )
@@ -0,0 +1,59 @@
+import functools
+
+import pytest
+
+from src.llm_agent_gui import embeddings
+
+
+class TestCachedEmbeddingFunction:
+    @pytest.fixture
+    def embedded_batches(self) -> list[list[str]]:
+        return []
+
+    @pytest.fixture
+    def embedding_function(
+        self, embedded_batches: list[list[str]]
+    ) -> embeddings.CachedEmbeddingFunction:
+        def embed_texts(texts: list[str]) -> list[list[float]]:
+            embedded_batches.append(texts)
+            return [[float(len(text)), 1.0] for text in texts]
+
+        return embeddings.CachedEmbeddingFunction(batch_size=2, embed_texts=embed_texts)
+
+    def test_embeds_in_batches(
+        self,
+        embedding_function: embeddings.CachedEmbeddingFunction,
+        embedded_batches: list[list[str]],
+    ):
+        vectors = embedding_function(["a", "bb", "ccc"])
+
+        assert vectors == [[1.0, 1.0], [2.0, 1.0], [3.0, 1.0]]
+        assert embedded_batches == [["a", "bb"], ["ccc"]]
+
+    def test_identical_texts_are_embedded_once(
+        self,
+        embedding_function: embeddings.CachedEmbeddingFunction,
+        embedded_batches: list[list[str]],
+    ):
+        embedding_function(["Hello there", "Hello there"])
+        vectors = embedding_function(["General Kenobi", "Hello there"])
+
+        assert vectors == [[14.0, 1.0], [11.0, 1.0]]
+        assert embedded_batches == [["Hello there"], ["General Kenobi"]]
+
+    def test_invalid_provider(self):
+        with pytest.raises(Exception, match="No valid embedding provider"):
+            embeddings.CachedEmbeddingFunction(provider="invalid")
+
+
+def test_onnx_embedding_internals_are_available():
+    # load_onnx relies on these to build the session with its own threads
+    from chromadb.utils.embedding_functions import ONNXMiniLM_L6_V2
+
+    onnx_embedding_function = ONNXMiniLM_L6_V2()
+
+    assert isinstance(vars(ONNXMiniLM_L6_V2)["model"], functools.cached_property)
+    assert callable(onnx_embedding_function._download_model_if_not_exists)
+    assert onnx_embedding_function.ort.SessionOptions is not None
+    assert onnx_embedding_function.DOWNLOAD_PATH
+    assert onnx_embedding_function.EXTRACTED_FOLDER_NAME
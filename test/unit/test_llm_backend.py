@@ -0,0 +1,398 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from src.llm_agent_gui import llm_backend, response_cache
+
+
+class TestLlmBackend:
+    def test_import_does_not_load_model_libraries(self):
+        output = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys; from src.llm_agent_gui import llm_backend; "
+                "print([m for m in ('openai', 'torch', 'transformers', 'llama_cpp') "
+                "if m in sys.modules])",
+            ],
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout
+
+        assert output.strip() == "[]"
+
+    def test_invalid_backend_raises(self):
+        with pytest.raises(Exception, match="No valid backend"):
+            llm_backend.LlmBackend("unknown")
+
+    def test_classifier_is_loaded_once_on_first_use(self, monkeypatch):
+        loaded_classifiers = []
+
+        def load_classifier(self):
+            loaded_classifiers.append(object())
+            return loaded_classifiers[-1]
+
+        monkeypatch.setattr(llm_backend.LlmBackend, "load_classifier", load_classifier)
+        backend = llm_backend.LlmBackend("openai")
+
+        assert loaded_classifiers == []
+        assert backend.classifier is backend.classifier
+        assert len(loaded_classifiers) == 1
+
+    def test_classify_sentiments_batches_and_caches(self, monkeypatch):
+        classifier_calls = []
+
+        def classifier(texts, **kwargs):
+            classifier_calls.append((texts, kwargs))
+            return [
+                [
+                    {"label": "joy", "score": 0.9 if "great" in text else 0.1},
+                    {"label": "sadness", "score": 0.5},
+                ]
+                for text in texts
+            ]
+
+        monkeypatch.setattr(
+            llm_backend.LlmBackend, "load_classifier", lambda self: classifier
+        )
+        backend = llm_backend.LlmBackend("openai", classifier_max_length=128)
+
+        labels = backend.classify_sentiments(["great day", "rainy day", "great day"])
+
+        assert labels == ["joy", "sadness", "joy"]
+        assert len(classifier_calls) == 1
+        texts, kwargs = classifier_calls[0]
+        assert texts == ["great day", "rainy day"]
+        assert kwargs["truncation"] is True
+        assert kwargs["max_length"] == 128
+
+        assert backend.classify_sentiment("rainy day") == "sadness"
+        assert len(classifier_calls) == 1
+
+    def test_invalid_classifier_runtime_raises(self):
+        with pytest.raises(Exception, match="No valid classifier runtime"):
+            llm_backend.LlmBackend("openai", classifier_runtime="tpu")
+
+    def test_inference_llm_reuses_cached_response(self, monkeypatch):
+        prompts = []
+
+        def inference_openai(self, prompt):
+            prompts.append(prompt)
+            return "Hello there!"
+
+        monkeypatch.setattr(
+            llm_backend.LlmBackend, "inference_openai", inference_openai
+        )
+        with TemporaryDirectory() as tmpdir:
+            backend = llm_backend.LlmBackend(
+                "openai",
+                response_cache=response_cache.ResponseCache(
+                    os.path.join(tmpdir, "cache.sqlite3"), None, 10
+                ),
+            )
+            prompt = [{"role": "system", "content": "Greet the user."}]
+
+            assert backend.inference_llm(prompt) == "Hello there!"
+            assert backend.inference_llm(prompt) == "Hello there!"
+            assert len(prompts) == 1
+
+            backend.inference_llm(prompt, use_cache=False)
+            assert len(prompts) == 2
+
+    def test_openai_context_window(self):
+        assert llm_backend.LlmBackend("openai").context_window == 16385
+        assert (
+            llm_backend.LlmBackend(
+                "openai", openai_model="gpt-4o", openai_context_window=128000
+            ).context_window
+            == 128000
+        )
+
+    def test_count_tokens_estimates_without_tokenizer(self, monkeypatch):
+        monkeypatch.setattr(llm_backend, "TIKTOKEN_AVAILABLE", False)
+        backend = llm_backend.LlmBackend("openai")
+
+        assert backend.count_tokens("General Kenobi") == 4
+        assert backend.count_tokens("") == 0
+
+    def test_count_tokens_with_model_unknown_to_tiktoken(self, monkeypatch):
+        requested_encodings = []
+
+        def encoding_for_model(model_name):
+            raise KeyError(model_name)
+
+        def get_encoding(encoding_name):
+            requested_encodings.append(encoding_name)
+            return types.SimpleNamespace(encode=str.split)
+
+        monkeypatch.setitem(
+            sys.modules,
+            "tiktoken",
+            types.SimpleNamespace(
+                encoding_for_model=encoding_for_model, get_encoding=get_encoding
+            ),
+        )
+        monkeypatch.setattr(llm_backend, "TIKTOKEN_AVAILABLE", True)
+        backend = llm_backend.LlmBackend("openai", openai_model="local-mistral-7b")
+
+        assert backend.count_tokens("General Kenobi") == 2
+        assert requested_encodings == ["cl100k_base"]
+
+
+class StubOpenAiServer(ThreadingHTTPServer):
+    """Answers chat completions locally, failing or stalling on request."""
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), StubOpenAiHandler)
+        self.failures: list[int] = []
+        self.delay = 0.0
+        self.trickle_delay = 0.0
+        self.request_count = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class StubOpenAiHandler(BaseHTTPRequestHandler):
+    server: StubOpenAiServer
+
+    def do_POST(self) -> None:
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            self.server.request_count += 1
+            self.server.in_flight += 1
+            self.server.max_in_flight = max(
+                self.server.max_in_flight, self.server.in_flight
+            )
+            failure = self.server.failures.pop(0) if self.server.failures else None
+        try:
+            time.sleep(self.server.delay)
+            if failure is not None:
+                self.send_json(failure, {"error": {"message": "try again"}})
+            elif request.get("stream"):
+                self.send_stream(["General ", "Kenobi"])
+            else:
+                self.send_json(
+                    200,
+                    {
+                        "id": "completion",
+                        "object": "chat.completion",
+                        "created": 0,
+                        "model": request["model"],
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {
+                                    "role": "assistant",
+                                    "content": "General Kenobi",
+                                },
+                                "finish_reason": "stop",
+                            }
+                        ],
+                    },
+                )
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client timed out
+        finally:
+            with self.server.lock:
+                self.server.in_flight -= 1
+
+    def send_json(self, status: int, body: dict) -> None:
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        # Slow but steady, every read gets data within the trickle delay
+        for start in range(0, len(content), len(content) // 4 + 1):
+            self.wfile.write(content[start : start + len(content) // 4 + 1])
+            self.wfile.flush()
+            time.sleep(self.server.trickle_delay)
+
+    def send_stream(self, deltas: list[str]) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for delta in deltas:
+            chunk = {
+                "id": "completion",
+                "object": "chat.completion.chunk",
+                "created": 0,
+                "model": "stub",
+                "choices": [{"index": 0, "delta": {"content": delta}}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class TestOpenAiBackend:
+    @pytest.fixture
+    def server(self, monkeypatch):
+        monkeypatch.setenv("OPENAI_API_KEY", "test-key")
+        server = StubOpenAiServer()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        yield server
+        server.shutdown()
+        server.server_close()
+
+    def create_backend(self, server: StubOpenAiServer, **kwargs):
+        return llm_backend.LlmBackend(
+            "openai",
+            openai_base_url=server.base_url,
+            retry_initial_delay=0.01,
+            **kwargs,
+        )
+
+    def test_inference_llm(self, server: StubOpenAiServer):
+        backend = self.create_backend(server)
+        prompt = [{"role": "user", "content": "Hello there!"}]
+
+        assert backend.inference_llm(prompt) == "General Kenobi"
+        assert "".join(backend.stream_llm(prompt)) == "General Kenobi"
+
+    def test_retries_rate_limits_and_server_errors(self, server: StubOpenAiServer):
+        server.failures = [429, 503]
+        backend = self.create_backend(server, max_retries=2)
+
+        assert backend.inference_llm([]) == "General Kenobi"
+        assert server.request_count == 3
+
+        server.failures = [500, 500]
+        with pytest.raises(Exception, match="try again"):
+            self.create_backend(server, max_retries=1).inference_llm([])
+
+    def test_request_timeout(self, server: StubOpenAiServer):
+        server.delay = 0.5
+        backend = self.create_backend(server, request_timeout=0.1, max_retries=0)
+
+        with pytest.raises(Exception, match="timed out"):
+            backend.inference_llm([])
+
+    def test_request_timeout_bounds_whole_request(self, server: StubOpenAiServer):
+        server.trickle_delay = 0.15
+        backend = self.create_backend(server, request_timeout=0.3, max_retries=0)
+
+        with pytest.raises(TimeoutError, match="timed out"):
+            backend.inference_llm([])
+
+    def test_concurrent_requests_are_capped(self, server: StubOpenAiServer):
+        server.delay = 0.1
+        backend = self.create_backend(server, max_concurrent_requests=2)
+
+        async def run_requests():
+            return await asyncio.gather(*(backend.ainference_llm([]) for _ in range(5)))
+
+        assert asyncio.run(run_requests()) == ["General Kenobi"] * 5
+        assert server.max_in_flight == 2
+
+
+class StubLlama:
+    """Records how many generations run at once on the same model."""
+
+    def __init__(self) -> None:
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def tokenize(self, text: bytes, add_bos: bool = True) -> list[int]:
+        return list(range(len(text.split())))
+
+    def create_chat_completion(self, messages, stream, **kwargs):
+        if stream:
+            return self.stream_chunks()
+        with self.generate():
+            return {"choices": [{"message": {"content": "General Kenobi"}}]}
+
+    def stream_chunks(self):
+        with self.generate():
+            for delta in ["General ", "Kenobi"]:
+                time.sleep(0.02)
+                yield {"choices": [{"delta": {"content": delta}}]}
+
+    def generate(self):
+        stub = self
+
+        class Generation:
+            def __enter__(self):
+                with stub.lock:
+                    stub.in_flight += 1
+                    stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+                time.sleep(0.02)
+
+            def __exit__(self, *exc_info):
+                with stub.lock:
+                    stub.in_flight -= 1
+
+        return Generation()
+
+
+class TestLlamaCppBackend:
+    @pytest.fixture
+    def llama(self, monkeypatch):
+        llama = StubLlama()
+        monkeypatch.setattr(llm_backend, "LLAMA_CPP_AVAILABLE", True)
+        monkeypatch.setattr(
+            llm_backend.LlmBackend, "load_llama_cpp", lambda self: llama
+        )
+        return llama
+
+    def test_generations_do_not_overlap(self, llama: StubLlama):
+        backend = llm_backend.LlmBackend("llama-cpp")
+        prompt = [{"role": "user", "content": "Hello there!"}]
+        answers = []
+
+        def stream_reply():
+            answers.append("".join(backend.stream_llm(prompt)))
+
+        def summarize():
+            answers.append(backend.inference_llm(prompt))
+
+        threads = [
+            threading.Thread(target=target)
+            for target in [stream_reply, summarize, stream_reply, summarize]
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert answers == ["General Kenobi"] * 4
+        assert llama.max_in_flight == 1
+
+    def test_async_inference_waits_for_running_generation(self, llama: StubLlama):
+        backend = llm_backend.LlmBackend("llama-cpp")
+        prompt = [{"role": "user", "content": "Hello there!"}]
+        streamed_answers = []
+        stream_thread = threading.Thread(
+            target=lambda: streamed_answers.append("".join(backend.stream_llm(prompt)))
+        )
+
+        async def run_requests():
+            return await asyncio.gather(
+                *(backend.ainference_llm(prompt) for _ in range(3))
+            )
+
+        stream_thread.start()
+        answers = asyncio.run(run_requests())
+        stream_thread.join()
+
+        assert answers == ["General Kenobi"] * 3
+        assert streamed_answers == ["General Kenobi"]
+        assert llama.max_in_flight == 1
@@ -7,6 +7,11 @@ import pytest
 from src.llm_agent_gui import memory
 
 
+def embed_by_length(texts: list[str]) -> list[list[float]]:
+    # Stands in for the embedding model, which has to be downloaded
+    return [[float(len(text)), 1.0] for text in texts]
+
+
 class TestSummaryBufferMemory:
     @pytest.fixture
     def summary_buffer(self) -> memory.SummaryBufferMemory:
@@ -110,6 +115,32 @@ class TestSummaryBufferMemory:
 
             summary_buffer.expand_buffer_on_disk([{"message": "new"}])
 
+            with open(os.path.join(tmpdir, "test_character.json")) as f:
+                assert json.load(f) == ["some summary", [{"message": "old"}]]
+            with open(os.path.join(tmpdir, "test_character.jsonl")) as f:
+                assert json.loads(f.readline()) == {"new_lines": [{"message": "new"}]}
+
+            assert summary_buffer.load_buffer_from_disk() == [
+                {"message": "old"},
+                {"message": "new"},
+            ]
+
+    def test_compact_on_disk(
+        self, summary_buffer: memory.SummaryBufferMemory, monkeypatch
+    ):
+        with TemporaryDirectory() as tmpdir:
+            monkeypatch.setattr(
+                summary_buffer,
+                "_SUMMARY_BUFFER_PATH",
+                os.path.join(tmpdir, "{}.json"),
+            )
+            with open(os.path.join(tmpdir, "test_character.json"), "w") as f:
+                f.write('["some summary", [{"message": "old"}]]')
+
+            summary_buffer.expand_buffer_on_disk([{"message": "new"}])
+            summary_buffer.compact_on_disk()
+
+            assert not os.path.exists(os.path.join(tmpdir, "test_character.jsonl"))
             with open(os.path.join(tmpdir, "test_character.json")) as f:
                 data = json.load(f)
                 assert data == [
@@ -117,6 +148,88 @@ class TestSummaryBufferMemory:
                     [{"message": "old"}, {"message": "new"}],
                 ]
 
+    def test_torn_journal_line_is_ignored(
+        self, summary_buffer: memory.SummaryBufferMemory, monkeypatch
+    ):
+        with TemporaryDirectory() as tmpdir:
+            monkeypatch.setattr(
+                summary_buffer,
+                "_SUMMARY_BUFFER_PATH",
+                os.path.join(tmpdir, "{}.json"),
+            )
+            with open(os.path.join(tmpdir, "test_character.json"), "w") as f:
+                f.write('["", [{"message": "old"}]]')
+            with open(os.path.join(tmpdir, "test_character.jsonl"), "w") as f:
+                f.write('{"new_lines": [{"message": "new"}]}\n{"new_li')
+
+            assert summary_buffer.load_buffer_from_disk() == [
+                {"message": "old"},
+                {"message": "new"},
+            ]
+
+    def test_append_after_torn_journal_line(
+        self, summary_buffer: memory.SummaryBufferMemory, monkeypatch
+    ):
+        with TemporaryDirectory() as tmpdir:
+            monkeypatch.setattr(
+                summary_buffer,
+                "_SUMMARY_BUFFER_PATH",
+                os.path.join(tmpdir, "{}.json"),
+            )
+            with open(os.path.join(tmpdir, "test_character.json"), "w") as f:
+                f.write('["", [{"message": "old"}]]')
+            with open(os.path.join(tmpdir, "test_character.jsonl"), "w") as f:
+                f.write('{"new_lines": [{"message": "new"}]}\n{"new_li')
+
+            summary_buffer.expand_buffer_on_disk([{"message": "after crash"}])
+            expected_buffer = [
+                {"message": "old"},
+                {"message": "new"},
+                {"message": "after crash"},
+            ]
+
+            assert summary_buffer.load_buffer_from_disk() == expected_buffer
+            summary_buffer.invalidate_cache()
+            assert summary_buffer.load_buffer_from_disk() == expected_buffer
+
+    def test_recover_interrupted_compaction(
+        self, summary_buffer: memory.SummaryBufferMemory, monkeypatch
+    ):
+        with TemporaryDirectory() as tmpdir:
+            monkeypatch.setattr(
+                summary_buffer,
+                "_SUMMARY_BUFFER_PATH",
+                os.path.join(tmpdir, "{}.json"),
+            )
+            with open(os.path.join(tmpdir, "test_character.json"), "w") as f:
+                f.write('["", [{"message": "old"}]]')
+            with open(os.path.join(tmpdir, "test_character.jsonl"), "w") as f:
+                f.write('{"new_lines": [{"message": "new"}]}\n')
+            # Complete snapshot written, crashed before the journal was dropped
+            with open(os.path.join(tmpdir, "test_character.json.tmp"), "w") as f:
+                f.write('["", [{"message": "old"}, {"message": "new"}]]')
+
+            assert summary_buffer.load_buffer_from_disk() == [
+                {"message": "old"},
+                {"message": "new"},
+            ]
+            assert not os.path.exists(os.path.join(tmpdir, "test_character.jsonl"))
+
+            summary_buffer.invalidate_cache()
+
+            # Crashed while writing the snapshot, the journal is still valid
+            with open(os.path.join(tmpdir, "test_character.jsonl"), "w") as f:
+                f.write('{"new_lines": [{"message": "newer"}]}\n')
+            with open(os.path.join(tmpdir, "test_character.json.tmp"), "w") as f:
+                f.write('["", [{"message": "ol')
+
+            assert summary_buffer.load_buffer_from_disk() == [
+                {"message": "old"},
+                {"message": "new"},
+                {"message": "newer"},
+            ]
+            assert not os.path.exists(os.path.join(tmpdir, "test_character.json.tmp"))
+
     def test_load_summary_from_disk(
         self, summary_buffer: memory.SummaryBufferMemory, monkeypatch
     ):
@@ -163,6 +276,287 @@ class TestSummaryBufferMemory:
                 data = json.load(f)
                 assert data == ["some summary", []]
 
+    def test_state_is_cached_until_invalidated(
+        self, summary_buffer: memory.SummaryBufferMemory, monkeypatch
+    ):
+        with TemporaryDirectory() as tmpdir:
+            monkeypatch.setattr(
+                summary_buffer,
+                "_SUMMARY_BUFFER_PATH",
+                os.path.join(tmpdir, "{}.json"),
+            )
+            with open(os.path.join(tmpdir, "test_character.json"), "w") as f:
+                f.write('["cached summary", [{"message": "cached"}]]')
+
+            assert summary_buffer.load_summary_from_disk() == "cached summary"
+            summary_buffer.expand_buffer_on_disk([{"message": "new"}])
+
+            with open(os.path.join(tmpdir, "test_character.json"), "w") as f:
+                f.write('["external summary", []]')
+
+            assert summary_buffer.load_summary_from_disk() == "cached summary"
+            assert summary_buffer.load_buffer_from_disk() == [
+                {"message": "cached"},
+                {"message": "new"},
+            ]
+
+            summary_buffer.invalidate_cache()
+
+            assert summary_buffer.load_summary_from_disk() == "external summary"
+
+    def test_session_change_invalidates_cache(
+        self, summary_buffer: memory.SummaryBufferMemory, monkeypatch
+    ):
+        with TemporaryDirectory() as tmpdir:
+            monkeypatch.setattr(
+                summary_buffer,
+                "_SUMMARY_BUFFER_PATH",
+                os.path.join(tmpdir, "{}.json"),
+            )
+            with open(os.path.join(tmpdir, "test_character.json"), "w") as f:
+                f.write('["first summary", []]')
+            with open(os.path.join(tmpdir, "other_character.json"), "w") as f:
+                f.write('["second summary", []]')
+
+            assert summary_buffer.load_summary_from_disk() == "first summary"
+
+            summary_buffer.character_session = "other_character"
+
+            assert summary_buffer.load_summary_from_disk() == "second summary"
+
+    def test_replace_summarized_lines_on_disk(
+        self, summary_buffer: memory.SummaryBufferMemory, monkeypatch
+    ):
+        with TemporaryDirectory() as tmpdir:
+            monkeypatch.setattr(
+                summary_buffer,
+                "_SUMMARY_BUFFER_PATH",
+                os.path.join(tmpdir, "{}.json"),
+            )
+            with open(os.path.join(tmpdir, "test_character.json"), "w") as f:
+                f.write('["old summary", [{"message": "summarized"}]]')
+            # Saved while the summary was being generated
+            summary_buffer.expand_buffer_on_disk([{"message": "new"}])
+
+            summary_buffer.replace_summarized_lines_on_disk(
+                new_summary="new summary", summarized_line_count=1
+            )
+
+            with open(os.path.join(tmpdir, "test_character.json")) as f:
+                assert json.load(f) == ["new summary", [{"message": "new"}]]
+            assert not summary_buffer.summary_pending
+
+    def test_summary_levels_are_kept(
+        self, summary_buffer: memory.SummaryBufferMemory, monkeypatch
+    ):
+        with TemporaryDirectory() as tmpdir:
+            monkeypatch.setattr(
+                summary_buffer,
+                "_SUMMARY_BUFFER_PATH",
+                os.path.join(tmpdir, "{}.json"),
+            )
+            summary_buffer.save_initial_buffer_on_disk([{"message": "summarized"}])
+            summary_levels = [
+                [memory.create_summary_entry("chunk", line_count=1)],
+                [memory.create_summary_entry("roll-up", line_count=4)],
+            ]
+
+            summary_buffer.replace_summarized_lines_on_disk(
+                new_summary=memory.compose_summary(summary_levels),
+                summarized_line_count=1,
+                summary_levels=summary_levels,
+            )
+            summary_buffer.reset_buffer_on_disk()
+            summary_buffer.invalidate_cache()
+
+            assert summary_buffer.load_summary_from_disk() == "roll-up\n\nchunk"
+            assert summary_buffer.load_summary_levels() == summary_levels
+
+    def test_compose_summary_keeps_whole_summaries_within_budget(self):
+        summary_levels = [
+            [
+                memory.create_summary_entry("chunk five", line_count=1),
+                memory.create_summary_entry("chunk six", line_count=1),
+            ],
+            [
+                memory.create_summary_entry("roll-up two", line_count=4),
+                memory.create_summary_entry("roll-up three", line_count=4),
+            ],
+            [memory.create_summary_entry("roll-up one", line_count=16)],
+        ]
+
+        def count_words(text):
+            return len(text.split())
+
+        assert memory.compose_summary(summary_levels) == (
+            "roll-up one\n\nroll-up two\n\nroll-up three\n\nchunk five\n\nchunk six"
+        )
+        # The top level, then the latest summaries up to the first that misses
+        assert memory.compose_summary(
+            summary_levels, count_tokens=count_words, token_budget=7
+        ) == ("roll-up one\n\nchunk five\n\nchunk six")
+        assert (
+            memory.compose_summary(
+                summary_levels[:1], count_tokens=count_words, token_budget=3
+            )
+            == "chunk six"
+        )
+
+    def test_legacy_summary_ranks_above_chunks(
+        self, summary_buffer: memory.SummaryBufferMemory, monkeypatch
+    ):
+        with TemporaryDirectory() as tmpdir:
+            monkeypatch.setattr(
+                summary_buffer,
+                "_SUMMARY_BUFFER_PATH",
+                os.path.join(tmpdir, "{}.json"),
+            )
+            with open(os.path.join(tmpdir, "test_character.json"), "w") as f:
+                f.write('["old summary", []]')
+
+            summary_levels = summary_buffer.load_summary_levels()
+
+            assert summary_levels[0] == []
+            assert [entry["summary"] for entry in summary_levels[1]] == ["old summary"]
+
+    def test_exceeds_buffer_overrun(self, monkeypatch):
+        summary_buffer = memory.SummaryBufferMemory(
+            2, "test_character", max_buffer_overrun=2
+        )
+        with TemporaryDirectory() as tmpdir:
+            monkeypatch.setattr(
+                summary_buffer,
+                "_SUMMARY_BUFFER_PATH",
+                os.path.join(tmpdir, "{}.json"),
+            )
+            summary_buffer.save_initial_buffer_on_disk([{"message": "greeting"}])
+
+            summary_buffer.expand_buffer_on_disk([{"message": "first"}])
+            summary_buffer.update_buffer_counter()
+            assert summary_buffer.summary_pending
+            assert not summary_buffer.exceeds_buffer_overrun()
+
+            summary_buffer.expand_buffer_on_disk([{"message": "second"}])
+            summary_buffer.expand_buffer_on_disk([{"message": "third"}])
+            summary_buffer.update_buffer_counter()
+            assert summary_buffer.exceeds_buffer_overrun()
+
+    def test_token_budget_triggers_summary(self, monkeypatch):
+        summary_buffer = memory.SummaryBufferMemory(
+            100,
+            "test_character",
+            count_tokens=lambda text: len(text.split()),
+            buffer_token_budget=8,
+            max_buffer_token_overrun=4,
+        )
+        with TemporaryDirectory() as tmpdir:
+            monkeypatch.setattr(
+                summary_buffer,
+                "_SUMMARY_BUFFER_PATH",
+                os.path.join(tmpdir, "{}.json"),
+            )
+            summary_buffer.save_initial_buffer_on_disk(
+                [{"role": "assistant", "content": "one two three"}]
+            )
+            summary_buffer.expand_buffer_on_disk(
+                [{"role": "user", "content": "four five six seven"}]
+            )
+            summary_buffer.update_buffer_counter()
+            assert not summary_buffer.summary_pending
+
+            summary_buffer.expand_buffer_on_disk(
+                [{"role": "assistant", "content": "eight nine"}]
+            )
+            summary_buffer.update_buffer_counter()
+            assert summary_buffer.summary_pending
+            assert not summary_buffer.exceeds_buffer_overrun()
+
+            # The newest lines worth up to half the budget stay verbatim
+            buffer = summary_buffer.load_buffer_from_disk()
+            assert summary_buffer.count_lines_to_summarize(buffer) == 2
+
+            summary_buffer.expand_buffer_on_disk(
+                [{"role": "user", "content": "ten eleven twelve"}]
+            )
+            summary_buffer.update_buffer_counter()
+            assert summary_buffer.exceeds_buffer_overrun()
+
+
+class TestTranscriptMemory:
+    @pytest.fixture
+    def transcript(self):
+        with TemporaryDirectory() as temp_dir:
+            yield memory.TranscriptMemory(
+                "test character",
+                transcript_path=os.path.join(temp_dir, "transcript.sqlite3"),
+            )
+
+    def test_save_new_lines(self, transcript: memory.TranscriptMemory):
+        first_sequence_numbers = transcript.save_new_lines(
+            [{"role": "assistant", "content": "Hello there"}], "Test", "User"
+        )
+        next_sequence_numbers = transcript.save_new_lines(
+            [
+                {"role": "user", "content": "General Kenobi"},
+                {"role": "assistant", "content": "You are a bold one"},
+            ],
+            "Test",
+            "User",
+        )
+
+        assert first_sequence_numbers == [0]
+        assert next_sequence_numbers == [1, 2]
+        assert transcript.get_documents() == (
+            [0, 1, 2],
+            ["Test: Hello there", "User: General Kenobi", "Test: You are a bold one"],
+        )
+
+    def test_sessions_are_separate(self, transcript: memory.TranscriptMemory):
+        transcript.save_new_lines([{"role": "user", "content": "Hi"}], "Test", "User")
+        transcript.set_session("other character")
+        assert transcript.is_empty()
+        assert transcript.save_new_lines(
+            [{"role": "user", "content": "Hi"}], "Other", "User"
+        ) == [0]
+
+        transcript.reset_session()
+        assert transcript.is_empty()
+        transcript.set_session("test character")
+        assert transcript.message_count() == 1
+
+    def test_get_chat_history_page(self, transcript: memory.TranscriptMemory):
+        transcript.save_new_lines(
+            [
+                {"role": "assistant", "content": "hello there"},
+                {"role": "user", "content": "general who?"},
+                {"role": "assistant", "content": "kenobi"},
+            ],
+            "Test",
+            "User",
+        )
+
+        recent_page, cursor = transcript.get_chat_history_page(limit=2)
+        assert recent_page == "User: general who?\n\nTest: kenobi\n\n"
+        assert cursor == 1
+
+        older_page, cursor = transcript.get_chat_history_page(before=cursor, limit=2)
+        assert older_page == "Test: hello there\n\n"
+        assert cursor is None
+
+    def test_import_documents(self, transcript: memory.TranscriptMemory):
+        transcript.import_documents(
+            [0, 1], ["Test: Hello there", "User: General Kenobi"], "Test"
+        )
+        # Already imported messages are left untouched
+        transcript.import_documents([1], ["User: Changed"], "Test")
+
+        assert transcript.get_full_chat_history() == (
+            "Test: hello there\n\nUser: general kenobi\n\n"
+        )
+        assert transcript.save_new_lines(
+            [{"role": "user", "content": "Hi"}], "Test", "User"
+        ) == [2]
+
 
 class TestVectorStore:
     @pytest.fixture
@@ -170,6 +564,7 @@ class TestVectorStore:
         vector_store_instance = memory.VectorStoreMemory(
             2, "test_character", vector_store_path="test/temp"
         )
+        vector_store_instance.open_collection()
         vector_store_instance.chroma_client.delete_collection("test_character")
         return vector_store_instance
 
@@ -197,6 +592,7 @@ class TestVectorStore:
         character_name = "test_character"
         user_name = "User"
         vector_store.save_new_lines_as_vectors(new_lines, character_name, user_name)
+        vector_store.flush()
         assert vector_store.collection.count() == len(new_lines)
 
     def test_retreive_related_information(
@@ -225,6 +621,19 @@ class TestVectorStore:
         string_ids = vector_store.create_string_ids(4)
         assert string_ids == ["id2", "id3", "id4", "id5"]
 
+    def test_create_string_ids_after_delete(
+        self, vector_store: memory.VectorStoreMemory, setup
+    ):
+        vector_store.collection.add(
+            ids=["id0", "id1", "id2"],
+            documents=["User: Hello there", "test_character: General Kenobi", "x"],
+            embeddings=[[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]],
+        )
+        vector_store.collection.delete(ids=["id0"])
+
+        assert vector_store.create_string_ids(2) == ["id3", "id4"]
+        assert vector_store.create_string_ids(1) == ["id5"]
+
     def test_reset_colletion(self, vector_store: memory.VectorStoreMemory, setup):
         new_lines = [
             {"role": "user", "content": "Hello there"},
@@ -236,22 +645,249 @@ class TestVectorStore:
 
         assert vector_store.collection.count() == 0
 
-    def test_get_full_chat_history(self, vector_store: memory.VectorStoreMemory, setup):
-        user_name = "User"
+    def test_create_string_ids_with_sequence_numbers(
+        self, vector_store: memory.VectorStoreMemory, setup
+    ):
+        assert vector_store.create_string_ids(2, [4, 5]) == ["id4", "id5"]
+        assert vector_store.create_string_ids(1) == ["id6"]
+
+    def test_get_stored_documents(self, vector_store: memory.VectorStoreMemory, setup):
+        vector_store.collection.add(
+            ids=["id10", "id2"],
+            documents=["User: later", "User: earlier"],
+            embeddings=[[1.0, 0.0], [0.0, 1.0]],
+        )
+
+        assert vector_store.get_stored_documents() == (
+            [2, 10],
+            ["User: earlier", "User: later"],
+        )
+
+    def test_queued_writes_are_flushed(self):
+        vector_store = memory.VectorStoreMemory(
+            2,
+            "test_character",
+            vector_store_path="test/temp",
+            write_batch_size=3,
+            write_batch_delay=60,
+            embedding_function=embed_by_length,
+        )
+        vector_store.open_collection()
         new_lines = [
             {"role": "user", "content": "Hello there"},
             {"role": "assistant", "content": "General Kenobi"},
-            {"role": "user", "content": "General who?"},
-            {"role": "assistant", "content": "Exactly."},
         ]
-        vector_store.save_new_lines_as_vectors(new_lines, "test_character", user_name)
+        vector_store.save_new_lines_as_vectors(new_lines, "test_character", "User")
+
+        assert vector_store.pending() == 2
+        assert vector_store.retreive_related_information("Kenobi?") == [
+            "test_character: General Kenobi"
+        ]
 
-        chat_history = vector_store.get_full_chat_history()
+        vector_store.flush()
 
-        assert (
-            chat_history
-            == user_name
-            + ": hello there\n\nTest_character: general kenobi\n\n"
-            + user_name
-            + ": general who?\n\nTest_character: exactly.\n\n"
+        assert vector_store.pending() == 0
+        assert vector_store.collection.count() == 2
+        vector_store.chroma_client.delete_collection("test_character")
+
+    def test_flush_raises_failed_write(
+        self, vector_store: memory.VectorStoreMemory, setup
+    ):
+        def failing_embedding(texts):
+            raise RuntimeError("embedding failed")
+
+        vector_store.embedding_function = failing_embedding
+        vector_store.save_new_lines_as_vectors(
+            [{"role": "user", "content": "Hello there"}], "test_character", "User"
+        )
+
+        with pytest.raises(RuntimeError, match="embedding failed"):
+            vector_store.flush()
+        assert vector_store.pending() == 0
+
+    def test_reset_collection_drops_old_lines(self):
+        vector_store = memory.VectorStoreMemory(
+            2,
+            "test character",
+            vector_store_path="test/temp",
+            embedding_function=embed_by_length,
+        )
+        vector_store.save_new_lines_as_vectors(
+            [
+                {"role": "assistant", "content": "Hello there"},
+                {"role": "user", "content": "Old secret about the crowbar"},
+            ],
+            "test character",
+            "User",
+            sequence_numbers=[0, 1],
         )
+
+        vector_store.reset_collection("test character")
+        vector_store.save_initial_lines_as_vectors(
+            {"role": "assistant", "content": "Welcome back"},
+            "test character",
+            sequence_numbers=[0],
+        )
+
+        assert vector_store.get_stored_documents() == (
+            [0],
+            ["test character: Welcome back"],
+        )
+        vector_store.chroma_client.delete_collection("test_character")
+
+    def test_rebuild_from_transcript(self):
+        vector_store = memory.VectorStoreMemory(
+            2,
+            "test_character",
+            vector_store_path="test/temp",
+            embedding_function=embed_by_length,
+        )
+        with TemporaryDirectory() as temp_dir:
+            transcript = memory.TranscriptMemory(
+                "test_character",
+                transcript_path=os.path.join(temp_dir, "transcript.sqlite3"),
+            )
+            transcript.save_new_lines(
+                [
+                    {"role": "user", "content": "Hello there"},
+                    {"role": "assistant", "content": "General Kenobi"},
+                ],
+                "test_character",
+                "User",
+            )
+
+            vector_store.rebuild_from_transcript(
+                transcript, character_name="test_character", batch_size=1
+            )
+
+        assert vector_store.get_stored_documents() == (
+            [0, 1],
+            ["User: Hello there", "test_character: General Kenobi"],
+        )
+        vector_store.chroma_client.delete_collection("test_character")
+
+    def test_rebuild_keeps_lines_missing_from_transcript(self):
+        vector_store = memory.VectorStoreMemory(
+            2,
+            "test_character",
+            vector_store_path="test/temp",
+            embedding_function=embed_by_length,
+        )
+        vector_store.save_new_lines_as_vectors(
+            [
+                {"role": "user", "content": "Hello there"},
+                {"role": "assistant", "content": "General Kenobi"},
+            ],
+            "test_character",
+            "User",
+            sequence_numbers=[0, 1],
+        )
+        with TemporaryDirectory() as temp_dir:
+            transcript = memory.TranscriptMemory(
+                "test_character",
+                transcript_path=os.path.join(temp_dir, "transcript.sqlite3"),
+            )
+
+            vector_store.rebuild_from_transcript(
+                transcript, character_name="test_character"
+            )
+
+            assert transcript.message_count() == 2
+            transcript.close()
+
+        assert vector_store.get_stored_documents() == (
+            [0, 1],
+            ["User: Hello there", "test_character: General Kenobi"],
+        )
+        vector_store.chroma_client.delete_collection("test_character")
+
+    def test_rebuild_with_other_embedding_dimension(self):
+        vector_store = memory.VectorStoreMemory(
+            1,
+            "test_character",
+            vector_store_path="test/temp",
+            embedding_function=embed_by_length,
+        )
+        vector_store.save_new_lines_as_vectors(
+            [
+                {"role": "user", "content": "Hello there"},
+                {"role": "assistant", "content": "General Kenobi"},
+            ],
+            "test_character",
+            "User",
+            sequence_numbers=[0, 1],
+        )
+        with TemporaryDirectory() as temp_dir:
+            transcript = memory.TranscriptMemory(
+                "test_character",
+                transcript_path=os.path.join(temp_dir, "transcript.sqlite3"),
+            )
+            vector_store.embedding_function = lambda texts: [
+                [*embedding, 0.0] for embedding in embed_by_length(texts)
+            ]
+
+            vector_store.rebuild_from_transcript(
+                transcript, character_name="test_character"
+            )
+            transcript.close()
+
+        assert vector_store.retreive_related_information("Hello there") == [
+            "User: Hello there"
+        ]
+        vector_store.chroma_client.delete_collection("test_character")
+
+    def test_retreive_related_information_finds_keyword_matches(self):
+        vector_store = memory.VectorStoreMemory(
+            1,
+            "test_character",
+            vector_store_path="test/temp",
+            embedding_function=embed_by_length,
+        )
+        vector_store.open_collection()
+        vector_store.save_new_lines_as_vectors(
+            [
+                {"role": "user", "content": "The tournament starts on friday at noon"},
+                {"role": "assistant", "content": "Sure"},
+                {"role": "user", "content": "We could go for a walk outside"},
+            ],
+            "test_character",
+            "User",
+        )
+        vector_store.flush()
+
+        # Dense search by length alone prefers the walk, keyword search wins
+        assert vector_store.retreive_related_information(
+            "What did I say about the tournament?"
+        ) == ["User: The tournament starts on friday at noon"]
+        vector_store.chroma_client.delete_collection("test_character")
+
+    def test_retrieval_filters_by_metadata(self):
+        vector_store = memory.VectorStoreMemory(
+            2,
+            "test_character",
+            vector_store_path="test/temp",
+            embedding_function=embed_by_length,
+        )
+        vector_store.open_collection()
+        vector_store.save_new_lines_as_vectors(
+            [
+                {"role": "user", "content": "I love the tournament"},
+                {"role": "assistant", "content": "The tournament is great"},
+                {"role": "user", "content": "The tournament is tomorrow"},
+            ],
+            "test_character",
+            "User",
+        )
+        vector_store.flush()
+
+        stored_metadata = vector_store.collection.get(ids=["id1"])["metadatas"][0]
+        assert stored_metadata["seq"] == 1
+        assert stored_metadata["role"] == "assistant"
+        # The latest line is in the summary buffer already
+        assert sorted(
+            vector_store.retreive_related_information("tournament", exclude_recent=1)
+        ) == ["User: I love the tournament", "test_character: The tournament is great"]
+        assert sorted(
+            vector_store.retreive_related_information("tournament", roles=["user"])
+        ) == ["User: I love the tournament", "User: The tournament is tomorrow"]
+        vector_store.chroma_client.delete_collection("test_character")
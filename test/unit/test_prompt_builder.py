@@ -0,0 +1,106 @@
+from src.llm_agent_gui import prompt_builder
+
+
+def count_words(text: str) -> int:
+    return len(text.split())
+
+
+def message(role: str, content: str) -> dict[str, str]:
+    return {"role": role, "content": content}
+
+
+class TestPromptBuilder:
+    def test_prompt_within_budget_is_complete(self):
+        builder = prompt_builder.PromptBuilder(
+            count_tokens=count_words, context_window=1000, response_token_reserve=100
+        )
+        recent_messages = [message("assistant", "Hello there"), message("user", "Hi")]
+
+        chat_prompt, token_breakdown = builder.build(
+            user_message="General Kenobi",
+            recent_messages=recent_messages,
+            instructions="Stay in character.",
+            summary="They met.",
+            related_information=["User: Hello"],
+        )
+
+        assert [m["role"] for m in chat_prompt] == [
+            "system",
+            "system",
+            "assistant",
+            "user",
+            "system",
+            "user",
+        ]
+        assert chat_prompt[0]["content"] == "Stay in character."
+        assert "They met." in chat_prompt[1]["content"]
+        assert chat_prompt[2:4] == recent_messages
+        assert "User: Hello" in chat_prompt[4]["content"]
+        assert chat_prompt[5] == message("user", "General Kenobi")
+        assert token_breakdown["dropped_messages"] == 0
+        assert token_breakdown["recent_turns"] == 2 + 1 + 2 * 4
+        assert token_breakdown["total"] == sum(
+            token_breakdown[section]
+            for section in [
+                "instructions",
+                "summary",
+                "related_information",
+                "recent_turns",
+                "user_message",
+            ]
+        )
+
+    def test_oldest_turns_are_dropped_first(self):
+        builder = prompt_builder.PromptBuilder(
+            count_tokens=count_words, context_window=40, response_token_reserve=10
+        )
+        recent_messages = [
+            message("user", "one two three four five six seven eight"),
+            message("assistant", "nine ten eleven twelve"),
+            message("user", "thirteen fourteen"),
+        ]
+
+        chat_prompt, token_breakdown = builder.build(
+            user_message="question", recent_messages=recent_messages
+        )
+
+        assert chat_prompt == recent_messages[1:] + [message("user", "question")]
+        assert token_breakdown["dropped_messages"] == 1
+        assert token_breakdown["total"] <= builder.prompt_token_budget
+
+    def test_summary_keeps_its_end_and_related_lines_fit_their_share(self):
+        builder = prompt_builder.PromptBuilder(
+            count_tokens=count_words,
+            context_window=200,
+            response_token_reserve=0,
+            summary_share=0.25,
+            related_information_share=0.15,
+        )
+        summary = " ".join(f"s{i}" for i in range(100))
+
+        chat_prompt, token_breakdown = builder.build(
+            user_message="question",
+            recent_messages=[],
+            instructions="Stay in character.",
+            summary=summary,
+            related_information=["User: " + " ".join(["word"] * 12)] * 3,
+        )
+
+        assert token_breakdown["summary"] <= 50
+        assert "s99" in chat_prompt[1]["content"]
+        assert "s0 " not in chat_prompt[1]["content"]
+        assert token_breakdown["related_information"] <= 30
+        assert chat_prompt[2]["content"].count("User:") == 1
+
+    def test_identical_input_gives_identical_prompt(self):
+        builder = prompt_builder.PromptBuilder(
+            count_tokens=count_words, context_window=30, response_token_reserve=0
+        )
+        recent_messages = [message("user", " ".join(["word"] * 40))]
+
+        first_prompt = builder.build("question", recent_messages)
+        second_prompt = builder.build("question", recent_messages)
+
+        assert first_prompt == second_prompt
+        # The latest turn alone is too long, so it is kept in part
+        assert 0 < first_prompt[1]["recent_turns"] <= 30
@@ -0,0 +1,76 @@
+import os
+from tempfile import TemporaryDirectory
+
+from src.llm_agent_gui import response_cache
+
+
+def test_make_cache_key_normalizes_whitespace():
+    prompt = [{"role": "system", "content": "Greet  the user.\n"}]
+    same_prompt = [{"role": "system", "content": "Greet the user."}]
+    other_prompt = [{"role": "system", "content": "Insult the user."}]
+
+    key = response_cache.make_cache_key("openai", "gpt-3.5-turbo", {}, prompt)
+
+    assert key == response_cache.make_cache_key(
+        "openai", "gpt-3.5-turbo", {}, same_prompt
+    )
+    assert key != response_cache.make_cache_key(
+        "openai", "gpt-3.5-turbo", {}, other_prompt
+    )
+    assert key != response_cache.make_cache_key(
+        "openai", "gpt-3.5-turbo", {"temperature": 0.4}, prompt
+    )
+
+
+def test_get_returns_stored_response():
+    with TemporaryDirectory() as tmpdir:
+        cache = response_cache.ResponseCache(
+            os.path.join(tmpdir, "cache.sqlite3"), ttl_seconds=None, max_entries=10
+        )
+        cache.put("key", "Hello there!")
+
+        assert cache.get("key") == "Hello there!"
+        assert cache.get("missing") is None
+
+
+def test_expired_response_is_dropped(monkeypatch):
+    with TemporaryDirectory() as tmpdir:
+        cache = response_cache.ResponseCache(
+            os.path.join(tmpdir, "cache.sqlite3"), ttl_seconds=60, max_entries=10
+        )
+        monkeypatch.setattr(response_cache.time, "time", lambda: 1000.0)
+        cache.put("key", "Hello there!")
+
+        monkeypatch.setattr(response_cache.time, "time", lambda: 1061.0)
+
+        assert cache.get("key") is None
+        assert len(cache) == 0
+
+
+def test_least_recently_read_response_is_evicted(monkeypatch):
+    with TemporaryDirectory() as tmpdir:
+        cache = response_cache.ResponseCache(
+            os.path.join(tmpdir, "cache.sqlite3"), ttl_seconds=None, max_entries=2
+        )
+        for timestamp, key in enumerate(["first", "second"]):
+            monkeypatch.setattr(response_cache.time, "time", lambda t=timestamp: t)
+            cache.put(key, key)
+        monkeypatch.setattr(response_cache.time, "time", lambda: 2.0)
+        cache.get("first")
+
+        monkeypatch.setattr(response_cache.time, "time", lambda: 3.0)
+        cache.put("third", "third")
+
+        assert cache.get("second") is None
+        assert cache.get("first") == "first"
+        assert cache.get("third") == "third"
+
+
+def test_cache_persists_across_instances():
+    with TemporaryDirectory() as tmpdir:
+        cache_path = os.path.join(tmpdir, "cache.sqlite3")
+        response_cache.ResponseCache(cache_path, None, 10).put("key", "persisted")
+
+        assert response_cache.ResponseCache(cache_path, None, 10).get("key") == (
+            "persisted"
+        )
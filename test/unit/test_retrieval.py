@@ -0,0 +1,41 @@
+from src.llm_agent_gui import retrieval
+
+
+class TestBm25Index:
+    def test_search_ranks_keyword_matches_first(self):
+        index = retrieval.Bm25Index()
+        index.add(0, "User: I signed up for the chess tournament")
+        index.add(1, "Test: How was your day?")
+        index.add(2, "User: The tournament is next week, the chess club hosts it")
+
+        results = index.search("What did I say about the tournament?", limit=5)
+
+        assert [doc_id for doc_id, _ in results] == [0, 2]
+        assert index.get_document(0) == "User: I signed up for the chess tournament"
+
+    def test_add_replaces_and_remove_deletes(self):
+        index = retrieval.Bm25Index()
+        index.add(0, "User: hello there")
+        index.add(0, "User: general kenobi")
+
+        assert index.search("hello", limit=5) == []
+        assert [doc_id for doc_id, _ in index.search("kenobi", limit=5)] == [0]
+
+        index.remove(0)
+        assert len(index) == 0
+        assert index.search("kenobi", limit=5) == []
+
+
+class TestReciprocalRankFusion:
+    def test_documents_ranked_by_both_come_first(self):
+        fused_ranking = retrieval.reciprocal_rank_fusion([[1, 2, 3], [3, 4, 1]])
+
+        assert fused_ranking[:2] == [1, 3]
+        assert set(fused_ranking) == {1, 2, 3, 4}
+
+    def test_weights_scale_fused_scores(self):
+        fused_ranking = retrieval.reciprocal_rank_fusion(
+            [[1, 2], [1, 2]], weights={2: 2.0}
+        )
+
+        assert fused_ranking == [2, 1]
@@ -0,0 +1,90 @@
+from src.llm_agent_gui import session_pool
+
+
+class FakeSession:
+    def __init__(self, character_name, cached_documents=0):
+        self.character_name = character_name
+        self.cached_documents = cached_documents
+        self.closed = False
+
+    def cached_document_count(self):
+        return self.cached_documents
+
+    def close(self):
+        self.closed = True
+
+
+class TestSessionPool:
+    def test_session_is_reused(self):
+        pool = session_pool.SessionPool(create_session=FakeSession)
+
+        assert pool.get("Goku") is pool.get("Goku")
+        assert len(pool) == 1
+
+    def test_least_recently_used_session_is_closed(self):
+        pool = session_pool.SessionPool(create_session=FakeSession, max_sessions=2)
+        goku = pool.get("Goku")
+        vegeta = pool.get("Vegeta")
+        pool.get("Goku")
+
+        pool.get("Gohan")
+
+        assert vegeta.closed and not goku.closed
+        assert "Vegeta" not in pool
+        assert "Goku" in pool and "Gohan" in pool
+
+    def test_sessions_are_closed_beyond_cached_documents(self):
+        pool = session_pool.SessionPool(
+            create_session=lambda name: FakeSession(name, cached_documents=60),
+            max_sessions=3,
+            max_cached_documents=100,
+        )
+        goku = pool.get("Goku")
+
+        vegeta = pool.get("Vegeta")
+
+        assert goku.closed and not vegeta.closed
+        assert len(pool) == 1
+
+    def test_requested_session_is_never_closed(self):
+        pool = session_pool.SessionPool(
+            create_session=lambda name: FakeSession(name, cached_documents=500),
+            max_cached_documents=100,
+        )
+
+        goku = pool.get("Goku")
+
+        assert not goku.closed
+        assert "Goku" in pool
+
+    def test_put_adds_existing_session(self):
+        pool = session_pool.SessionPool(create_session=FakeSession, max_sessions=1)
+        goku = FakeSession("Goku")
+        pool.put("Goku", goku)
+
+        assert pool.get("Goku") is goku
+        pool.get("Vegeta")
+        assert goku.closed
+
+    def test_evicted_sessions_are_handed_to_close_callback(self):
+        evicted_sessions = []
+        pool = session_pool.SessionPool(
+            create_session=FakeSession,
+            max_sessions=1,
+            close_evicted_session=evicted_sessions.append,
+        )
+        goku = pool.get("Goku")
+
+        pool.get("Vegeta")
+
+        assert evicted_sessions == [goku]
+        assert not goku.closed
+
+    def test_close_closes_all_sessions(self):
+        pool = session_pool.SessionPool(create_session=FakeSession)
+        sessions = [pool.get(name) for name in ["Goku", "Vegeta"]]
+
+        pool.close()
+
+        assert all(session.closed for session in sessions)
+        assert len(pool) == 0
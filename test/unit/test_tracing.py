@@ -0,0 +1,91 @@
+import contextvars
+import json
+import os
+import threading
+from tempfile import TemporaryDirectory
+
+import pytest
+
+from src.llm_agent_gui import tracing
+
+
+class TestTracer:
+    def test_span_is_recorded(self):
+        tracer = tracing.Tracer()
+
+        with tracer.span("summary_buffer.load", lines=3) as span:
+            span["attributes"]["cached"] = False
+
+        (recorded_span,) = tracer.get_spans()
+        assert recorded_span["name"] == "summary_buffer.load"
+        assert recorded_span["duration"] >= 0
+        assert recorded_span["attributes"] == {"lines": 3, "cached": False}
+
+    def test_failed_span_records_error(self):
+        tracer = tracing.Tracer()
+
+        with pytest.raises(ValueError), tracer.span("vector_store.query"):
+            raise ValueError("no collection")
+
+        assert tracer.get_spans()[0]["attributes"]["error"] == "ValueError"
+
+    def test_ring_buffer_keeps_latest_spans(self):
+        tracer = tracing.Tracer(capacity=2)
+
+        for name in ["first", "second", "third"]:
+            with tracer.span(name):
+                pass
+
+        assert [span["name"] for span in tracer.get_spans()] == ["second", "third"]
+
+    def test_spans_join_turn_across_threads(self):
+        tracer = tracing.Tracer()
+
+        def run_stage():
+            with tracer.span("turn.buffer_write"):
+                pass
+
+        with tracing.turn() as turn_id:
+            with tracer.span("turn.prompt_build"):
+                pass
+            stage_thread = threading.Thread(
+                target=contextvars.copy_context().run, args=(run_stage,)
+            )
+            stage_thread.start()
+            stage_thread.join()
+        with tracer.span("ui.render"):
+            pass
+
+        assert [span["name"] for span in tracer.get_spans(turn=turn_id)] == [
+            "turn.prompt_build",
+            "turn.buffer_write",
+        ]
+
+    def test_export_jsonl(self):
+        tracer = tracing.Tracer()
+        with tracer.span("llm.stream", tokens=12):
+            pass
+
+        with TemporaryDirectory() as tmpdir:
+            export_path = os.path.join(tmpdir, "trace.jsonl")
+
+            assert tracer.export_jsonl(export_path) == 1
+            with open(export_path) as f:
+                exported_span = json.loads(f.readline())
+
+        assert exported_span["name"] == "llm.stream"
+        assert exported_span["attributes"] == {"tokens": 12}
+
+
+def test_format_spans():
+    spans = [
+        {
+            "name": "llm.stream",
+            "duration": 1.5,
+            "attributes": {"time_to_first_token": 0.25, "tokens": 42},
+        }
+    ]
+
+    assert tracing.format_spans(spans) == (
+        "llm.stream" + " " * 22 + "   1500.0 ms  first token 250.0 ms  42 tokens"
+    )
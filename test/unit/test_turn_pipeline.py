@@ -0,0 +1,48 @@
+import threading
+
+from src.llm_agent_gui import turn_pipeline
+
+
+class TestTurnPipeline:
+    def test_jobs_run_in_submission_order(self):
+        pipeline = turn_pipeline.TurnPipeline()
+        for turn in range(3):
+            pipeline.submit(lambda emit_event, turn=turn: emit_event("answer", turn))
+
+        pipeline.wait_until_idle()
+
+        assert pipeline.get_events() == [("answer", 0), ("answer", 1), ("answer", 2)]
+        assert pipeline.get_events() == []
+        pipeline.shutdown()
+
+    def test_jobs_are_queued_while_worker_is_busy(self):
+        pipeline = turn_pipeline.TurnPipeline()
+        release_job = threading.Event()
+        pipeline.submit(lambda emit_event: release_job.wait())
+        pipeline.submit(lambda emit_event: emit_event("answer", "queued"))
+
+        assert pipeline.is_busy()
+        assert pipeline.pending() == 2
+
+        release_job.set()
+        pipeline.wait_until_idle()
+
+        assert not pipeline.is_busy()
+        assert pipeline.get_events() == [("answer", "queued")]
+        pipeline.shutdown()
+
+    def test_failing_job_emits_error_and_keeps_worker_alive(self):
+        pipeline = turn_pipeline.TurnPipeline()
+
+        def failing_job(emit_event):
+            raise ValueError("inference failed")
+
+        pipeline.submit(failing_job)
+        pipeline.submit(lambda emit_event: emit_event("answer", "next"))
+        pipeline.wait_until_idle()
+
+        (error_event, error), next_event = pipeline.get_events()
+        assert error_event == "error"
+        assert isinstance(error, ValueError)
+        assert next_event == ("answer", "next")
+        pipeline.shutdown()
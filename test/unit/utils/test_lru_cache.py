@@ -0,0 +1,31 @@
+from src.llm_agent_gui.utils import lru_cache
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = lru_cache.LruCache(max_size=2)
+    cache.put("first", 1)
+    cache.put("second", 2)
+
+    assert cache.get("first") == 1  # first is now the most recently used
+
+    cache.put("third", 3)
+
+    assert "second" not in cache
+    assert cache.get("first") == 1
+    assert cache.get("third") == 3
+    assert len(cache) == 2
+
+
+def test_get_returns_default_for_missing_key():
+    cache = lru_cache.LruCache(max_size=1)
+
+    assert cache.get("missing") is None
+    assert cache.get("missing", "default") == "default"
+
+
+def test_pop_removes_entry():
+    cache = lru_cache.LruCache(max_size=2)
+    cache.put("key", "value")
+
+    assert cache.pop("key") == "value"
+    assert "key" not in cache
@@ -0,0 +1,45 @@
+from src.llm_agent_gui.utils import prompts
+
+
+class Character:
+    name = "test_character"
+    platform_type = "movie"
+    platform_name = "Star Wars"
+
+
+def test_system_chat_prompt_is_independent_of_turn_context():
+    system_prompt = prompts.prepare_system_chat_prompt(
+        character=Character(), system_message="Stay in character."
+    )
+
+    assert "test_character" in system_prompt
+    assert "Stay in character." in system_prompt
+    assert "summary" not in system_prompt
+
+
+def test_prepare_related_information_prompt():
+    related_information_prompt = prompts.prepare_related_information_prompt(
+        context_sentences=["User: Hello there", "test_character: General Kenobi"]
+    )
+
+    assert related_information_prompt.endswith(
+        "User: Hello there\ntest_character: General Kenobi\n\n"
+    )
+
+
+def test_prepare_chunk_summarizer_prompt():
+    summarizer_prompt = prompts.prepare_chunk_summarizer_prompt(
+        previous_summary="They met at the cantina.",
+        new_messages=[
+            {"role": "user", "content": "Hello there"},
+            {"role": "assistant", "content": "General Kenobi"},
+        ],
+        character_name="test_character",
+        user_name="User",
+    )
+
+    assert "They met at the cantina." in summarizer_prompt[1]["content"]
+    assert (
+        "User: Hello there\ntest_character: General Kenobi\n"
+        in (summarizer_prompt[1]["content"])
+    )